@@ -0,0 +1,57 @@
+"""Микробенчмарк маршрутизации callback_data.
+
+Сравнивает CALLBACKS.resolve() с линейным проходом по тем же маршрутам
+(как в старой цепочке if data == ... / data.startswith(...)).
+
+    python bench/bench_callbacks.py [-n 200000]
+"""
+import argparse, os, sys, timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "0:bench")  # bot.py требует токен при импорте
+
+import bot  # noqa: E402
+
+SAMPLES = [
+    "tarot:open", "tarot:draw:three", "tarot:about:mystic", "tarot:buy:p15",
+    "catpred:open", "catpred:Любовь", "catdepth:Любовь:medium", "catdepth:Работа:short",
+    "settings:open", "settings:notify:set:09:00", "setz:Лев", "ui:menu", "noop",
+    "admin:stats_age", "admin:bc_stop:42", "unknown:data",
+]
+
+def linear_routes(router) -> list[tuple[str, bool]]:
+    routes = [(k, False) for k in router._exact]
+    stack = [("", router._trie)]
+    while stack:
+        prefix, node = stack.pop()
+        for seg, child in node.items():
+            if seg is None:
+                routes.append((prefix, True))
+            else:
+                stack.append((prefix + seg + ":", child))
+    return routes
+
+def linear_resolve(routes, data: str):
+    for pat, is_prefix in routes:
+        if (data.startswith(pat) if is_prefix else data == pat):
+            return pat
+    return None
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=200_000, help="вызовов на каждый callback_data")
+    args = ap.parse_args()
+    routes = linear_routes(bot.CALLBACKS)
+    print(f"маршрутов: {len(routes)} (точных {len(bot.CALLBACKS._exact)})")
+    print(f"{'callback_data':<28}{'router, нс':>12}{'linear, нс':>12}")
+    tot_r = tot_l = 0.0
+    for data in SAMPLES:
+        r = timeit.timeit(lambda: bot.CALLBACKS.resolve(data), number=args.n) / args.n * 1e9
+        l = timeit.timeit(lambda: linear_resolve(routes, data), number=args.n) / args.n * 1e9
+        tot_r += r; tot_l += l
+        print(f"{data:<28}{r:>12.0f}{l:>12.0f}")
+    print(f"{'среднее':<28}{tot_r / len(SAMPLES):>12.0f}{tot_l / len(SAMPLES):>12.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Микробенчмарки горячих путей контента и раскладов.
+
+Работает офлайн: каталоги знаков из репозитория, tarot_deck.json, оверлеи генерируются во
+временный каталог, SQLite — временная база с историей раскладов (--users пользователей,
+маски за TAROT_NO_REPEAT_DAYS дней и журнал tarot_draws).
+
+    python bench/bench_hotpaths.py                  # сравнить с bench/baseline_hotpaths.json
+    python bench/bench_hotpaths.py --save           # записать новую базовую линию
+    python bench/bench_hotpaths.py -k resolve --threshold 0.5
+
+Для каждого кейса берётся лучшее из --repeat замеров (мкс на вызов). Код выхода 1, если
+какой-то кейс медленнее базовой линии больше чем на --threshold (доля). Базовая линия
+привязана к машине: после смены железа или Python её нужно перезаписать.
+"""
+import argparse, asyncio, json, os, platform, random, shutil, sys, tempfile, time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = tempfile.mkdtemp(prefix="bench-hotpaths-")
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("BOT_TOKEN", "0:bench")  # bot.py требует токен при импорте
+os.environ.setdefault("PREDICTIONS_DB_DIR", str(ROOT))
+os.environ["DB_PATH"] = str(Path(TMP) / "bench.db")
+os.environ["TAROT_OVERLAYS_DIR"] = str(Path(TMP) / "overlays")
+
+import bot  # noqa: E402
+
+BASELINE = Path(__file__).resolve().parent / "baseline_hotpaths.json"
+
+def _write_overlays():
+    """Оверлей на каждый знак: текст для каждого тега колоды."""
+    tags = sorted({t for card in bot.load_tarot_deck() for t in card["tags"]})
+    d = Path(os.environ["TAROT_OVERLAYS_DIR"])
+    d.mkdir(parents=True, exist_ok=True)
+    for z in bot.ZODIACS:
+        overlay = {t: f"{z}: тема «{t}» сегодня звучит особенно." for t in tags}
+        (d / f"{z}.json").write_text(json.dumps(overlay, ensure_ascii=False), encoding="utf-8")
+
+async def _seed_db(users: int, draws_per_day: int):
+    """tarot_users.recent_masks за окно без повторов + соответствующий журнал tarot_draws."""
+    await bot.DB.open()
+    await bot.init_db()
+    deck = bot.tarot_deck()
+    today = bot._today_ordinal()
+    rng = random.Random(42)
+    user_rows, draw_rows = [], []
+    for uid in range(1, users + 1):
+        masks = {}
+        for back in range(bot.TAROT_NO_REPEAT_DAYS):
+            if rng.random() < 0.6:   # заходит не каждый день
+                continue
+            day = today - back
+            picked = rng.sample(range(len(deck)), rng.randint(1, draws_per_day))
+            masks[day] = sum(1 << i for i in picked)
+            date = bot.datetime.date.fromordinal(day).isoformat()
+            for i in picked:
+                draw_rows.append((uid, int(time.time()) - back * 86400, date, deck[i]["code"], "scientist", 0))
+        user_rows.append((uid, rng.randint(0, 20), "scientist", bot._format_masks(masks)))
+    await bot.DB.executemany(
+        "INSERT INTO tarot_users(user_id, cards_balance, tarolog, recent_masks) VALUES(?,?,?,?)", user_rows)
+    await bot.DB.executemany(
+        "INSERT INTO tarot_draws(user_id, ts, date, card_code, tarolog, is_free) VALUES(?,?,?,?,?,?)", draw_rows)
+    return len(draw_rows)
+
+def _cases(users: int):
+    base = bot._pred_dirs()[0]
+    zdir = bot.resolve_zodiac_dir(base, "Скорпион")
+    deck = bot.load_tarot_deck()
+    overlay = bot.load_zodiac_overlay("Лев")
+    card = deck[17]
+    names = ["Скорпион", "  Близнецы ", "Водолей_short", "Любовь и отношения", "ЁЛКА-Финансы (1)"]
+    rng = random.Random(7)
+    uids = [rng.randint(1, users) for _ in range(1024)]
+    it = iter(range(1 << 62))
+    return {
+        "norm_fs":                 (lambda: [bot._norm_fs(n) for n in names], len(names)),
+        "resolve_zodiac_dir":      (lambda: bot.resolve_zodiac_dir(base, "Скорпион"), 1),
+        "resolve_zodiac_dir_miss": (lambda: bot.resolve_zodiac_dir(base, "Змееносец"), 1),
+        "resolve_category_files":  (lambda: bot.resolve_category_files(zdir, "Любовь", "medium"), 1),
+        "find_prediction_files":   (lambda: bot.find_prediction_files("Скорпион", "Любовь", "long"), 1),
+        "pick_prediction":         (lambda: bot.pick_prediction("Скорпион", "Любовь", "short"), 1),
+        "load_tarot_deck":         (bot.load_tarot_deck, 1),
+        "load_zodiac_overlay":     (lambda: bot.load_zodiac_overlay("Лев"), 1),
+        "draw_unique_cards_one":   (lambda: bot.draw_unique_cards_for_spread(uids[next(it) & 1023], "Лев", "one"), 1),
+        "draw_unique_cards_three": (lambda: bot.draw_unique_cards_for_spread(uids[next(it) & 1023], "Лев", "three"), 1),
+        "build_category_card":     (lambda: bot.build_category_card("Скорпион", "Любовь"), 1),
+        "apply_overlays":          (lambda: bot.apply_overlays(card["upright"], card["tags"], overlay), 1),
+    }
+
+async def _measure(fn, per_call: int, repeat: int, min_time: float) -> float:
+    """Лучшее время одного вызова (мкс) из repeat серий; размер серии подбирается под min_time."""
+    async def run(n):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            r = fn()
+            if asyncio.iscoroutine(r):
+                await r
+        return time.perf_counter() - t0
+    n = 1
+    while (dt := await run(n)) < min_time / 10:
+        n *= 2
+    n = max(1, int(n * min_time / dt))
+    best = min([await run(n) for _ in range(repeat)])
+    return best / n / per_call * 1e6
+
+def _load_baseline(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8")).get("results", {})
+    except FileNotFoundError:
+        return {}
+
+async def main_async(args) -> int:
+    _write_overlays()
+    n_draws = await _seed_db(args.users, args.draws_per_day)
+    print(f"БД: {args.users} пользователей, {n_draws} раскладов в журнале")
+    bot.PRED_INDEX.reload(force=True)
+    baseline = {} if args.save else _load_baseline(args.baseline)
+    results, regressions = {}, []
+    print(f"{'кейс':<26}{'мкс/вызов':>12}{'база':>12}{'Δ':>9}")
+    try:
+        for name, (fn, per_call) in _cases(args.users).items():
+            if args.k and args.k not in name:
+                continue
+            us = await _measure(fn, per_call, args.repeat, args.min_time)
+            results[name] = round(us, 3)
+            ref = baseline.get(name)
+            delta = f"{(us / ref - 1) * 100:+.0f}%" if ref else ""
+            flag = ""
+            if ref and us > ref * (1 + args.threshold):
+                regressions.append(name)
+                flag = "  РЕГРЕССИЯ"
+            print(f"{name:<26}{us:>12.2f}{ref if ref else '—':>12}{delta:>9}{flag}")
+    finally:
+        await bot.DB.close()
+        shutil.rmtree(TMP, ignore_errors=True)
+    if args.save:
+        if args.k and args.baseline.exists():
+            # частичный прогон обновляет только свои кейсы
+            results = {**_load_baseline(args.baseline), **results}
+        args.baseline.write_text(json.dumps({
+            "python": platform.python_version(),
+            "machine": f"{platform.system()} {platform.machine()}",
+            "results": dict(sorted(results.items())),
+        }, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"базовая линия записана: {args.baseline}")
+        return 0
+    if regressions:
+        print(f"регрессии (> {args.threshold:.0%}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-k", default="", help="только кейсы, в имени которых есть подстрока")
+    ap.add_argument("--save", action="store_true", help="записать результаты как базовую линию")
+    ap.add_argument("--baseline", type=Path, default=BASELINE)
+    ap.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление, доля")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="длительность одной серии, с")
+    ap.add_argument("--users", type=int, default=5000, help="пользователей с историей раскладов")
+    ap.add_argument("--draws-per-day", type=int, default=3)
+    args = ap.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
@@ -10,17 +10,29 @@
 # - Предсказания из файлов predictions_db/<Знак>/<Категория>_{short|medium|long}.txt
 # - Подсветка текущего таролога (✅) и блокировка кнопки «Выбрать», если он уже выбран
 # - /tgtest для проверки Telegram API
+# - Webhook-режим со встроенным HTTP-сервером (WEBHOOK_URL / UPDATES_MODE=webhook)
+# - Метрики в формате Prometheus на GET /metrics (METRICS_PORT)
 #
-# Требования: python-telegram-bot >= 20, aiosqlite, python3.10+
-# В .env нужен BOT_TOKEN; опционально TELEGRAM_BASE_URL, HTTPS_PROXY/HTTP_PROXY
+# Требования: python-telegram-bot >= 20, aiosqlite, python3.10+; Pillow (пережатие картинок; без него файлы отправляются как есть)
+# В .env нужен BOT_TOKEN; опционально TELEGRAM_BASE_URL, HTTPS_PROXY/HTTP_PROXY,
+# WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, ALLOWED_UPDATES,
+# METRICS_PORT, METRICS_LISTEN
 
-import os, asyncio, logging, datetime, inspect, random, json, re, unicodedata
+import os, sys, asyncio, logging, datetime, inspect, random, json, re, html, unicodedata, hashlib, hmac, secrets, signal, sqlite3, tempfile, time, functools
+from bisect import bisect_left
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
 from typing import Optional
 from zoneinfo import ZoneInfo
 
 import aiosqlite
 from dotenv import load_dotenv
+try:
+    from PIL import Image, ImageOps   # есть в requirements.txt; без Pillow картинки отправляются без пережатия
+except ImportError:
+    Image = ImageOps = None
 from telegram import (
     Update, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
@@ -28,9 +40,11 @@ from telegram import (
 from telegram.constants import ParseMode
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters,
+    CallbackQueryHandler, ContextTypes, TypeHandler, filters,
+    BasePersistence, PersistenceInput, BaseRateLimiter,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut, NetworkError
+from telegram.request import HTTPXRequest
 
 # ----------------- БАЗОВАЯ НАСТРОЙКА -----------------
 
@@ -44,11 +58,37 @@ if not BOT_TOKEN:
 TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "").strip()
 HTTP_PROXY = os.getenv("HTTPS_PROXY", os.getenv("HTTP_PROXY", "")).strip()
 
-DB_PATH = APP_DIR / "astro.db"
+# Приём апдейтов: polling (по умолчанию) или webhook — если задан WEBHOOK_URL.
+# UPDATES_MODE=webhook без WEBHOOK_URL поднимает только локальный сервер (для проверки записанными апдейтами).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")        # публичный https://host[:port]
+UPDATES_MODE = os.getenv("UPDATES_MODE", "webhook" if WEBHOOK_URL else "polling").strip().lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443") or 8443)
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "tg-webhook").strip().strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if UPDATES_MODE == "webhook" and not WEBHOOK_URL and not WEBHOOK_SECRET:
+    # локальный сервер без setWebhook: секрет должен знать и отправитель (tools/replay_updates.py)
+    raise SystemExit("❌ UPDATES_MODE=webhook без WEBHOOK_URL: задайте WEBHOOK_SECRET в .env")
+# с WEBHOOK_URL секрет по умолчанию случайный — его получает только Telegram через setWebhook
+WEBHOOK_SECRET = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40") or 40)
+# хендлеры бота обрабатывают только сообщения и нажатия кнопок; "all" — все типы
+_ALLOWED_UPDATES_ENV = os.getenv("ALLOWED_UPDATES", "message,callback_query").strip()
+
+# Шардирование: SHARDS>1 — фронт-процесс принимает апдейты и раздаёт их по user_id % SHARDS
+# воркерам (каждый — полноценный бот со своими кэшами). SHARD_INDEX фронт выставляет воркерам сам.
+SHARD_COUNT = max(1, int(os.getenv("SHARDS", "1") or 1))
+_SHARD_INDEX_ENV = os.getenv("SHARD_INDEX", "").strip()
+SHARD_INDEX = int(_SHARD_INDEX_ENV) if _SHARD_INDEX_ENV else None   # None — фронт или одиночный процесс
+IS_PRIMARY = SHARD_INDEX in (None, 0)   # утренние рассылки, продолжение broadcast, запись daily_renders
+
+DB_PATH = Path(os.getenv("DB_PATH", "").strip() or APP_DIR / "astro.db")
 TZ = ZoneInfo("Europe/Moscow")
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+# каждая задача JobQueue (этапы анимаций) иначе пишет по три INFO-строки
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 
 # ----------------- АДМИНЫ -----------------
 MAIN_ADMIN_ID = int(os.getenv("MAIN_ADMIN_ID", "0") or 0)
@@ -167,6 +207,9 @@ def _label_for_tarolog(code: Optional[str]) -> str:
     return "выбрать…"
 
 def _tarot_img_path(code: str) -> Optional[Path]:
+    p = ASSETS.path("tarot", code)
+    if p is not None:
+        return p
     base = Path(TAROT_IMAGES_DIR)
     if not base.exists():
         return None
@@ -182,6 +225,9 @@ def _tarot_img_path(code: str) -> Optional[Path]:
 # --- Zodiac images (helper) ---
 ZODIAC_IMAGES_DIR = os.getenv("ZODIAC_IMAGES_DIR", "zodiac_images")
 def _zodiac_img_path(zodiac: str) -> Optional[Path]:
+    p = ASSETS.path("zodiac", zodiac)
+    if p is not None:
+        return p
     base = Path(ZODIAC_IMAGES_DIR)
     if not base.is_absolute():
         base = APP_DIR / base
@@ -213,6 +259,16 @@ def _zodiac_img_path(zodiac: str) -> Optional[Path]:
 def today_str() -> str:
     return datetime.datetime.now(tz=TZ).strftime("%Y-%m-%d")
 
+# --- Process-stable seeds ---
+# Встроенный hash() для строк рандомизируется при каждом запуске (PYTHONHASHSEED), поэтому
+# все детерминированные выборы (предсказание дня, расклад, шкалы) считаются через blake2b.
+SEED_KEY = os.getenv("SEED_KEY", "astro-bot").encode("utf-8")
+
+def stable_hash(*parts) -> int:
+    """64-битный хеш полей; одинаков во всех процессах, воркерах и после рестарта."""
+    raw = "\x1f".join(str(p) for p in parts).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8, key=SEED_KEY).digest(), "big")
+
 # ---------- Predictions filesystem helpers ----------
 _EN_ALIAS = {
     "Овен":"aries","Телец":"taurus","Близнецы":"gemini","Рак":"cancer","Лев":"leo","Дева":"virgo",
@@ -355,11 +411,73 @@ def load_predictions(zodiac: str, category: str, depth: str) -> list[str]:
             continue
     return []
 
+# ---------- In-memory prediction index (hot reload) ----------
+PREDICTIONS_RELOAD_SEC = int(os.getenv("PREDICTIONS_RELOAD_SEC", "30") or 30)
+PRED_DEPTHS = ("short", "medium", "long")
+
+def _pred_fs_signature() -> tuple:
+    """(путь, mtime_ns, size) всех .txt в каталогах знаков — дешёвый признак изменений."""
+    sig = []
+    for base in _pred_dirs():
+        try:
+            for d in base.iterdir():
+                if not d.is_dir() or d.name.startswith("."):
+                    continue
+                for f in d.iterdir():
+                    if f.suffix.lower() == ".txt" and f.is_file():
+                        st = f.stat()
+                        sig.append((str(f), st.st_mtime_ns, st.st_size))
+        except Exception:
+            continue
+    return tuple(sorted(sig))
+
+class PredictionIndex:
+    """Снимок всех пулов предсказаний {(знак, категория, глубина): tuple[str, ...]}.
+    Строится теми же резолверами (fallback на _common, _long, ё/е, префиксы) и
+    подменяется целиком одним присваиванием, поэтому читатели не видят полусобранных данных."""
+
+    def __init__(self):
+        self._pools: Optional[MappingProxyType] = None
+        self._sig: Optional[tuple] = None
+
+    def get(self, zodiac: str, category: str, depth: str) -> Optional[tuple]:
+        pools = self._pools
+        if pools is None:
+            self.reload()
+            pools = self._pools
+        return pools.get((zodiac, category, depth))
+
+    def reload(self, force: bool = False) -> bool:
+        sig = _pred_fs_signature()
+        if not force and self._pools is not None and sig == self._sig:
+            return False
+        pools = {}
+        for z in ZODIACS:
+            for cat, _emo in CATEGORY_LIST:
+                for depth in PRED_DEPTHS:
+                    pools[(z, cat, depth)] = tuple(load_predictions(z, cat, depth))
+        self._pools, self._sig = MappingProxyType(pools), sig
+        logging.info("Prediction index built: %d pools, %d files", len(pools), len(sig))
+        return True
+
+PRED_INDEX = PredictionIndex()
+
+async def pred_index_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if await asyncio.to_thread(PRED_INDEX.reload):
+            # тексты поменялись — пересчитываем готовые тела на сегодня
+            await DAILY.refresh()
+    except Exception as e:
+        logging.warning("Prediction index reload failed: %s", e)
+
 def pick_prediction(zodiac: str, category: str, depth: str) -> str:
-    pool = load_predictions(zodiac, category, depth)
+    pool = PRED_INDEX.get(zodiac, category, depth)
+    if pool is None:
+        # категория/знак вне индекса — старый путь через файловую систему
+        pool = load_predictions(zodiac, category, depth)
     if not pool:
         return "Пока нет текста для этой категории. Попробуй другую или зайди позже."
-    idx = abs(hash((today_str(), zodiac, category, depth))) % len(pool)
+    idx = stable_hash(today_str(), zodiac, category, depth) % len(pool)
     return pool[idx]
 
 # ---- Tarot loaders & helpers (78 карт, перевёрнутые, оверлеи) ----
@@ -384,6 +502,23 @@ def load_tarot_deck() -> list[dict]:
         logging.warning("Tarot deck load failed: %s", e)
     return TAROT_DECK_FALLBACK[:]
 
+_DECK: Optional[list[dict]] = None
+_DECK_INDEX: dict[str, int] = {}
+
+def tarot_deck() -> list[dict]:
+    """Колода, загруженная один раз за процесс (не изменять — общий объект)."""
+    global _DECK, _DECK_INDEX
+    if _DECK is None:
+        deck = load_tarot_deck()
+        _DECK_INDEX = {c["code"]: i for i, c in enumerate(deck)}
+        _DECK = deck
+    return _DECK
+
+def tarot_card_index() -> dict[str, int]:
+    """code → индекс карты в tarot_deck()."""
+    tarot_deck()
+    return _DECK_INDEX
+
 def load_zodiac_overlay(zodiac: str) -> dict:
     """Читает оверлей по знаку: словарь {tag: overlay_text}."""
     try:
@@ -419,63 +554,83 @@ def decide_orientation(rng: random.Random) -> bool:
 
 # ---- Tarot helpers ----
 async def get_user_zodiac(user_id: int) -> Optional[str]:
-    async with db_connect() as db:
-        cur = await db.execute("SELECT zodiac FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        return row[0] if row and row[0] else None
-
-async def recent_cards_set(user_id: int, days: int) -> set[str]:
-    # собрать уникальные коды карт за последние N дней (учитываем, что card_code может быть списком через запятую)
-    since = datetime.datetime.now(tz=TZ) - datetime.timedelta(days=days)
-    since_ts = int(since.timestamp())
-    seen: set[str] = set()
-    async with db_connect() as db:
-        cur = await db.execute("SELECT card_code FROM tarot_draws WHERE user_id=? AND ts>=?", (user_id, since_ts))
-        async for row in cur:
-            val = row[0] or ""
-            for part in str(val).split(","):
-                p = part.strip()
-                if p.endswith("(R)"):
-                    p = p[:-3].strip()
-                if p:
-                    seen.add(p)
-    return seen
+    return (await PROFILES.get(user_id)).zodiac
+
+# --- No-repeat window as per-day bitmasks ---
+# Карта = индекс в загруженной колоде; для каждого дня храним 78-битную маску вытянутых карт
+# в tarot_users.recent_masks ("<day_ordinal>:<hex>;..."). Исключения за TAROT_NO_REPEAT_DAYS —
+# это OR нескольких чисел, журнал tarot_draws на пути расклада не читается.
+
+def _today_ordinal() -> int:
+    return datetime.datetime.now(tz=TZ).date().toordinal()
+
+def _parse_masks(raw: Optional[str]) -> dict[int, int]:
+    out: dict[int, int] = {}
+    for part in (raw or "").split(";"):
+        day, sep, mask = part.partition(":")
+        if not sep:
+            continue
+        try:
+            out[int(day)] = int(mask, 16)
+        except ValueError:
+            continue
+    return out
+
+def _format_masks(masks: dict[int, int], days: int = TAROT_NO_REPEAT_DAYS) -> str:
+    cutoff = _today_ordinal() - days
+    return ";".join(f"{d}:{m:x}" for d, m in sorted(masks.items()) if d >= cutoff and m)
+
+def cards_to_mask(codes) -> int:
+    index = tarot_card_index()
+    mask = 0
+    for code in codes:
+        c = str(code).strip()
+        if c.endswith("(R)"):
+            c = c[:-3].strip()
+        i = index.get(c)
+        if i is not None:
+            mask |= 1 << i
+    return mask
+
+async def recent_cards_mask(user_id: int, days: int = TAROT_NO_REPEAT_DAYS) -> int:
+    """OR масок за последние `days` дней."""
+    row = await DB.fetchone("SELECT COALESCE(recent_masks,'') FROM tarot_users WHERE user_id=?", (user_id,))
+    cutoff = _today_ordinal() - days
+    mask = 0
+    for d, m in _parse_masks(row[0] if row else "").items():
+        if d >= cutoff:
+            mask |= m
+    for d, m in _PENDING_MASKS.get(user_id, {}).items():   # ещё не сброшенные WRITE_BEHIND
+        if d >= cutoff:
+            mask |= m
+    return mask
 
 def _seed_for_spread(user_id: int, zodiac: str, spread_key: str) -> int:
     # детерминированное семя для конкретного дня + пользователь + знак + тип расклада
-    base = f"{today_str()}|{user_id}|{zodiac}|{spread_key}"
-    return abs(hash(base)) % (2**31)
+    return stable_hash(today_str(), user_id, zodiac, spread_key) % (2**31)
 
 async def draw_unique_cards_for_spread(user_id: int, zodiac: str, spread_key: str) -> list[dict]:
     """Возвращает список карточек-объектов {code,upright,reversed,tags} без повторов за TAROT_NO_REPEAT_DAYS."""
     spread = TAROT_SPREADS[spread_key]
     need = len(spread["positions"])
     rng = deck_rng_for(user_id, zodiac, spread_key)
-    deck = load_tarot_deck()
-    rng.shuffle(deck)
-    # фильтруем от недавних
-    recent = await recent_cards_set(user_id, TAROT_NO_REPEAT_DAYS)
-    fresh = [c for c in deck if c["code"] not in recent]
-    chosen: list[dict] = []
-    pool = fresh if len(fresh) >= need else deck
-    for card in pool:
-        if card in chosen:
-            continue
-        chosen.append(card)
-        if len(chosen) == need:
-            break
-    return chosen
+    deck = tarot_deck()
+    order = list(range(len(deck)))
+    rng.shuffle(order)
+    # фильтруем от недавних (индексы уникальны — повторов внутри расклада нет)
+    recent = await recent_cards_mask(user_id, TAROT_NO_REPEAT_DAYS)
+    fresh = [i for i in order if not (recent >> i) & 1]
+    pool = fresh if len(fresh) >= need else order
+    return [deck[i] for i in pool[:need]]
 
 
 # --- Notifications (user-chosen time) ---
 DEFAULT_NOTIFY_TIME = "09:00"  # Moscow time by default
+NOTIFY_SLOTS = ("07:00", "08:00", "09:00", "10:00", "11:00", "12:00")  # окно 07:00–12:00 МСК
 
 async def get_notify_time(user_id: int) -> str:
     """Returns HH:MM (MSK). Enforces 07:00–12:00 with :00 minutes; else returns default 09:00."""
-    async with db_connect() as db:
-        cur = await db.execute("SELECT COALESCE(notify_time, '') FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        val = (row[0] or "").strip() if row else ""
+    val = (await PROFILES.get(user_id)).notify_time.strip()
     if not re.match(r"^\d{2}:\d{2}$", val or ""):
         return DEFAULT_NOTIFY_TIME
     hh, mm = val.split(":")
@@ -525,14 +680,14 @@ def load_daily_prediction(zodiac: Optional[str] = None) -> str:
     if base_file.exists() and base_file.is_file():
         lines = _read_lines(base_file)
         if lines:
-            idx = abs(hash(today_str())) % len(lines)
+            idx = stable_hash(today_str()) % len(lines)
             return lines[idx]
 
     # 2) Файл predictions.txt
     if base_txt.exists() and base_txt.is_file():
         lines = _read_lines(base_txt)
         if lines:
-            idx = abs(hash(today_str())) % len(lines)
+            idx = stable_hash(today_str()) % len(lines)
             return lines[idx]
 
     # 3) Директория predictions/
@@ -551,28 +706,22 @@ def load_daily_prediction(zodiac: Optional[str] = None) -> str:
             if p.exists() and p.is_file():
                 lines = _read_lines(p)
                 if lines:
-                    idx = abs(hash(today_str() + (zodiac or ""))) % len(lines)
+                    idx = stable_hash(today_str(), zodiac or "") % len(lines)
                     return lines[idx]
 
     return "✨ Сегодня нет текста предсказания. Проверьте: файл <code>predictions</code> или каталог <code>predictions/</code> рядом с bot.py."
 
 async def _morning_digest_text(zodiac: str) -> str:
-    today = today_str()
-    zemo = ZODIAC_SYMBOL.get(zodiac, "✨")
-    pred = load_daily_prediction(zodiac)
-    return (
-        f"🌅 <b>Доброе утро</b> · {zemo} <b>{zodiac}</b>\n"
-        f"<i>{today}</i>\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"{pred}"
-    )
+    return DAILY.morning_body(zodiac)
 
-async def send_morning_digest(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, force: bool = False):
-    async with db_connect() as db:
-        cur = await db.execute("SELECT COALESCE(consent,0), COALESCE(zodiac,'') FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-    consent = int(row[0] or 0) if row else 0
-    zodiac = (row[1] or '').strip() if row else ''
+async def send_morning_digest(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, force: bool = False, zodiac: Optional[str] = None):
+    """zodiac передаёт планировщик: подписка и знак уже проверены его выборкой."""
+    if zodiac and not force:
+        consent = 1
+    else:
+        prof = await user_profile(context, user_id)
+        consent = prof.consent
+        zodiac = (prof.zodiac or '').strip()
     if not force:
         if consent != 1 or not zodiac:
             return
@@ -581,172 +730,1230 @@ async def send_morning_digest(context: ContextTypes.DEFAULT_TYPE, user_id: int,
         if not zodiac:
             zodiac = 'Овен'
 
-    # try to attach zodiac image on top if available
+    # картинка знака с дайджестом в подписи (если есть)
     zimg = None
     try:
         zimg = _zodiac_img_path(zodiac)
     except Exception:
         zimg = None
 
-    if zimg:
+    text = await _morning_digest_text(zodiac)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]])
+    # плановая рассылка уступает интерактивным ответам; тест из админки — нет
+    await send_card(context.bot, chat_id, zimg, text, reply_markup=kb, rate_limit_args=None if force else BULK)
+
+# --- Morning scheduler (JobQueue) ---
+# Один run_once на ближайший слот из NOTIFY_SLOTS: в момент слота — одна индексированная
+# выборка (consent, notify_time), отправка с ограниченным темпом и пакетные отметки
+# last_morning_date/blocked каждые MORNING_PERSIST_CHUNK получателей. Следующий слот
+# планируется от номинального времени текущего ещё до рассылки — долгий слот его не съест.
+MORNING_CATCHUP_MIN = 30     # после рестарта догоняем слот, если он прошёл не раньше N минут назад
+MORNING_CONCURRENCY = 8
+MORNING_PERSIST_CHUNK = 200  # отметки о доставке пишем пачками по ходу рассылки
+MORNING_RATE = float(os.getenv("MORNING_RATE", "12") or 12)  # дайджестов в секунду (фото с подписью; длинный текст — 2 запроса)
+
+def _slot_datetime(day: datetime.date, slot: str) -> datetime.datetime:
+    hh, mm = slot.split(":")
+    return datetime.datetime.combine(day, datetime.time(int(hh), int(mm)), tzinfo=TZ)
+
+def _next_morning_slot(now: datetime.datetime) -> tuple[datetime.datetime, str]:
+    for offset in (0, 1):
+        day = now.date() + datetime.timedelta(days=offset)
+        for slot in NOTIFY_SLOTS:
+            at = _slot_datetime(day, slot)
+            if at > now:
+                return at, slot
+    raise RuntimeError("no notify slots configured")
+
+def schedule_next_morning(job_queue, after: Optional[datetime.datetime] = None):
+    """Планирует ближайший слот после after (по умолчанию — после текущего момента).
+    Слот, опоздавший не больше чем на MORNING_CATCHUP_MIN, запускается сразу."""
+    now = datetime.datetime.now(tz=TZ)
+    if after is not None:
+        now = max(after, now - datetime.timedelta(minutes=MORNING_CATCHUP_MIN))
+    at, slot = _next_morning_slot(now)
+    job_queue.run_once(morning_slot_job, when=at, data={"slot": slot, "at": at, "reschedule": True}, name=f"morning:{slot}")
+    logging.info("Next morning digest slot: %s", at.isoformat())
+
+def start_morning_scheduler(job_queue):
+    now = datetime.datetime.now(tz=TZ)
+    for slot in NOTIFY_SLOTS:
+        at = _slot_datetime(now.date(), slot)
+        if at <= now < at + datetime.timedelta(minutes=MORNING_CATCHUP_MIN):
+            job_queue.run_once(morning_slot_job, when=0, data={"slot": slot, "reschedule": False}, name=f"morning:{slot}:catchup")
+    schedule_next_morning(job_queue)
+
+async def deliver_morning_slot(context: ContextTypes.DEFAULT_TYPE, slot: str) -> int:
+    today = today_str()
+    rows = await DB.fetchall(
+        "SELECT user_id, chat_id, zodiac FROM users "
+        "WHERE consent=1 AND notify_time=? AND COALESCE(last_morning_date,'')<>? "
+        "AND COALESCE(blocked,0)=0 AND COALESCE(zodiac,'')<>''",
+        (slot, today)
+    )
+    if not rows:
+        return 0
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(MORNING_CONCURRENCY)
+    interval = 1.0 / max(0.1, MORNING_RATE)
+    delivered: list[tuple] = []
+    blocked: list[tuple] = []
+    total = 0
+
+    async def _persist():
+        # забираем накопленное до первого await — параллельные задачи пишут уже в новые списки
+        nonlocal delivered, blocked, total
+        done, dead = delivered, blocked
+        delivered, blocked = [], []
+        if not done and not dead:
+            return
+        total += len(done)
+
+        async def _tx(db):
+            if done:
+                await db.executemany("UPDATE users SET last_morning_date=? WHERE user_id=?", done)
+            if dead:
+                await db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", dead)
+        await asyncio.shield(DB.write(_tx))
+        for (uid,) in dead:
+            profile_changed(uid, blocked=1)
+
+    async def _one(uid: int, cid: int, zodiac: str):
+        try:
+            await send_morning_digest(context, uid, cid, zodiac=zodiac)
+            delivered.append((today, uid))
+        except Forbidden:
+            blocked.append((uid,))
+        except Exception as e:
+            logging.warning("morning send failed for %s: %s", uid, e)
+        finally:
+            sem.release()
+        if len(delivered) + len(blocked) >= MORNING_PERSIST_CHUNK:
+            await _persist()
+
+    tasks = []
+    next_at = loop.time()
+    try:
+        for uid, cid, zodiac in rows:
+            next_at = max(next_at + interval, loop.time() - 1.0)
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await sem.acquire()
+            tasks.append(asyncio.create_task(_one(uid, cid, zodiac)))
+        await asyncio.gather(*tasks)
+    finally:
+        # хвост пачки (и при аварийном выходе — чтобы не слать повторно)
+        await _persist()
+    logging.info("Morning slot %s: delivered %d of %d", slot, total, len(rows))
+    return total
+
+async def morning_slot_job(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data or {}
+    if data.get("reschedule"):
+        # до рассылки и от номинального времени слота: если рассылка затянется дольше
+        # интервала между слотами, следующий всё равно сработает вовремя
+        schedule_next_morning(context.job_queue, after=data.get("at"))
+    try:
+        await deliver_morning_slot(context, data.get("slot", DEFAULT_NOTIFY_TIME))
+    except Exception as e:
+        logging.warning("morning slot %s failed: %s", data.get("slot"), e)
+
+# ----------------- МЕТРИКИ -----------------
+# Счётчики и гистограммы живут в памяти процесса; GET /metrics отдаёт их в текстовом формате
+# Prometheus. METRICS_PORT=0 — эндпоинт выключен (сами замеры дешёвые и идут всегда).
+# Воркер шарда N слушает METRICS_PORT + N.
+
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_REGISTRY: list = []
+
+def _label_escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _metric_labels(names, values, le=None) -> str:
+    parts = [f'{n}="{_label_escape(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _metric_num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, name: str, help_: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help_, labelnames
+        self._values: dict[tuple, int] = {}
+        METRICS_REGISTRY.append(self)
+
+    def inc(self, *labels, n: int = 1):
+        self._values[labels] = self._values.get(labels, 0) + n
+
+    def value(self, *labels) -> int:
+        return self._values.get(labels, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, v in sorted(self._values.items()):
+            yield f"{self.name}{_metric_labels(self.labelnames, labels)} {v}"
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help_, labelnames, buckets
+        self._series: dict[tuple, list] = {}   # labels -> [по корзинам..., sum, count]
+        METRICS_REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        s = self._series.get(labels)
+        if s is None:
+            s = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect_left(self.buckets, value)   # первая корзина с le >= value
+        if i < len(self.buckets):
+            s[i] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def count(self, *labels) -> int:
+        s = self._series.get(labels)
+        return s[-1] if s else 0
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, s in sorted(self._series.items()):
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                yield f"{self.name}_bucket{_metric_labels(self.labelnames, labels, le)} {acc}"
+            yield f"{self.name}_bucket{_metric_labels(self.labelnames, labels, '+Inf')} {s[-1]}"
+            yield f"{self.name}_sum{_metric_labels(self.labelnames, labels)} {_metric_num(s[-2])}"
+            yield f"{self.name}_count{_metric_labels(self.labelnames, labels)} {s[-1]}"
+
+class Gauge:
+    """Значение снимается при опросе: fn() -> число (задаётся сразу или позже через set_function)."""
+
+    def __init__(self, name: str, help_: str, fn=None):
+        self.name, self.help, self.fn = name, help_, fn
+        METRICS_REGISTRY.append(self)
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def render(self):
+        if self.fn is None:
+            return
+        try:
+            v = self.fn()
+        except Exception:
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {_metric_num(v)}"
+
+def render_metrics() -> str:
+    return "\n".join(line for m in METRICS_REGISTRY for line in m.render()) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("kind", "route"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ("kind", "route"))
+CALLBACKS_UNMATCHED = Counter("bot_callbacks_unmatched_total", "Callback data без маршрута")
+DB_SECONDS = Histogram("bot_db_query_seconds", "Длительность запросов к SQLite (запись — вместе с ожиданием в очереди)", ("op",))
+DB_ERRORS = Counter("bot_db_errors_total", "Ошибки запросов к SQLite", ("op",))
+API_SECONDS = Histogram("bot_api_seconds", "Длительность вызовов Telegram Bot API", ("method",))
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки Telegram Bot API по классам", ("method", "error"))
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue", "Апдейты в очереди Application")
+DB_WRITE_QUEUE_DEPTH = Gauge("bot_db_write_queue", "Записи в очереди писателя БД", lambda: DB._queue.qsize())
+WB_DEPTH = Gauge("bot_write_behind_queue", "Строки в очереди write-behind", lambda: WRITE_BEHIND.depth)
+WB_ROWS = Counter("bot_write_behind_rows_total", "Строки, записанные через write-behind")
+WB_ERRORS = Counter("bot_write_behind_errors_total", "Неудачные сбросы write-behind")
+WB_DROPPED = Counter("bot_write_behind_dropped_total", "Строки, отброшенные write-behind (ошибка данных или исчерпаны повторы)")
+ANIMATIONS_ACTIVE = Gauge("bot_progress_animations", "Анимации прогресса в процессе", lambda: ANIMATIONS.active)
+RATE_DELAYED = Counter("bot_rate_limit_delayed_total", "Запросы, задержанные лимитером отправки", ("priority",))
+RATE_WAIT_SECONDS = Histogram("bot_rate_limit_wait_seconds", "Ожидание жетона лимитера отправки", ("priority",))
+RATE_RETRY_AFTER = Counter("bot_rate_limit_retry_after_total", "Ответы 429, повторённые лимитером", ("method",))
+RATE_WAITING = Gauge("bot_rate_limit_waiting", "Запросы, ждущие жетона лимитера", lambda: RATE_LIMITER.waiting)
+
+def timed_handler(handler, kind: str, route):
+    """Оборачивает хендлер PTB замером времени; route — строка или fn(update, context) -> str
+    (считается до вызова: хендлер может сбросить флаги, по которым выбиралась ветка)."""
+    @functools.wraps(handler)
+    async def _wrapped(update, context):
+        label = route(update, context) if callable(route) else route
+        t0 = time.perf_counter()
         try:
-            with open(zimg, "rb") as f:
-                await context.bot.send_photo(chat_id=chat_id, photo=f)
+            return await handler(update, context)
         except Exception:
+            HANDLER_ERRORS.inc(kind, label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, kind, label)
+    return _wrapped
+
+def api_error_class(e: Exception) -> str:
+    if isinstance(e, RetryAfter):
+        return "retry_after"
+    if isinstance(e, Forbidden):
+        return "forbidden"
+    if isinstance(e, BadRequest):
+        return "not_modified" if "not modified" in str(e).lower() else "bad_request"
+    if isinstance(e, TimedOut):
+        return "timeout"
+    if isinstance(e, NetworkError):
+        return "network"
+    return "other"
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером каждого вызова Bot API по имени метода (последний сегмент URL)."""
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(method, api_error_class(e))
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - t0, method)
+
+class MetricsServer:
+    """GET /metrics; одно соединение — один запрос (скрейпер Prometheus большего не просит)."""
+
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.listen, self.port = listen, port
+        self._server = None
+        self._conns: dict = {}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logging.info("Metrics on http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await _close_connections(self._conns)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns[writer] = asyncio.current_task()
+        try:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            method, target, _ = line.decode("latin-1").split()
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            if target.split("?", 1)[0] != "/metrics":
+                status, body = "404 Not Found", b""
+            elif method not in ("GET", "HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            else:
+                status, body = "200 OK", render_metrics().encode()
+            writer.write((f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                          f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("latin-1"))
+            if method != "HEAD":
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
             pass
+        finally:
+            self._conns.pop(writer, None)
+            writer.close()
+
+METRICS_SERVER: Optional[MetricsServer] = None
 
-    text = await _morning_digest_text(zodiac)
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]])
-    await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_markup=kb)
 # ----------------- DB -----------------
+# Соединения открываются один раз при старте: один писатель (все записи идут через очередь
+# в фоновую задачу и коммитятся пачками) и небольшой пул read-only соединений в режиме WAL.
+
+DB_READERS = int(os.getenv("DB_READERS", "4") or 4)
+DB_WRITE_BATCH = 64  # сколько записей из очереди объединять в одну транзакцию
+DB_PRAGMAS = (
+    "busy_timeout=5000",
+    "temp_store=MEMORY",
+    "cache_size=-16000",       # ~16 МБ страничного кеша на соединение
+    "mmap_size=134217728",     # 128 МБ memory-mapped I/O
+)
+
+class Database:
+    """Долгоживущие соединения SQLite: один писатель через очередь + пул читателей."""
+
+    def __init__(self, path: Path, readers: int = DB_READERS):
+        self.path = path
+        self.readers_n = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._readers: Optional[asyncio.Queue] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # isolation_level=None — транзакциями управляем сами (BEGIN/COMMIT в _run_batch)
+            self._writer = await aiosqlite.connect(self.path.as_posix(), isolation_level=None)
+            await self._writer.execute("PRAGMA journal_mode=WAL")
+            await self._writer.execute("PRAGMA synchronous=NORMAL")
+            await self._apply_pragmas(self._writer)
+            self._readers = asyncio.Queue()
+            uri = self.path.resolve().as_uri() + "?mode=ro"
+            for _ in range(self.readers_n):
+                conn = await aiosqlite.connect(uri, uri=True, isolation_level=None)
+                await self._apply_pragmas(conn)
+                self._reader_conns.append(conn)
+                self._readers.put_nowait(conn)
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._writer_loop(), name="db-writer")
+
+    @staticmethod
+    async def _apply_pragmas(conn):
+        for pragma in DB_PRAGMAS:
+            await conn.execute(f"PRAGMA {pragma}")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        # дожидаемся, пока писатель обработает всё, что уже стоит в очереди
+        await self._queue.put(None)
+        try:
+            await self._task
+        except Exception as e:
+            logging.warning("DB writer stopped with error: %s", e)
+        for conn in self._reader_conns:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        try:
+            await self._writer.close()
+        except Exception:
+            pass
+        self._writer = None
+        self._reader_conns = []
+        self._readers = self._queue = self._task = None
+
+    # --- чтение ---
+    async def read(self, fn, op: str = "read"):
+        """Выполняет fn(conn) на свободном read-only соединении из пула."""
+        if self._writer is None:
+            await self.open()
+        t0 = time.perf_counter()
+        conn = await self._readers.get()
+        try:
+            return await fn(conn)
+        except Exception:
+            DB_ERRORS.inc(op)
+            raise
+        finally:
+            self._readers.put_nowait(conn)
+            DB_SECONDS.observe(time.perf_counter() - t0, op)
+
+    async def fetchone(self, sql: str, params=()):
+        async def _q(conn):
+            cur = await conn.execute(sql, params)
+            return await cur.fetchone()
+        return await self.read(_q, "fetchone")
+
+    async def fetchall(self, sql: str, params=()):
+        async def _q(conn):
+            cur = await conn.execute(sql, params)
+            return await cur.fetchall()
+        return await self.read(_q, "fetchall")
+
+    # --- запись ---
+    async def write(self, fn, op: str = "write"):
+        """Ставит fn(conn) в очередь писателя; результат возвращается после COMMIT."""
+        if self._writer is None:
+            await self.open()
+        t0 = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, fut))
+        try:
+            return await fut
+        except Exception:
+            DB_ERRORS.inc(op)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - t0, op)
+
+    async def execute(self, sql: str, params=()) -> int:
+        """Одиночная запись; возвращает rowcount."""
+        async def _w(conn):
+            cur = await conn.execute(sql, params)
+            return cur.rowcount
+        return await self.write(_w, "execute")
+
+    async def executemany(self, sql: str, seq) -> None:
+        seq = list(seq)
+        async def _w(conn):
+            await conn.executemany(sql, seq)
+        await self.write(_w, "executemany")
+
+    async def _writer_loop(self):
+        stop = False
+        while not stop:
+            job = await self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < DB_WRITE_BATCH and not self._queue.empty():
+                nxt = self._queue.get_nowait()
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            try:
+                await self._run_batch(batch)
+            except Exception as e:
+                # писатель не должен умирать: иначе все следующие DB.write ждут вечно
+                logging.exception("DB write batch failed: %s", e)
+                try:
+                    await self._writer.execute("ROLLBACK")
+                except Exception:
+                    pass
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    async def _run_batch(self, batch: list):
+        # Каждая запись — в своём SAVEPOINT: ошибка одной не откатывает соседей по пачке.
+        db = self._writer
+        done = []
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fn, fut in batch:
+            if fut.done():  # вызывающий уже отменил ожидание
+                continue
+            try:
+                await db.execute("SAVEPOINT w")
+                res = await fn(db)
+                await db.execute("RELEASE w")
+                done.append((fut, res))
+            except Exception as e:
+                try:
+                    await db.execute("ROLLBACK TO w")
+                    await db.execute("RELEASE w")
+                except Exception:
+                    pass
+                if not fut.done():   # вызывающий мог отменить ожидание, пока fn выполнялась
+                    fut.set_exception(e)
+        try:
+            await db.execute("COMMIT")
+        except Exception as e:
+            logging.warning("DB commit failed: %s", e)
+            try:
+                await db.execute("ROLLBACK")
+            except Exception:
+                pass
+            for fut, _ in done:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, res in done:
+            if not fut.done():
+                fut.set_result(res)
+
+DB = Database(DB_PATH)
+
+# --- Write-behind для append-only событий ---
+# Журнал раскладов (и подобные события) не должен ждать COMMIT на пути ответа: строки копятся
+# в памяти и уходят executemany одной транзакцией раз в WB_FLUSH_MS или при WB_MAX_ROWS строк.
+# При остановке бота очередь сбрасывается до закрытия БД.
+# Строка с ошибкой данных (constraint, неверные параметры) не держит очередь: пачка по этому
+# SQL повторяется построчно, плохие строки логируются и отбрасываются. Прочие ошибки (БД
+# занята, диск) — повтор с экспоненциальной паузой; после WB_MAX_RETRIES неудач подряд
+# пачка отбрасывается, чтобы очередь не росла без предела.
+
+WB_FLUSH_MS = int(os.getenv("WB_FLUSH_MS", "250") or 250)
+WB_MAX_ROWS = int(os.getenv("WB_MAX_ROWS", "500") or 500)
+WB_MAX_RETRIES = int(os.getenv("WB_MAX_RETRIES", "8") or 8)
+WB_BACKOFF_MAX_SEC = 30.0
+_WB_ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+
+class WriteBehind:
+    def __init__(self, db: Database, flush_ms: int = WB_FLUSH_MS, max_rows: int = WB_MAX_ROWS):
+        self.db, self.flush_ms, self.max_rows = db, flush_ms, max_rows
+        self._rows: dict[str, list] = {}   # sql -> [params]; порядок SQL = порядок первого add
+        self._depth = 0
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._failures = 0        # неудачных сбросов подряд
+        self._retry_at = 0.0      # monotonic: до этого момента цикл не сбрасывает (backoff)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def add(self, sql: str, params: tuple):
+        self._rows.setdefault(sql, []).append(params)
+        self._depth += 1
+        if self._depth >= self.max_rows:
+            self._full.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._loop(), name="write-behind")
+
+    async def stop(self):
+        # цикл не отменяем: он дописывает текущий сброс и выходит сам, затем — финальный сброс
+        if self._task is not None:
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if self._stopping:
+                break
+            if time.monotonic() < self._retry_at:
+                continue
+            await self.flush()
+
+    def _requeue(self, batch: dict, n: int):
+        # строки возвращаются в начало очереди: следующий тик попробует снова
+        for sql, rows in self._rows.items():
+            batch.setdefault(sql, []).extend(rows)
+        self._rows, self._depth = batch, self._depth + n
+
+    def _on_write_done(self, batch: dict, n: int, write: asyncio.Future):
+        if write.cancelled():
+            logging.warning("Write-behind flush of %d rows cancelled, requeued", n)
+            self._requeue(batch, n)
+            return
+        if write.exception() is not None:
+            WB_ERRORS.inc()
+            self._failures += 1
+            if self._failures >= WB_MAX_RETRIES:
+                logging.error("Write-behind: %d rows dropped after %d failed flushes: %s", n, self._failures, write.exception())
+                WB_DROPPED.inc(n=n)
+                self._failures, self._retry_at = 0, 0.0
+                return
+            delay = min(WB_BACKOFF_MAX_SEC, self.flush_ms / 1000 * 2 ** self._failures)
+            logging.warning("Write-behind flush of %d rows failed (%s), retry in %.1fs", n, write.exception(), delay)
+            self._retry_at = time.monotonic() + delay
+            self._requeue(batch, n)
+            return
+        dropped = write.result()
+        self._failures, self._retry_at = 0, 0.0
+        WB_ROWS.inc(n=n - dropped)
+        if dropped:
+            WB_DROPPED.inc(n=dropped)
+
+    @staticmethod
+    async def _write_rows(conn, sql: str, rows: list) -> int:
+        """Построчная запись после ошибки данных в executemany; возвращает число отброшенных строк."""
+        dropped = 0
+        for params in rows:
+            await conn.execute("SAVEPOINT wb_row")
+            try:
+                await conn.execute(sql, params)
+            except _WB_ROW_ERRORS as e:
+                await conn.execute("ROLLBACK TO wb_row")
+                logging.error("Write-behind: row dropped (%s): %s %r", e, sql.split("(", 1)[0], params)
+                dropped += 1
+            await conn.execute("RELEASE wb_row")
+        return dropped
+
+    async def flush(self) -> int:
+        if not self._depth:
+            return 0
+        batch, n = self._rows, self._depth
+        self._rows, self._depth = {}, 0
+        async def _tx(conn) -> int:
+            dropped = 0
+            for sql, rows in batch.items():
+                await conn.execute("SAVEPOINT wb")
+                try:
+                    await conn.executemany(sql, rows)
+                except _WB_ROW_ERRORS:
+                    await conn.execute("ROLLBACK TO wb")
+                    dropped += await self._write_rows(conn, sql, rows)
+                await conn.execute("RELEASE wb")
+            return dropped
+        # запись не отменяется вместе с вызывающим: иначе писатель пропустит задание с
+        # отменённым future, а строки уже вынуты из очереди. Итог (успех или возврат строк)
+        # фиксирует колбэк, даже если нас отменили раньше.
+        write = asyncio.ensure_future(self.db.write(_tx, "write_behind"))
+        write.add_done_callback(functools.partial(self._on_write_done, batch, n))
+        try:
+            dropped = await asyncio.shield(write)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return 0
+        return n - dropped
+
+WRITE_BEHIND = WriteBehind(DB)
+
+# --- Schema migrations ---
+# Версия схемы хранится в schema_version; миграции применяются по порядку, каждая в своей
+# транзакции вместе с записью о версии. Все шаги идемпотентны (IF NOT EXISTS, проверка колонок),
+# поэтому базы, созданные старым init_db, проходят их без ошибок.
+
+async def _add_column(db, table: str, column: str, decl: str):
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [r[1] for r in await cur.fetchall()]:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+async def _mig_base_tables(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        zodiac TEXT,
+        consent INTEGER DEFAULT 0,
+        age INTEGER,
+        gender TEXT
+    )""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS tarot_users(
+        user_id INTEGER PRIMARY KEY,
+        cards_balance INTEGER DEFAULT 0,
+        tarolog TEXT,
+        free_last_date TEXT,
+        free_used INTEGER DEFAULT 0
+    )""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS tarot_referrals(
+        referrer_id INTEGER NOT NULL,
+        referred_id INTEGER NOT NULL UNIQUE,
+        ts INTEGER NOT NULL
+    )""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS tarot_draws(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        card_code TEXT,
+        tarolog TEXT,
+        is_free INTEGER NOT NULL DEFAULT 0
+    )""")
+
+async def _mig_user_columns(db):
+    await _add_column(db, "users", "notify_time", "TEXT")
+    await _add_column(db, "users", "blocked", "INTEGER DEFAULT 0")
+    await _add_column(db, "users", "last_morning_date", "TEXT")
+    # Планировщик выбирает подписчиков по точному слоту — пустое/невалидное время приводим к дефолту
+    slots = ",".join("?" * len(NOTIFY_SLOTS))
+    await db.execute(
+        f"UPDATE users SET notify_time=? WHERE consent=1 AND COALESCE(notify_time,'') NOT IN ({slots})",
+        (DEFAULT_NOTIFY_TIME, *NOTIFY_SLOTS)
+    )
+
+async def _mig_media_broadcast(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS media_cache(
+        path TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        ts INTEGER NOT NULL
+    )""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_chat_id INTEGER NOT NULL,
+        progress_mid INTEGER,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_ts INTEGER NOT NULL,
+        finished_ts INTEGER
+    )""")
+    await db.execute("""CREATE TABLE IF NOT EXISTS broadcast_targets(
+        job_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(job_id, chat_id)
+    ) WITHOUT ROWID""")
+
+async def _mig_daily_renders(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS daily_renders(
+        date TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        body TEXT NOT NULL,
+        PRIMARY KEY(date, kind, key)
+    ) WITHOUT ROWID""")
+
+async def _mig_recent_masks(db):
+    if await _add_column(db, "tarot_users", "recent_masks", "TEXT"):
+        await _backfill_recent_masks(db)
+
+async def _mig_hot_indexes(db):
+    # (consent, notify_time) обслуживает и фильтр только по consent — отдельный индекс не нужен
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_consent_notify ON users(consent, notify_time)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_draws_user_ts ON tarot_draws(user_id, ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON tarot_referrals(referrer_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_chat ON users(chat_id)")
+
+async def _mig_tarot_ledger(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS tarot_ledger(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        delta INTEGER NOT NULL,
+        balance INTEGER NOT NULL,
+        ref TEXT
+    )""")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user ON tarot_ledger(user_id, id)")
+    # входящие остатки: после миграции SUM(delta) по пользователю сразу равна cards_balance
+    ts = int(datetime.datetime.now(tz=TZ).timestamp())
+    await db.execute(
+        "INSERT INTO tarot_ledger(user_id, ts, kind, delta, balance) "
+        "SELECT user_id, ?, 'opening', cards_balance, cards_balance FROM tarot_users WHERE COALESCE(cards_balance,0) <> 0",
+        (ts,))
+
+async def _mig_ui_state(db):
+    # user_data/chat_data PTB: scope 'u' — пользователь, 'c' — чат; data — компактный JSON ('' — пусто)
+    await db.execute("""CREATE TABLE IF NOT EXISTS ui_state(
+        scope TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        PRIMARY KEY(scope, id)
+    ) WITHOUT ROWID""")
+
+# --- Счётчики админ-статистики ---
+# Админские срезы (знаки, пол, возраст, подписки, карты) читаются из stats_counters, а не
+# агрегатами по users/tarot_users/tarot_draws. Счётчики ведут триггеры, поэтому их не обходит
+# ни один путь записи (апсерты профиля, write-behind раскладов, миграции). Ключ — "срез:значение".
+# Триггеры и пересчёт (stats_rebuild) строятся из одного описания _STATS_SPEC.
+
+STATS_AGE_BUCKETS = [(17, "<18"), (24, "18–24"), (34, "25–34"), (44, "35–44"), (54, "45–54"), (200, "55+")]
+
+def _stats_age_key(r: str) -> str:
+    a = f"CAST({r}.age AS INTEGER)"
+    whens = " ".join(f"WHEN {a} <= {hi} THEN '{label}'" for hi, label in STATS_AGE_BUCKETS)
+    return f"'age:' || CASE WHEN {a} IS NULL OR {a} <= 0 THEN '' {whens} ELSE '' END"
+
+# таблица -> (колонки, от которых зависят ключи; r -> [(SQL ключа, SQL вклада строки)])
+_STATS_SPEC = {
+    "users": (("zodiac", "gender", "age", "consent"), lambda r: [
+        ("'users'", "1"),
+        (f"'zodiac:' || COALESCE({r}.zodiac, '')", "1"),
+        (f"'gender:' || COALESCE({r}.gender, '')", "1"),
+        (_stats_age_key(r), "1"),
+        (f"'subs:' || CASE WHEN COALESCE({r}.consent, 0) = 1 THEN 'on' ELSE 'off' END", "1"),
+    ]),
+    "tarot_users": (("cards_balance",), lambda r: [
+        ("'tarot_users'", "1"),
+        ("'cards_balance'", f"COALESCE({r}.cards_balance, 0)"),
+    ]),
+    "tarot_draws": (("is_free",), lambda r: [
+        ("'draws'", "1"),
+        ("'draws_free'", f"({r}.is_free = 1)"),
+    ]),
+}
 
-def db_connect():
-    # Return coroutine from aiosqlite.connect; `async with db_connect() as db` will await it once.
-    return aiosqlite.connect(DB_PATH.as_posix())
+def _stats_upsert(pairs) -> str:
+    values = ", ".join(f"({k}, {v})" for k, v in pairs)
+    return f"INSERT INTO stats_counters(name, n) VALUES {values} ON CONFLICT(name) DO UPDATE SET n = n + excluded.n;"
+
+def _stats_triggers_sql() -> list[str]:
+    out = []
+    for table, (cols, keys) in _STATS_SPEC.items():
+        new = keys("NEW")
+        old = [(k, f"-({v})") for k, v in keys("OLD")]
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in cols)
+        out += [
+            f"CREATE TRIGGER IF NOT EXISTS stats_{table}_ins AFTER INSERT ON {table} BEGIN {_stats_upsert(new)} END",
+            f"CREATE TRIGGER IF NOT EXISTS stats_{table}_del AFTER DELETE ON {table} BEGIN {_stats_upsert(old)} END",
+            f"CREATE TRIGGER IF NOT EXISTS stats_{table}_upd AFTER UPDATE OF {', '.join(cols)} ON {table} "
+            f"WHEN {changed} BEGIN {_stats_upsert(old + new)} END",
+        ]
+    return out
+
+async def _stats_recount(db) -> dict[str, tuple[int, int]]:
+    """Пересчитывает stats_counters с нуля; возвращает расхождения {ключ: (было, стало)}."""
+    cur = await db.execute("SELECT name, n FROM stats_counters WHERE n <> 0")
+    before = dict(await cur.fetchall())
+    await db.execute("DELETE FROM stats_counters")
+    for table, (_cols, keys) in _STATS_SPEC.items():
+        for k, v in keys("r"):
+            await db.execute(f"INSERT INTO stats_counters(name, n) SELECT {k}, SUM({v}) FROM {table} AS r GROUP BY 1")
+    cur = await db.execute("SELECT name, n FROM stats_counters WHERE n <> 0")
+    after = dict(await cur.fetchall())
+    return {k: (before.get(k, 0), after.get(k, 0)) for k in before.keys() | after.keys()
+            if before.get(k, 0) != after.get(k, 0)}
+
+async def _mig_stats_counters(db):
+    await db.execute("""CREATE TABLE IF NOT EXISTS stats_counters(
+        name TEXT PRIMARY KEY,
+        n INTEGER NOT NULL
+    ) WITHOUT ROWID""")
+    for sql in _stats_triggers_sql():
+        await db.execute(sql)
+    await _stats_recount(db)
+
+async def stats_rebuild() -> dict[str, tuple[int, int]]:
+    """Сверка счётчиков с таблицами и пересчёт в одной транзакции (записи ждут её в очереди писателя)."""
+    return await DB.write(_stats_recount, "stats_rebuild")
+
+async def stats_counters() -> dict[str, int]:
+    # ключей — десятки, не зависит от числа пользователей
+    return dict(await DB.fetchall("SELECT name, n FROM stats_counters"))
+
+MIGRATIONS = [
+    (1, "base tables", _mig_base_tables),
+    (2, "users: notify_time, blocked, last_morning_date", _mig_user_columns),
+    (3, "media cache and broadcast jobs", _mig_media_broadcast),
+    (4, "daily renders", _mig_daily_renders),
+    (5, "tarot no-repeat masks", _mig_recent_masks),
+    (6, "hot query indexes", _mig_hot_indexes),
+    (7, "tarot ledger", _mig_tarot_ledger),
+    (8, "ui state", _mig_ui_state),
+    (9, "stats counters", _mig_stats_counters),
+]
 
 async def init_db():
-    async with db_connect() as db:
-        await db.execute("""CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            chat_id INTEGER NOT NULL,
-            zodiac TEXT,
-            consent INTEGER DEFAULT 0,
-            age INTEGER,
-            gender TEXT
-        )""")
-        # Ensure notify_time column exists
+    await DB.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_ts INTEGER NOT NULL
+    )""")
+    applied = {r[0] for r in await DB.fetchall("SELECT version FROM schema_version")}
+    for version, name, fn in MIGRATIONS:
+        if version in applied:
+            continue
+        async def _tx(db, version=version, name=name, fn=fn):
+            await fn(db)
+            await db.execute("INSERT INTO schema_version(version, name, applied_ts) VALUES(?,?,?)",
+                             (version, name, int(datetime.datetime.now(tz=TZ).timestamp())))
+        await DB.write(_tx)
+        logging.info("DB migration %d applied: %s", version, name)
+
+# Запросы горячего пути: при старте проверяем, что SQLite не уходит в полный скан таблицы
+HOT_QUERIES = [
+    ("morning slot", "SELECT user_id, chat_id, zodiac FROM users WHERE consent=1 AND notify_time=? AND COALESCE(last_morning_date,'')<>? AND COALESCE(blocked,0)=0", ("09:00", "")),
+    ("broadcast targets", "SELECT chat_id FROM users WHERE consent=1 AND COALESCE(blocked,0)=0", ()),
+    ("draw history", "SELECT card_code FROM tarot_draws WHERE user_id=? AND ts>=?", (0, 0)),
+    ("referrals by referrer", "SELECT COUNT(1) FROM tarot_referrals WHERE referrer_id=?", (0,)),
+    ("tarot user", "SELECT COALESCE(cards_balance,0) FROM tarot_users WHERE user_id=?", (0,)),
+    ("pending broadcast", "SELECT chat_id FROM broadcast_targets WHERE job_id=? AND status=0 LIMIT 1", (0,)),
+]
+
+async def check_query_plans() -> list[str]:
+    """EXPLAIN QUERY PLAN по HOT_QUERIES; предупреждает о полном скане таблицы."""
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        # через писателя: читатели открыты до миграций и держат старую схему, а программа
+        # EXPLAIN не сверяет schema cookie — после апгрейда план строился бы без новых индексов
+        async def _plan(conn, sql=sql, params=params):
+            cur = await conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return await cur.fetchall()
         try:
-            cur = await db.execute("PRAGMA table_info(users)")
-            cols = [r[1] for r in await cur.fetchall()]
-            if "notify_time" not in cols:
-                await db.execute("ALTER TABLE users ADD COLUMN notify_time TEXT")
+            rows = await DB.write(_plan, "query_plan")
         except Exception as e:
-            logging.warning("Could not ensure notify_time column: %s", e)
-        await db.execute("""CREATE TABLE IF NOT EXISTS tarot_users(
-            user_id INTEGER PRIMARY KEY,
-            cards_balance INTEGER DEFAULT 0,
-            tarolog TEXT,
-            free_last_date TEXT,
-            free_used INTEGER DEFAULT 0
-        )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS tarot_referrals(
-            referrer_id INTEGER NOT NULL,
-            referred_id INTEGER NOT NULL UNIQUE,
-            ts INTEGER NOT NULL
-        )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS tarot_draws(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ts INTEGER NOT NULL,
-            date TEXT NOT NULL,
-            card_code TEXT,
-            tarolog TEXT,
-            is_free INTEGER NOT NULL DEFAULT 0
-        )""")
-        await db.commit()
+            logging.warning("Query plan check failed for %s: %s", name, e)
+            continue
+        for row in rows:
+            detail = str(row[-1])
+            if re.match(r"^SCAN \w+$", detail):
+                problems.append(f"{name}: {detail}")
+                logging.warning("Hot query '%s' falls back to a full scan: %s", name, detail)
+    return problems
+
+async def _backfill_recent_masks(db):
+    """Однократно переносит окно «без повторов» из tarot_draws в recent_masks."""
+    exists = await (await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tarot_draws'")).fetchone()
+    if not exists:
+        return
+    since = int((datetime.datetime.now(tz=TZ) - datetime.timedelta(days=TAROT_NO_REPEAT_DAYS)).timestamp())
+    per_user: dict[int, dict[int, int]] = {}
+    cur = await db.execute("SELECT user_id, ts, card_code FROM tarot_draws WHERE ts>=?", (since,))
+    for uid, ts, codes in await cur.fetchall():
+        day = datetime.datetime.fromtimestamp(ts, tz=TZ).date().toordinal()
+        masks = per_user.setdefault(uid, {})
+        masks[day] = masks.get(day, 0) | cards_to_mask(str(codes or "").split(","))
+    for uid, masks in per_user.items():
+        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id) VALUES(?)", (uid,))
+        await db.execute("UPDATE tarot_users SET recent_masks=? WHERE user_id=?", (_format_masks(masks), uid))
+    if per_user:
+        logging.info("Backfilled tarot no-repeat masks for %d users", len(per_user))
+
+# ----------------- ПРОФИЛИ (кэш) -----------------
+# Компактная запись users + tarot_users на пользователя. Загружается одним запросом
+# в pre-handler (group -1) и кладётся в context.profile; все UPDATE-хелперы ниже
+# пишут сквозь кэш, поэтому обычное нажатие кнопки не читает БД вовсе.
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000") or 50000)
+
+class UserProfile:
+    __slots__ = ("user_id", "exists", "consent", "zodiac", "age", "gender", "notify_time", "blocked",
+                 "tarot_exists", "cards_balance", "tarolog", "free_last_date", "free_used")
+
+    def __init__(self, user_id: int, row=None):
+        self.user_id = user_id
+        row = row or (None,) * 12
+        self.exists = row[0] is not None
+        self.consent = int(row[1] or 0)
+        self.zodiac = row[2] or None
+        self.age = row[3]
+        self.gender = row[4]
+        self.notify_time = row[5] or ''
+        self.blocked = int(row[6] or 0)
+        self.tarot_exists = row[7] is not None
+        self.cards_balance = int(row[8] or 0)
+        self.tarolog = _norm_tarolog(row[9]) or ''
+        self.free_last_date = row[10] or ''
+        self.free_used = int(row[11] or 0)
+
+_PROFILE_SQL = """
+    SELECT u.user_id, u.consent, u.zodiac, u.age, u.gender, u.notify_time, u.blocked,
+           t.user_id, t.cards_balance, t.tarolog, t.free_last_date, t.free_used
+    FROM (SELECT ? AS uid) k
+    LEFT JOIN users u ON u.user_id = k.uid
+    LEFT JOIN tarot_users t ON t.user_id = k.uid
+"""
+
+class ProfileCache:
+    """LRU профилей. Запись меняется только после COMMIT (write-through из хелперов)."""
+
+    def __init__(self, size: int = PROFILE_CACHE_SIZE):
+        self._size = max(1, size)
+        self._items: "OrderedDict[int, UserProfile]" = OrderedDict()
+        self._loading: dict[int, list] = {}   # uid -> [записей за время загрузки, загрузчиков]
+
+    async def get(self, user_id: int) -> UserProfile:
+        prof = self._items.get(user_id)
+        if prof is not None:
+            self._items.move_to_end(user_id)
+            return prof
+        ent = self._loading.setdefault(user_id, [0, 0])
+        ent[1] += 1
+        writes = ent[0]
+        try:
+            row = await DB.fetchone(_PROFILE_SQL, (user_id,))
+            prof = UserProfile(user_id, row)
+            # за время чтения могла пройти запись — такой снимок не кладём в кэш
+            if ent[0] == writes and user_id not in self._items:
+                self._items[user_id] = prof
+                if len(self._items) > self._size:
+                    self._items.popitem(last=False)
+            return self._items.get(user_id, prof)
+        finally:
+            ent[1] -= 1
+            if not ent[1]:
+                self._loading.pop(user_id, None)
+
+    def update(self, user_id: int, **fields):
+        ent = self._loading.get(user_id)
+        if ent:
+            ent[0] += 1
+        prof = self._items.get(user_id)
+        if prof is not None:
+            for k, v in fields.items():
+                setattr(prof, k, v)
+
+    def invalidate(self, user_id: int):
+        ent = self._loading.get(user_id)
+        if ent:
+            ent[0] += 1
+        self._items.pop(user_id, None)
+
+PROFILES = ProfileCache()
+
+def profile_changed(user_id: int, **fields):
+    """Запись чужого профиля (админ, рефералка, рассылки): при шардировании кэш пользователя
+    живёт в другом воркере — туда уходит инвалидация, локально правим только свои."""
+    if shard_of(user_id) == (SHARD_INDEX or 0):
+        PROFILES.update(user_id, **fields)
+    else:
+        send_shard_control(shard_of(user_id), {"control": "invalidate", "user_id": user_id})
+
+async def profile_prehandler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    context.profile = await PROFILES.get(user.id) if user else None
+
+async def user_profile(context, user_id: int) -> UserProfile:
+    prof = getattr(context, "profile", None)
+    if prof is not None and prof.user_id == user_id:
+        return prof
+    return await PROFILES.get(user_id)
+
+async def set_user_fields(user_id: int, prof: Optional[UserProfile] = None, **fields):
+    """prof — профиль, который держит хендлер: его правим тоже. Кэш мог его уже не содержать
+    (вытеснен LRU или снимок с гонкой при загрузке), и экран подтверждения показал бы старое."""
+    cols = ", ".join(f"{k}=?" for k in fields)
+    await DB.execute(f"UPDATE users SET {cols} WHERE user_id=?", (*fields.values(), user_id))
+    PROFILES.update(user_id, **fields)
+    if prof is not None and prof.user_id == user_id:
+        for k, v in fields.items():
+            setattr(prof, k, v)
 
 async def ensure_user_row(user_id: int, chat_id: int):
-    async with db_connect() as db:
-        await db.execute("INSERT OR IGNORE INTO users(user_id, chat_id) VALUES(?,?)", (user_id, chat_id))
-        await db.commit()
+    prof = await PROFILES.get(user_id)
+    if prof.exists:
+        return
+    await DB.execute("INSERT OR IGNORE INTO users(user_id, chat_id) VALUES(?,?)", (user_id, chat_id))
+    PROFILES.update(user_id, exists=True)
 
 async def tarot_get_user(user_id: int):
-    async with db_connect() as db:
-        cur = await db.execute("SELECT COALESCE(cards_balance,0), COALESCE(tarolog,''), COALESCE(free_last_date,''), COALESCE(free_used,0) FROM tarot_users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        if row:
-            bal, tar, last, used = row
-            return bal, (_norm_tarolog(tar) or ''), last, used
-        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id) VALUES(?)", (user_id,))
-        await db.commit()
-        return 0, '', '', 0
+    prof = await PROFILES.get(user_id)
+    if not prof.tarot_exists:
+        await DB.execute("INSERT OR IGNORE INTO tarot_users(user_id) VALUES(?)", (user_id,))
+        PROFILES.update(user_id, tarot_exists=True)
+    return prof.cards_balance, prof.tarolog, prof.free_last_date, prof.free_used
 
 async def tarot_set_tarolog(user_id: int, code: str):
-    async with db_connect() as db:
+    async def _tx(db):
         await db.execute("INSERT OR IGNORE INTO tarot_users(user_id) VALUES(?)", (user_id,))
         await db.execute("UPDATE tarot_users SET tarolog=? WHERE user_id=?", (_norm_tarolog(code), user_id))
-        await db.commit()
+    await DB.write(_tx)
+    PROFILES.update(user_id, tarot_exists=True, tarolog=_norm_tarolog(code) or '')
+
+# --- Журнал карт (tarot_ledger) ---
+# Каждое движение — строка журнала: opening (остаток при миграции), grant (админ), purchase,
+# referral, paid (списание), free (бесплатная попытка, delta=0). Баланс меняется одним
+# условным UPSERT/UPDATE … RETURNING в той же транзакции, что и запись в журнал, поэтому
+# SUM(delta) по пользователю всегда равна cards_balance (проверка — tarot_reconcile).
+
+async def _ledger_row(db, user_id: int, kind: str, delta: int, balance: int, ref=None):
+    await db.execute(
+        "INSERT INTO tarot_ledger(user_id, ts, kind, delta, balance, ref) VALUES(?,?,?,?,?,?)",
+        (user_id, int(datetime.datetime.now(tz=TZ).timestamp()), kind, delta, balance,
+         None if ref is None else str(ref)))
+
+async def _credit(db, user_id: int, n: int, kind: str, ref=None) -> int:
+    cur = await db.execute(
+        "INSERT INTO tarot_users(user_id, cards_balance) VALUES(?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET cards_balance = COALESCE(cards_balance,0) + excluded.cards_balance "
+        "RETURNING cards_balance", (user_id, n))
+    bal = int((await cur.fetchone())[0])
+    await _ledger_row(db, user_id, kind, n, bal, ref)
+    return bal
 
 async def tarot_try_use_free(user_id: int) -> bool:
     today = today_str()
-    async with db_connect() as db:
-        cur = await db.execute("SELECT COALESCE(free_last_date,''), COALESCE(free_used,0) FROM tarot_users WHERE user_id=?", (user_id,))
+    async def _tx(db):
+        # новый день — счётчик с единицы; иначе +1, пока не упёрлись в TAROT_DAILY_FREE
+        cur = await db.execute(
+            "INSERT INTO tarot_users(user_id, free_last_date, free_used) VALUES(?, ?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET "
+            "free_used = CASE WHEN free_last_date IS excluded.free_last_date THEN COALESCE(free_used,0) + 1 ELSE 1 END, "
+            "free_last_date = excluded.free_last_date "
+            "WHERE free_last_date IS NOT excluded.free_last_date OR COALESCE(free_used,0) < ? "
+            "RETURNING free_used, COALESCE(cards_balance,0)",
+            (user_id, today, TAROT_DAILY_FREE))
         row = await cur.fetchone()
-        if not row:
-            await db.execute("INSERT OR IGNORE INTO tarot_users(user_id, free_last_date, free_used) VALUES(?,?,0)", (user_id, today))
-            await db.commit()
-            return True
-        last, used = row
-        if last != today:
-            await db.execute("UPDATE tarot_users SET free_last_date=?, free_used=0 WHERE user_id=?", (today, user_id))
-            await db.commit()
-            used = 0
-        if used < TAROT_DAILY_FREE:
-            await db.execute("UPDATE tarot_users SET free_used = free_used + 1 WHERE user_id=?", (user_id,))
-            await db.commit()
-            return True
-        return False
+        if row is None:
+            cur = await db.execute("SELECT COALESCE(free_used,0) FROM tarot_users WHERE user_id=?", (user_id,))
+            return False, int((await cur.fetchone())[0])
+        await _ledger_row(db, user_id, "free", 0, int(row[1]), today)
+        return True, int(row[0])
+    ok, used = await DB.write(_tx)
+    PROFILES.update(user_id, tarot_exists=True, free_last_date=today, free_used=used)
+    return ok
+
+# Журнал раскладов и маска «без повторов» пишутся через WRITE_BEHIND. Карты, вытянутые
+# сегодня (и вчера — на случай сброса около полуночи), дополнительно держим в _PENDING_MASKS:
+# recent_cards_mask учитывает их, пока БД не догнала, а новая строка recent_masks всегда
+# надмножество уже поставленных в очередь, так что порядок UPDATE в пачке не важен.
+_DRAWS_SQL = "INSERT INTO tarot_draws(user_id, ts, date, card_code, tarolog, is_free) VALUES(?,?,?,?,?,?)"
+_MASK_ROW_SQL = "INSERT OR IGNORE INTO tarot_users(user_id) VALUES(?)"
+_MASK_SQL = "UPDATE tarot_users SET recent_masks=? WHERE user_id=?"
+_PENDING_MASKS: dict[int, dict[int, int]] = {}   # user_id -> {day: mask}
+_pending_day = 0
+
+def _pending_masks_for(user_id: int, today: int) -> dict[int, int]:
+    global _PENDING_MASKS, _pending_day
+    if _pending_day != today:
+        # раз в сутки: оставляем только вчерашние и сегодняшние карты
+        _PENDING_MASKS = {uid: kept for uid, m in _PENDING_MASKS.items()
+                          if (kept := {d: v for d, v in m.items() if d >= today - 1})}
+        _pending_day = today
+    return _PENDING_MASKS.setdefault(user_id, {})
 
 async def tarot_log_draw(user_id: int, card_code: str, tarolog: Optional[str], is_free: int):
-    async with db_connect() as db:
-        ts = int(datetime.datetime.now(tz=TZ).timestamp())
-        await db.execute(
-            "INSERT INTO tarot_draws(user_id, ts, date, card_code, tarolog, is_free) VALUES(?,?,?,?,?,?)",
-            (user_id, ts, today_str(), card_code, tarolog or None, int(is_free))
-        )
-        await db.commit()
-
-async def tarot_add_cards(user_id: int, n: int):
-    async with db_connect() as db:
-        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id, cards_balance) VALUES(?, 0)", (user_id,))
-        await db.execute("UPDATE tarot_users SET cards_balance = COALESCE(cards_balance,0) + ? WHERE user_id=?", (n, user_id))
-        await db.commit()
+    ts = int(datetime.datetime.now(tz=TZ).timestamp())
+    drawn = cards_to_mask((card_code or "").split(","))
+    today = _today_ordinal()
+    row = await DB.fetchone("SELECT COALESCE(recent_masks,'') FROM tarot_users WHERE user_id=?", (user_id,))
+    masks = _parse_masks(row[0] if row else "")
+    pending = _pending_masks_for(user_id, today)
+    pending[today] = pending.get(today, 0) | drawn
+    for day, mask in pending.items():
+        masks[day] = masks.get(day, 0) | mask
+    WRITE_BEHIND.add(_DRAWS_SQL, (user_id, ts, today_str(), card_code, tarolog or None, int(is_free)))
+    WRITE_BEHIND.add(_MASK_ROW_SQL, (user_id,))
+    WRITE_BEHIND.add(_MASK_SQL, (_format_masks(masks), user_id))
+
+async def tarot_add_cards(user_id: int, n: int, kind: str = "grant", ref=None):
+    bal = await DB.write(lambda db: _credit(db, user_id, n, kind, ref))
+    profile_changed(user_id, tarot_exists=True, cards_balance=bal)   # админ начисляет и чужим
 
 
 # --- Списание одной платной карты (возвращает True, если успешно) ---
 async def tarot_consume_paid_card(user_id: int) -> bool:
     """Пытается списать 1 карту с баланса. Возвращает True, если получилось."""
-    async with db_connect() as db:
-        # Убедимся, что запись существует
-        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id, cards_balance) VALUES(?, 0)", (user_id,))
-        cur = await db.execute("SELECT COALESCE(cards_balance,0) FROM tarot_users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        bal = int(row[0]) if row and row[0] is not None else 0
-        if bal <= 0:
-            return False
-        await db.execute("UPDATE tarot_users SET cards_balance = cards_balance - 1 WHERE user_id=?", (user_id,))
-        await db.commit()
-        return True
+    return await tarot_consume_paid_cards(user_id, 1)
 
 # --- Списание N платных карт атомарно (возвращает True, если успешно) ---
-async def tarot_consume_paid_cards(user_id: int, n: int) -> bool:
+async def tarot_consume_paid_cards(user_id: int, n: int, ref=None) -> bool:
     """Списывает n платных карт атомарно. Возвращает True, если удалось."""
     if n <= 0:
         return True
-    async with db_connect() as db:
-        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id, cards_balance) VALUES(?, 0)", (user_id,))
-        cur = await db.execute("SELECT COALESCE(cards_balance,0) FROM tarot_users WHERE user_id=?", (user_id,))
+    async def _tx(db):
+        cur = await db.execute(
+            "UPDATE tarot_users SET cards_balance = cards_balance - ? "
+            "WHERE user_id=? AND cards_balance >= ? RETURNING cards_balance", (n, user_id, n))
         row = await cur.fetchone()
-        bal = int(row[0]) if row and row[0] is not None else 0
-        if bal < n:
-            return False
-        await db.execute("UPDATE tarot_users SET cards_balance = cards_balance - ? WHERE user_id=?", (n, user_id))
-        await db.commit()
-        return True
+        if row is None:
+            cur = await db.execute("SELECT COALESCE(cards_balance,0) FROM tarot_users WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+            return False, int(row[0]) if row else 0
+        await _ledger_row(db, user_id, "paid", -n, int(row[0]), ref)
+        return True, int(row[0])
+    ok, bal = await DB.write(_tx)
+    PROFILES.update(user_id, tarot_exists=True, cards_balance=bal)
+    return ok
 
 async def tarot_add_referral(referrer_id: int, referred_id: int) -> bool:
     if referrer_id == referred_id:
         return False
-    async with db_connect() as db:
-        cur = await db.execute("SELECT 1 FROM tarot_referrals WHERE referred_id=?", (referred_id,))
-        if await cur.fetchone():
-            return False
-        ts = int(datetime.datetime.now(tz=TZ).timestamp())
-        await db.execute("INSERT OR IGNORE INTO tarot_referrals(referrer_id, referred_id, ts) VALUES(?,?,?)", (referrer_id, referred_id, ts))
-        await db.execute("INSERT OR IGNORE INTO tarot_users(user_id, cards_balance) VALUES(?, 0)", (referrer_id,))
-        await db.execute("UPDATE tarot_users SET cards_balance = COALESCE(cards_balance,0) + 1 WHERE user_id=?", (referrer_id,))
-        await db.commit()
-        return True
+    ts = int(datetime.datetime.now(tz=TZ).timestamp())
+    async def _tx(db):
+        cur = await db.execute(
+            "INSERT INTO tarot_referrals(referrer_id, referred_id, ts) VALUES(?,?,?) "
+            "ON CONFLICT(referred_id) DO NOTHING RETURNING 1", (referrer_id, referred_id, ts))
+        if await cur.fetchone() is None:
+            return None
+        return await _credit(db, referrer_id, 1, "referral", referred_id)
+    bal = await DB.write(_tx)
+    if bal is None:
+        return False
+    profile_changed(referrer_id, tarot_exists=True, cards_balance=bal)
+    return True
+
+async def tarot_reconcile(limit: int = 20) -> tuple[int, list[tuple[int, int, int]]]:
+    """Сверка cards_balance с SUM(delta) журнала: (число расхождений, первые limit как (user_id, баланс, журнал))."""
+    sql = ("SELECT t.user_id, COALESCE(t.cards_balance,0), COALESCE(l.total,0) FROM tarot_users t "
+           "LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM tarot_ledger GROUP BY user_id) l USING(user_id) "
+           "WHERE COALESCE(t.cards_balance,0) <> COALESCE(l.total,0) "
+           "UNION ALL "
+           "SELECT l.user_id, 0, SUM(l.delta) FROM tarot_ledger l LEFT JOIN tarot_users t USING(user_id) "
+           "WHERE t.user_id IS NULL GROUP BY l.user_id HAVING SUM(l.delta) <> 0")
+    rows = await DB.fetchall(sql)
+    return len(rows), [tuple(int(x) for x in r) for r in rows[:limit]]
 
 # ----------------- UI УТИЛИТЫ -----------------
 
@@ -767,10 +1974,7 @@ async def safe_edit(query, text: str, reply_markup=None, parse_mode=None):
                 if "message to edit not found" in str(e).lower() or "message is not modified" in str(e).lower() or "can't parse entities" in str(e).lower():
                     chat_id = msg.chat.id
                     new_msg = await query.get_bot().send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
-                    try:
-                        await msg.delete()
-                    except Exception:
-                        pass
+                    CLEANUP.add(chat_id, msg.message_id)
                     return
                 raise
         await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -779,24 +1983,52 @@ async def safe_edit(query, text: str, reply_markup=None, parse_mode=None):
         if ("query is too old" in msg) or ("query id is invalid" in msg) or ("message to edit not found" in msg) or ("message is not modified" in msg):
             chat_id = query.message.chat.id
             new_msg = await query.get_bot().send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
+            CLEANUP.add(chat_id, query.message.message_id)
         else:
             raise
 
+# --- Отложенное удаление UI-сообщений ---
+# Старые окна, фото и предсказания не удаляются по одному перед новой отправкой: их id копятся
+# по чатам, а в конце апдейта (группа CLEANUP_GROUP) уходят одним deleteMessages. Новое
+# сообщение появляется без ожидания удалений. Задачи JobQueue (анимации) сбрасывают сами.
+CLEANUP_GROUP = 1
+DELETE_BATCH = 100   # лимит deleteMessages
+
+class CleanupCollector:
+    def __init__(self):
+        self._pending: dict[int, set[int]] = {}   # chat_id -> message_id
+
+    def add(self, chat_id: Optional[int], *message_ids):
+        ids = {int(m) for m in message_ids if m}
+        if chat_id and ids:
+            self._pending.setdefault(chat_id, set()).update(ids)
+
+    async def flush(self, bot, chat_id: int):
+        ids = sorted(self._pending.pop(chat_id, ()))
+        for i in range(0, len(ids), DELETE_BATCH):
+            try:
+                # недоступные (уже удалённые, старше 48 ч) Telegram просто пропускает
+                await bot.delete_messages(chat_id=chat_id, message_ids=ids[i:i + DELETE_BATCH])
+            except Exception as e:
+                logging.debug("deleteMessages in chat %s failed: %s", chat_id, e)
+
+CLEANUP = CleanupCollector()
+
+async def cleanup_flush(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat is not None:
+        await CLEANUP.flush(context.bot, chat.id)
+
 async def ui_show(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, reply_markup=None, parse_mode=None):
     """Показывает/обновляет одно «окно»; удаляет предыдущее при необходимости."""
     mid = context.chat_data.get("ui_mid")
 
     from telegram import ReplyKeyboardMarkup as _RKM
     if isinstance(reply_markup, _RKM):
-        if mid:
-            try: await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-            except Exception: pass
         m = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
         context.chat_data["ui_mid"] = m.message_id
+        if mid and mid != m.message_id:
+            CLEANUP.add(chat_id, mid)
         return
 
     if mid:
@@ -810,66 +2042,536 @@ async def ui_show(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, r
     m = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
     context.chat_data["ui_mid"] = m.message_id
     if old_mid and old_mid != m.message_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=old_mid)
-        except Exception:
-            pass
+        CLEANUP.add(chat_id, old_mid)
+
+def _cleanup_info(info: Optional[dict]):
+    """Ставит в очередь удаления сообщение из записи {"chat_id", "message_id"}."""
+    if info:
+        CLEANUP.add(info.get("chat_id"), info.get("message_id"))
 
 async def try_delete_last_prediction(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    info = context.user_data.get("last_pred_msg")
-    if not info:
-        return
-    chat_id = info.get("chat_id"); message_id = info.get("message_id")
-    if chat_id and message_id:
+    _cleanup_info(context.user_data.pop("last_pred_msg", None))
+    # сохранённое фото предсказания (если текст не влез в подпись)
+    _cleanup_info(context.user_data.pop("last_pred_photo", None))
+
+
+async def tarot_cleanup_about_photo(context: ContextTypes.DEFAULT_TYPE):
+    _cleanup_info(context.user_data.pop("tarot_about_photo", None))
+
+# --- Новый, более универсальный очиститель фото таролога ---
+async def tarot_cleanup_all_photos(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет любые сохранённые фото таролога (и из user_data, и из chat_data)."""
+    # 1) Старый ключ в user_data
+    _cleanup_info(context.user_data.pop("tarot_about_photo", None))
+    # 2) Универсальный ключ в chat_data
+    _cleanup_info(context.chat_data.pop("tarot_photo", None))
+
+
+# ----------------- MEDIA (кеш file_id) -----------------
+# Telegram возвращает file_id для загруженного фото; повторная отправка по file_id
+# не требует заливать байты заново. Ключ — путь + хеш содержимого, копия хранится в SQLite.
+
+class MediaCache:
+    """Кеш file_id для локальных картинок (таролог, знак зодиака)."""
+
+    def __init__(self):
+        self._ids: dict[str, tuple[str, str]] = {}              # path -> (digest, file_id)
+        self._digests: dict[str, tuple[int, int, str]] = {}     # path -> (mtime_ns, size, digest)
+        self._loaded = False
+
+    @staticmethod
+    def _key(path: Path) -> str:
+        try:
+            return path.resolve().relative_to(APP_DIR.resolve()).as_posix()
+        except ValueError:
+            return path.resolve().as_posix()
+
+    def _digest(self, path: Path, key: str) -> str:
+        # пересчитываем хеш только если файл изменился (mtime/size)
+        st = path.stat()
+        known = self._digests.get(key)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        digest = hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
+        self._digests[key] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            for path, digest, file_id in await DB.fetchall("SELECT path, digest, file_id FROM media_cache"):
+                self._ids[path] = (digest, file_id)
+        except Exception as e:
+            logging.warning("Media cache load failed: %s", e)
+
+    async def send_photo(self, bot, chat_id: int, path: Path, **kwargs):
+        """send_photo по file_id; загружает файл заново, если он изменился или id отвергнут."""
+        await self._ensure_loaded()
+        key = self._key(path)
+        digest = self._digest(path, key)
+        cached = self._ids.get(key)
+        if cached and cached[0] == digest:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=cached[1], **kwargs)
+            except BadRequest as e:
+                if "file" not in str(e).lower():
+                    raise
+                logging.info("file_id for %s rejected (%s); re-uploading", key, e)
+                self._ids.pop(key, None)
+        with path.open("rb") as f:
+            msg = await bot.send_photo(chat_id=chat_id, photo=f, **kwargs)
+        if msg.photo:
+            file_id = msg.photo[-1].file_id
+            self._ids[key] = (digest, file_id)
+            try:
+                await DB.execute(
+                    "INSERT OR REPLACE INTO media_cache(path, digest, file_id, ts) VALUES(?,?,?,?)",
+                    (key, digest, file_id, int(datetime.datetime.now(tz=TZ).timestamp()))
+                )
+            except Exception as e:
+                logging.warning("Media cache store failed for %s: %s", key, e)
+        return msg
+
+MEDIA = MediaCache()
+
+# Карточка «картинка + текст» одним сообщением: подпись к фото вместо отдельного текста.
+# Лимит подписи — 1024 символа видимого текста (после разбора HTML, в единицах UTF-16);
+# длиннее — фото и текст уходят двумя сообщениями, как раньше.
+CAPTION_LIMIT = 1024
+
+def _caption_len(html_text: str) -> int:
+    visible = html.unescape(re.sub(r"<[^>]+>", "", html_text))
+    return len(visible.encode("utf-16-le")) // 2
+
+async def send_card(bot, chat_id: int, photo: Optional[Path], text: str, reply_markup=None, rate_limit_args=None):
+    """(сообщение с текстом, отдельное фото или None). Текст всегда в HTML."""
+    if photo is not None and _caption_len(text) <= CAPTION_LIMIT:
+        try:
+            msg = await MEDIA.send_photo(bot, chat_id, photo, caption=text, parse_mode=ParseMode.HTML,
+                                         reply_markup=reply_markup, rate_limit_args=rate_limit_args)
+            return msg, None
+        except (RetryAfter, Forbidden):
+            raise
+        except Exception as e:
+            logging.warning("photo card for chat %s failed, sending text only: %s", chat_id, e)
+            photo = None
+    photo_msg = None
+    if photo is not None:
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            photo_msg = await MEDIA.send_photo(bot, chat_id, photo, rate_limit_args=rate_limit_args)
         except Exception:
             pass
-    context.user_data.pop("last_pred_msg", None)
-    # Удалим сохранённое фото предсказания (если было)
-    info_photo = context.user_data.get("last_pred_photo")
-    if info_photo:
-        p_chat = info_photo.get("chat_id"); p_mid = info_photo.get("message_id")
-        if p_chat and p_mid:
+    msg = await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup,
+                                 rate_limit_args=rate_limit_args)
+    return msg, photo_msg
+
+
+# ----------------- ИЗОБРАЖЕНИЯ (сборка ассетов) -----------------
+# Исходники в zodiac_images/ и tarot_images/ отдаются не как есть: на старте (или по
+# tools/build_assets.py) каждое фото уменьшается до ASSET_MAX_SIDE по длинной стороне и
+# пережимается в JPEG в пуле процессов, чтобы не держать цикл событий. Результат лежит в
+# ASSET_CACHE_DIR под именем по хешу содержимого; manifest.json связывает канонический ключ
+# ("zodiac/Лев", "tarot/mystic") с файлом и с mtime/size исходника — неизменённые файлы
+# при следующем старте не читаются. Если пережатый файл не меньше исходника, берётся исходник.
+# Без Pillow шаг только нормализует имена и копирует файлы в кеш.
+
+ASSET_CACHE_DIR = Path(os.getenv("ASSET_CACHE_DIR", "").strip() or APP_DIR / ".asset_cache")
+ASSET_MAX_SIDE = int(os.getenv("ASSET_MAX_SIDE", "1280") or 1280)   # больше Telegram всё равно не покажет
+ASSET_JPEG_QUALITY = int(os.getenv("ASSET_JPEG_QUALITY", "80") or 80)
+TG_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+def _fix_mojibake(name: str) -> str:
+    """UTF-8 имя, распакованное как cp437 (zip без флага UTF-8): «╨¢╨╡╨▓» -> «Лев»; результат в NFC."""
+    try:
+        name = name.encode("cp437").decode("utf-8")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        pass
+    return unicodedata.normalize("NFC", name)
+
+def _asset_zodiac_key(stem: str) -> Optional[str]:
+    n = _norm_fs(_fix_mojibake(stem))
+    for z in ZODIACS:
+        if n in (_norm_fs(z), _EN_ALIAS[z]):
+            return z
+    return None
+
+def _asset_tarot_key(stem: str) -> Optional[str]:
+    n = _fix_mojibake(stem).strip().lower()
+    for code, _ in TAROT_TAROLOGS:
+        if n.startswith(code):
+            return code
+    return None
+
+def _optimize_image(data: bytes, max_side: int, quality: int) -> tuple[bytes, str]:
+    """Выполняется в процессе пула: (байты, расширение) — пережатый JPEG или исходник, если он меньше."""
+    if Image is None:
+        return data, ""
+    from io import BytesIO
+    with Image.open(BytesIO(data)) as src:
+        im = ImageOps.exif_transpose(src)
+        if im.mode in ("RGBA", "LA", "P"):
+            im = im.convert("RGBA")
+            bg = Image.new("RGB", im.size, (255, 255, 255))
+            bg.paste(im, mask=im.getchannel("A"))
+            im = bg
+        elif im.mode != "RGB":
+            im = im.convert("RGB")
+        im.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = BytesIO()
+        im.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        # лимиты Telegram для фото: до 10 МБ, ширина + высота до 10000
+        fits = src.format == "JPEG" and sum(src.size) <= 10000 and len(data) <= TG_PHOTO_MAX_BYTES
+    if fits and len(data) <= out.tell():
+        return data, ".jpg"
+    return out.getvalue(), ".jpg"
+
+class AssetStore:
+    """Канонический ключ -> оптимизированный файл в кеше; манифест переживает рестарт."""
+
+    SOURCES = (("zodiac", ZODIAC_IMAGES_DIR, _asset_zodiac_key), ("tarot", TAROT_IMAGES_DIR, _asset_tarot_key))
+
+    def __init__(self, cache_dir: Path = ASSET_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.manifest_path = cache_dir / "manifest.json"
+        self._entries: dict[str, dict] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def params(self) -> str:
+        # смена настроек или появление Pillow пересобирает всё
+        return f"{ASSET_MAX_SIDE}/{ASSET_JPEG_QUALITY}/{'pil' if Image is not None else 'copy'}"
+
+    def path(self, kind: str, key: str) -> Optional[Path]:
+        e = self._entries.get(f"{kind}/{key}")
+        if e is None:
+            return None
+        p = self.cache_dir / e["file"]
+        return p if p.exists() else None
+
+    def _load_manifest(self) -> dict:
+        try:
+            m = json.loads(self.manifest_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return {}
+        return m.get("entries", {}) if m.get("params") == self.params else {}
+
+    def _scan(self) -> dict[str, Path]:
+        found = {}
+        for kind, src_dir, key_fn in self.SOURCES:
+            base = Path(src_dir)
+            if not base.is_absolute():
+                base = APP_DIR / base
+            if not base.is_dir():
+                continue
+            for f in sorted(base.iterdir()):
+                if not (f.is_file() and f.suffix.lower() in IMAGE_EXTS):
+                    continue
+                key = key_fn(f.stem)
+                if key is None:
+                    logging.warning("Asset %s: не удалось сопоставить имя «%s»", f, _fix_mojibake(f.stem))
+                elif f"{kind}/{key}" not in found:
+                    found[f"{kind}/{key}"] = f
+        return found
+
+    def _plan(self) -> tuple[dict[str, dict], list[tuple[str, Path, bytes, str]]]:
+        """Синхронная часть (в потоке): что взять из манифеста, что пережать."""
+        old = self._load_manifest()
+        entries, jobs = {}, []
+        for key, src in self._scan().items():
+            st = src.stat()
+            e = old.get(key)
+            if e and e["mtime_ns"] == st.st_mtime_ns and e["size"] == st.st_size and (self.cache_dir / e["file"]).exists():
+                entries[key] = e
+                continue
+            data = src.read_bytes()
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if e and e["digest"] == digest and (self.cache_dir / e["file"]).exists():
+                entries[key] = {**e, "mtime_ns": st.st_mtime_ns}   # touch без изменения содержимого
+                continue
+            entries[key] = {"src": src.name, "mtime_ns": st.st_mtime_ns, "size": st.st_size, "digest": digest}
+            jobs.append((key, src, data, digest))
+        return entries, jobs
+
+    def _store(self, data: bytes, ext: str) -> str:
+        name = hashlib.blake2b(data, digest_size=16).hexdigest() + ext
+        dst = self.cache_dir / name
+        if not dst.exists():
+            tmp = dst.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, dst)   # воркеры шардов собирают одновременно — файл появляется целиком
+        return name
+
+    def _save_manifest(self, entries: dict):
+        tmp = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"params": self.params, "entries": entries}, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, self.manifest_path)
+        # файлы, на которые манифест больше не ссылается
+        live = {e["file"] for e in entries.values()} | {self.manifest_path.name}
+        for f in self.cache_dir.iterdir():
+            if f.name not in live and not f.name.endswith(".tmp"):
+                f.unlink(missing_ok=True)
+
+    async def build(self) -> int:
+        """Пересобирает изменившиеся ассеты; возвращает число обработанных файлов."""
+        async with self._lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entries, jobs = await asyncio.to_thread(self._plan)
+            if jobs:
+                if Image is None:
+                    # без Pillow пережимать нечем — только копируем в кеш (в потоке, ниже), без пула процессов
+                    results = [(data, "") for _, _, data, _ in jobs]
+                else:
+                    loop = asyncio.get_running_loop()
+                    with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+                        results = await asyncio.gather(
+                            *(loop.run_in_executor(pool, _optimize_image, data, ASSET_MAX_SIDE, ASSET_JPEG_QUALITY)
+                              for _, _, data, _ in jobs), return_exceptions=True)
+                for (key, src, data, _), res in zip(jobs, results):
+                    if isinstance(res, Exception):
+                        logging.warning("Asset %s: не удалось пережать (%s), отправляем исходник", src, res)
+                        res = (data, "")
+                    out, ext = res
+                    name = await asyncio.to_thread(self._store, out, ext or src.suffix.lower())
+                    entries[key].update(file=name, bytes=len(out))
+                saved = sum(e["size"] - e["bytes"] for e in entries.values())
+                logging.info("Assets: пересобрано %d из %d, экономия %.1f КБ на полном комплекте",
+                             len(jobs), len(entries), saved / 1024)
+            await asyncio.to_thread(self._save_manifest, entries)
+            self._entries = entries
+            return len(jobs)
+
+ASSETS = AssetStore()
+
+
+# ----------------- РАССЫЛКА (broadcast) -----------------
+# Рассылка живёт в БД (broadcast_jobs/broadcast_targets) и отправляется фоновой задачей:
+# темп ниже глобального лимита Telegram (~30 msg/s), пауза на RetryAfter, отметка
+# заблокировавших бота, продолжение после перезапуска и живой прогресс у админа.
+# Каждый чат получает одно сообщение на рассылку, так что лимит на чат соблюдается сам собой.
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25") or 25)            # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16") or 16)  # одновременных запросов
+BROADCAST_CHUNK = 500            # целей за одну выборку из БД
+BROADCAST_PROGRESS_SEC = 3.0     # как часто обновлять сообщение с прогрессом
+BROADCAST_MAX_ATTEMPTS = 5
+
+# статусы broadcast_targets.status
+BC_PENDING, BC_SENT, BC_FAILED, BC_BLOCKED = 0, 1, 2, 3
+
+def broadcast_stop_kb(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить рассылку", callback_data=f"admin:bc_stop:{job_id}")]])
+
+class Broadcaster:
+    """Фоновые задачи рассылки: по одной asyncio-задаче на активную рассылку."""
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._pause_until = 0.0  # общая пауза после RetryAfter
+
+    async def create(self, bot, admin_chat_id: int, text: str) -> int:
+        now = int(datetime.datetime.now(tz=TZ).timestamp())
+        async def _tx(db):
+            cur = await db.execute(
+                "INSERT INTO broadcast_jobs(admin_chat_id, text, status, created_ts) VALUES(?,?,'running',?)",
+                (admin_chat_id, text, now)
+            )
+            job_id = cur.lastrowid
+            await db.execute(
+                "INSERT OR IGNORE INTO broadcast_targets(job_id, chat_id) "
+                "SELECT ?, chat_id FROM users WHERE consent=1 AND COALESCE(blocked,0)=0",
+                (job_id,)
+            )
+            return job_id
+        job_id = await DB.write(_tx)
+        try:
+            m = await bot.send_message(chat_id=admin_chat_id, text=f"📬 Рассылка #{job_id}: подготовка…", reply_markup=broadcast_stop_kb(job_id))
+            await DB.execute("UPDATE broadcast_jobs SET progress_mid=? WHERE id=?", (m.message_id, job_id))
+        except Exception as e:
+            logging.warning("broadcast #%s: progress message failed: %s", job_id, e)
+        self.start(bot, job_id)
+        return job_id
+
+    def start(self, bot, job_id: int):
+        if job_id in self._tasks and not self._tasks[job_id].done():
+            return
+        self._tasks[job_id] = asyncio.create_task(self._run(bot, job_id), name=f"broadcast-{job_id}")
+
+    async def resume_all(self, bot):
+        for (job_id,) in await DB.fetchall("SELECT id FROM broadcast_jobs WHERE status='running'"):
+            logging.info("Resuming broadcast #%s", job_id)
+            self.start(bot, job_id)
+
+    async def cancel(self, job_id: int):
+        await DB.execute("UPDATE broadcast_jobs SET status='cancelled', finished_ts=? WHERE id=? AND status='running'",
+                         (int(datetime.datetime.now(tz=TZ).timestamp()), job_id))
+        task = self._tasks.pop(job_id, None)
+        if task:
+            task.cancel()
+
+    async def stop(self):
+        # при остановке процесса рассылки остаются в статусе running и продолжатся после старта
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
             try:
-                await context.bot.delete_message(chat_id=p_chat, message_id=p_mid)
-            except Exception:
+                await t
+            except BaseException:
                 pass
-        context.user_data.pop("last_pred_photo", None)
 
+    async def _send_one(self, bot, chat_id: int, text: str) -> int:
+        loop = asyncio.get_running_loop()
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            delay = self._pause_until - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, rate_limit_args=BULK)
+                return BC_SENT
+            except RetryAfter as e:
+                ra = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+                self._pause_until = max(self._pause_until, loop.time() + ra + 0.5)
+                continue
+            except Forbidden:
+                return BC_BLOCKED
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return BC_BLOCKED
+                return BC_FAILED
+            except Exception:
+                await asyncio.sleep(1.0)
+        return BC_FAILED
 
-async def tarot_cleanup_about_photo(context: ContextTypes.DEFAULT_TYPE):
-    info = context.user_data.pop("tarot_about_photo", None)
-    if not info:
-        return
-    chat_id = info.get("chat_id"); message_id = info.get("message_id")
-    if chat_id and message_id:
+    async def _progress(self, bot, job_id: int, chat_id: int, mid: Optional[int], counts: dict, done: bool = False,
+                        cancelled: bool = False, failed: bool = False):
+        if not mid:
+            return
+        total = sum(counts.values())
+        processed = total - counts[BC_PENDING]
+        if failed:
+            head = "⚠️ Рассылка прервана ошибкой"
+        else:
+            head = "✅ Рассылка" if done else ("⏹ Рассылка остановлена" if cancelled else "📬 Рассылка")
+        final = done or cancelled or failed
+        txt = (f"{head} #{job_id}\n"
+               f"Обработано: <b>{processed}</b> из <b>{total}</b>\n"
+               f"Доставлено: {counts[BC_SENT]} · Ошибок: {counts[BC_FAILED]} · Заблокировали: {counts[BC_BLOCKED]}")
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            await bot.edit_message_text(chat_id=chat_id, message_id=mid, text=txt, parse_mode=ParseMode.HTML,
+                                        reply_markup=None if final else broadcast_stop_kb(job_id))
         except Exception:
             pass
 
-# --- Новый, более универсальный очиститель фото таролога ---
-async def tarot_cleanup_all_photos(context: ContextTypes.DEFAULT_TYPE):
-    """Удаляет любые сохранённые фото таролога (и из user_data, и из chat_data)."""
-    # 1) Старый ключ в user_data
-    info = context.user_data.pop("tarot_about_photo", None)
-    if info:
-        chat_id = info.get("chat_id"); message_id = info.get("message_id")
-        if chat_id and message_id:
+    async def _counts(self, job_id: int) -> dict:
+        counts = {BC_PENDING: 0, BC_SENT: 0, BC_FAILED: 0, BC_BLOCKED: 0}
+        for st, n in await DB.fetchall("SELECT status, COUNT(1) FROM broadcast_targets WHERE job_id=? GROUP BY status", (job_id,)):
+            counts[int(st)] = int(n)
+        return counts
+
+    async def _run(self, bot, job_id: int):
+        try:
+            await self._deliver(bot, job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # задача не должна умирать молча: рассылка помечается failed (resume_all её не подхватит),
+            # админ видит итог в сообщении с прогрессом
+            logging.exception("broadcast #%s failed", job_id)
             try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                await DB.execute("UPDATE broadcast_jobs SET status='failed', finished_ts=? WHERE id=? AND status='running'",
+                                 (int(datetime.datetime.now(tz=TZ).timestamp()), job_id))
+                row = await DB.fetchone("SELECT admin_chat_id, progress_mid FROM broadcast_jobs WHERE id=?", (job_id,))
+                if row:
+                    await self._progress(bot, job_id, row[0], row[1], await self._counts(job_id), failed=True)
             except Exception:
-                pass
-    # 2) Универсальный ключ в chat_data
-    info2 = context.chat_data.pop("tarot_photo", None)
-    if info2:
-        chat_id = info2.get("chat_id"); message_id = info2.get("message_id")
-        if chat_id and message_id:
+                logging.exception("broadcast #%s: failed to record failure", job_id)
+        finally:
+            if self._tasks.get(job_id) is asyncio.current_task():
+                self._tasks.pop(job_id, None)
+
+    async def _deliver(self, bot, job_id: int):
+        row = await DB.fetchone("SELECT text, admin_chat_id, progress_mid FROM broadcast_jobs WHERE id=?", (job_id,))
+        if not row:
+            return
+        text, admin_chat_id, mid = row
+        counts = await self._counts(job_id)
+
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        interval = 1.0 / max(0.1, BROADCAST_RATE)
+        next_at = loop.time()
+        last_progress = 0.0
+        tasks: list = []
+
+        async def _one(cid: int, results: list):
             try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-            except Exception:
-                pass
+                st = await self._send_one(bot, cid, text)
+            finally:
+                sem.release()
+            results.append((st, job_id, cid))
+            counts[BC_PENDING] -= 1
+            counts[st] += 1
+
+        try:
+            while True:
+                rows = await DB.fetchall(
+                    "SELECT chat_id FROM broadcast_targets WHERE job_id=? AND status=0 LIMIT ?",
+                    (job_id, BROADCAST_CHUNK)
+                )
+                if not rows:
+                    break
+                results: list = []
+                tasks = []
+                try:
+                    for (cid,) in rows:
+                        # равномерный темп + общая пауза после RetryAfter
+                        next_at = max(next_at + interval, self._pause_until, loop.time() - 1.0)
+                        delay = next_at - loop.time()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        await sem.acquire()
+                        tasks.append(asyncio.create_task(_one(cid, results)))
+                        if loop.time() - last_progress >= BROADCAST_PROGRESS_SEC:
+                            last_progress = loop.time()
+                            await self._progress(bot, job_id, admin_chat_id, mid, counts)
+                    await asyncio.gather(*tasks)
+                finally:
+                    # сохраняем результаты даже при отмене — чтобы после рестарта не слать повторно
+                    if results:
+                        await asyncio.shield(self._save(results))
+        except asyncio.CancelledError:
+            for t in tasks:
+                t.cancel()
+            row = await DB.fetchone("SELECT status FROM broadcast_jobs WHERE id=?", (job_id,))
+            if row and row[0] == "cancelled":
+                await self._progress(bot, job_id, admin_chat_id, mid, counts, cancelled=True)
+            raise
+        except Exception:
+            for t in tasks:
+                t.cancel()
+            raise
+
+        await DB.execute("UPDATE broadcast_jobs SET status='done', finished_ts=? WHERE id=? AND status='running'",
+                         (int(datetime.datetime.now(tz=TZ).timestamp()), job_id))
+        await self._progress(bot, job_id, admin_chat_id, mid, counts, done=True)
+        logging.info("broadcast #%s finished: %s", job_id, counts)
+
+    async def _save(self, results: list):
+        async def _tx(db):
+            await db.executemany("UPDATE broadcast_targets SET status=? WHERE job_id=? AND chat_id=?", results)
+            blocked = [(cid,) for st, _, cid in results if st == BC_BLOCKED]
+            if blocked:
+                await db.executemany("UPDATE users SET blocked=1 WHERE chat_id=?", blocked)
+        await DB.write(_tx)
+        # в личке chat_id == user_id
+        for st, _, cid in results:
+            if st == BC_BLOCKED:
+                profile_changed(cid, blocked=1)
+
+BROADCASTS = Broadcaster()
 
 
 # ----------------- КЛАВИАТУРЫ -----------------
@@ -882,9 +2584,11 @@ def admin_main_kb() -> _IKM2:
         # Баланс
         [_IKB2("🃏 +5 карт мне", callback_data="admin:give5"), _IKB2("📊 Статистика карт", callback_data="admin:cards_stats")],
         [_IKB2("➕ Выдать карты пользователю", callback_data="admin:grant_cards")],
+        [_IKB2("🧾 Сверка баланса с журналом", callback_data="admin:reconcile")],
         # Статистика
         [_IKB2("👥 По знакам", callback_data="admin:stats_zodiac"), _IKB2("🚻 По полу", callback_data="admin:stats_gender")],
         [_IKB2("🎂 По возрастам", callback_data="admin:stats_age"), _IKB2("🔔 Подписки", callback_data="admin:stats_subs")],
+        [_IKB2("♻️ Пересчитать статистику", callback_data="admin:stats_rebuild")],
         # Контент
         [_IKB2("📂 Проверить предсказания", callback_data="admin:pred_overview")],
         [_IKB2("✏️ Редактировать предсказание", callback_data="admin:pred_edit")],
@@ -1039,28 +2743,106 @@ def zodiac_pick_kb_settings() -> InlineKeyboardMarkup:
 
 def notify_time_kb() -> InlineKeyboardMarkup:
     # Разрешаем только окно 07:00–12:00 (МСК)
-    opts = ["07:00","08:00","09:00","10:00","11:00","12:00"]
+    opts = list(NOTIFY_SLOTS)
     rows = []
     for i in range(0, len(opts), 2):
         pair = opts[i:i+2]
         rows.append([InlineKeyboardButton(f"⏰ {t}", callback_data=f"settings:notify:set:{t}") for t in pair])
     rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="settings:open")])
     return InlineKeyboardMarkup(rows)
-# ----------------- ОБРАБОТЧИКИ -----------------
-
-async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# ----------------- CALLBACK ROUTER -----------------
+# callback_data → обработчик. Точные ключи ("tarot:open") — один поиск в dict;
+# параметризованные ("catdepth:<cat>:<depth>") — trie по сегментам ':' до первого
+# параметра, побеждает самый длинный литеральный префикс. Последний параметр забирает
+# остаток строки целиком (как split(":", n) в старых ветках).
+
+class CallbackCtx:
+    __slots__ = ("query", "data", "user_id", "chat_id", "prof")
+
+    def __init__(self, query, user_id: int, chat_id: int, prof=None):
+        self.query = query
+        self.data = query.data or ""
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.prof = prof
+
+class CallbackRouter:
+    def __init__(self):
+        self._exact: dict[str, tuple] = {}   # data -> (fn, admin, (), pattern)
+        self._trie: dict = {}                # сегмент -> узел; ключ None — маршрут узла
+
+    def route(self, pattern: str, admin: bool = False):
+        """Декоратор: @CALLBACKS.route("tarot:about:<code>"), admin=True — только для админов."""
+        def deco(fn):
+            self.add(pattern, fn, admin)
+            return fn
+        return deco
+
+    def add(self, pattern: str, fn, admin: bool = False):
+        segs = pattern.split(":")
+        first = next((i for i, seg in enumerate(segs) if seg.startswith("<")), None)
+        if first is None:
+            self._exact[pattern] = (fn, admin, (), pattern)
+            return
+        params = tuple(seg[1:-1] for seg in segs[first:])
+        assert all(seg.startswith("<") for seg in segs[first:]), pattern
+        node = self._trie
+        for seg in segs[:first]:
+            node = node.setdefault(seg, {})
+        node[None] = (fn, admin, params, pattern)
+
+    def resolve(self, data: str):
+        """(fn, admin, kwargs, pattern) или None."""
+        hit = self._exact.get(data)
+        if hit is not None:
+            return hit[0], hit[1], {}, hit[3]
+        node = self._trie
+        best, best_pos, pos = None, 0, 0
+        for seg in data.split(":"):
+            node = node.get(seg)
+            if node is None:
+                break
+            pos += len(seg) + 1
+            route = node.get(None)
+            # маршрут подходит, если после префикса хватает сегментов на все параметры
+            if route is not None and pos <= len(data) and data.count(":", pos) >= len(route[2]) - 1:
+                best, best_pos = route, pos
+        if best is None:
+            return None
+        fn, admin, params, pattern = best
+        return fn, admin, dict(zip(params, data[best_pos:].split(":", len(params) - 1))), pattern
+
+    async def dispatch(self, context, cb: CallbackCtx) -> bool:
+        hit = self.resolve(cb.data)
+        if hit is None:
+            CALLBACKS_UNMATCHED.inc()
+            return False
+        fn, admin, kwargs, pattern = hit
+        if admin and not is_admin(cb.user_id):
+            await safe_answer(cb.query, "Только для админов", show_alert=True)
+            return True
+        t0 = time.perf_counter()
+        try:
+            await fn(context, cb, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc("callback", pattern)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, "callback", pattern)
+        return True
+
+CALLBACKS = CallbackRouter()
+
+# ----------------- ОБРАБОТЧИКИ -----------------
+
+async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     chat_id = update.effective_chat.id
 
     # Gate: требуем подписку и выбранный знак
-    async with db_connect() as db:
-        cur = await db.execute(
-            "SELECT COALESCE(consent,0), COALESCE(zodiac,'') FROM users WHERE user_id=?",
-            (uid,)
-        )
-        row = await cur.fetchone()
-        consent = int(row[0]) if row else 0
-        zodiac  = str(row[1]) if row and row[1] else ''
+    prof = await user_profile(context, uid)
+    consent = prof.consent
+    zodiac  = prof.zodiac or ''
 
     if not consent:
         await ui_show(context, chat_id, await build_consent_text(uid), reply_markup=consent_inline_kb())
@@ -1078,17 +2860,15 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     chat_id = update.effective_chat.id
     await ensure_user_row(uid, chat_id)
+    # /start после блокировки — снова доступен для рассылок
+    prof = await user_profile(context, uid)
+    if prof.blocked:
+        await set_user_fields(uid, prof, blocked=0)
 
     # /start ref12345
         # Gate: сначала подписка, затем знак зодиака
-    async with db_connect() as db:
-        cur = await db.execute(
-            "SELECT COALESCE(consent,0), COALESCE(zodiac,'') FROM users WHERE user_id=?",
-            (uid,)
-        )
-        row = await cur.fetchone()
-        consent = int(row[0]) if row else 0
-        zodiac  = str(row[1]) if row and row[1] else ''
+    consent = prof.consent
+    zodiac  = prof.zodiac or ''
 
     if not consent:
         await ui_show(
@@ -1118,12 +2898,13 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     await ensure_user_row(uid, chat_id)
 
+    # Переход по меню отменяет незавершённую анимацию прогресса
+    await ANIMATIONS.cancel(context, chat_id)
+
     # Gate: без согласия и знака не пускаем никуда
-    async with db_connect() as db:
-        cur = await db.execute("SELECT COALESCE(consent,0), COALESCE(zodiac,'') FROM users WHERE user_id=?", (uid,))
-        row = await cur.fetchone()
-        consent = int(row[0]) if row else 0
-        zodiac  = str(row[1]) if row and row[1] else ''
+    prof = await user_profile(context, uid)
+    consent = prof.consent
+    zodiac  = prof.zodiac or ''
     if not consent:
         await ui_show(context, chat_id,
             await build_consent_text(uid),
@@ -1147,26 +2928,17 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await ui_show(context, chat_id, "Формат: <code>user_id количество</code>\nПример: <code>123456789 5</code>", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
             return
-        await tarot_add_cards(uid_target, amount)
+        await tarot_add_cards(uid_target, amount, "grant", uid)
         context.user_data.pop("await_grant_cards", None)
         await ui_show(context, chat_id, f"✅ Начислено <b>+{amount}</b> карт пользователю <code>{uid_target}</code>.", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
         return
 
-    # Ожидание текста для рассылки (тест: отправляем только себе)
+    # Ожидание текста для рассылки: ставим задачу, отправка идёт в фоне
     if context.user_data.get("await_broadcast"):
         context.user_data.pop("await_broadcast", None)
         try:
-            async with db_connect() as db:
-                cur = await db.execute("SELECT chat_id FROM users WHERE COALESCE(consent,0)=1")
-                rows = await cur.fetchall()
-            sent = 0
-            for (cid,) in rows:
-                try:
-                    await context.bot.send_message(chat_id=cid, text=text, parse_mode=ParseMode.HTML)
-                    sent += 1
-                except Exception:
-                    continue
-            await ui_show(context, chat_id, f"✅ Рассылка отправлена {sent} пользователям.", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+            job_id = await BROADCASTS.create(context.bot, chat_id, text)
+            await ui_show(context, chat_id, f"✅ Рассылка #{job_id} запущена. Прогресс — в отдельном сообщении.", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
         except Exception as e:
             await ui_show(context, chat_id, f"❌ Ошибка отправки: {e}", reply_markup=admin_main_kb())
         return
@@ -1175,10 +2947,6 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await tarot_cleanup_about_photo(context)
         await try_delete_last_prediction(context, uid)
         # если знак не выбран — сначала его
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac FROM users WHERE user_id=?", (uid,))
-            row = await cur.fetchone()
-            zodiac = row[0] if row else None
         if not zodiac:
             await ui_show(context, chat_id, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
             return
@@ -1196,14 +2964,7 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == BTN_PROFILE:
         await try_delete_last_prediction(context, uid)
         await tarot_cleanup_about_photo(context)
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (uid,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
-            else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
-        await ui_show(context, chat_id, settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
+        await ui_show(context, chat_id, settings_main_text(prof.zodiac, prof.age, prof.gender, prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
         return
 
     # Ввод возраста (ожидание текстом)
@@ -1216,17 +2977,9 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await ui_show(context, chat_id, "Введите возраст числом от 10 до 120:", reply_markup=settings_main_kb())
             return
-        async with db_connect() as db:
-            await db.execute("UPDATE users SET age=? WHERE user_id=?", (val, uid))
-            await db.commit()
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (uid,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
-            else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
+        await set_user_fields(uid, prof, age=val)
         context.user_data.pop("await_set_age", None)
-        await ui_show(context, chat_id, "✅ Возраст обновлён.\n\n" + settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
+        await ui_show(context, chat_id, "✅ Возраст обновлён.\n\n" + settings_main_text(prof.zodiac, prof.age, prof.gender, prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
         return
 
     if text == BTN_HELP:
@@ -1237,6 +2990,18 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await ui_show(context, chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
 
+_MENU_BRANCHES = {BTN_CATPRED: "catpred", BTN_TAROT: "tarot", BTN_PROFILE: "profile", BTN_HELP: "help"}
+_MENU_AWAITS = ("await_grant_cards", "await_broadcast", "await_set_age")
+
+def menu_branch(update: Update, context) -> str:
+    """Метка ветки menu_router для метрик: кнопка меню, режим ожидания ввода или other."""
+    text = ((update.effective_message and update.effective_message.text) or "").strip()
+    branch = _MENU_BRANCHES.get(text)
+    if branch:
+        return branch
+    ud = context.user_data or {}
+    return next((flag for flag in _MENU_AWAITS if ud.get(flag)), "other")
+
 # Zodiac inline keyboard (placed here to avoid forward-ref issue)
 from telegram import InlineKeyboardMarkup as _IKM, InlineKeyboardButton as _IKB
 def zodiac_pick_kb() -> _IKM:
@@ -1292,12 +3057,98 @@ def build_pred_progress(zodiac: Optional[str] = None) -> tuple[list[str], int]:
     total = random.randint(5, 7)
     return stages, total
 
+# --- Progress animations (JobQueue) ---
+# Этапы прогресса и финальный показ — это отложенные задачи JobQueue: хендлер считает
+# результат, ставит анимацию и сразу возвращается. Одна анимация на чат; переход по меню
+# отменяет её (keep_result=True — результат показываем сразу, без оставшихся этапов).
+ANIM_MAX_ACTIVE = int(os.getenv("ANIM_MAX_ACTIVE", "1000") or 1000)  # сверх лимита — показ без анимации
+
+class ProgressAnimator:
+    def __init__(self, limit: int = ANIM_MAX_ACTIVE):
+        self._limit = limit
+        self._active: dict[int, dict] = {}   # chat_id -> анимация
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    async def run(self, context, chat_id: int, stages: list[str], total: int, reveal,
+                  keep_result: bool = False, on_finish=None) -> bool:
+        """Показывает stages за total секунд (не менее 2 с на этап), затем await reveal().
+        on_finish() вызывается всегда — и после показа, и при отмене."""
+        await self.cancel(context, chat_id)
+        jq = context.job_queue
+        if jq is None or not stages or len(self._active) >= self._limit:
+            await self._finish(context.bot, chat_id, {"mid": None, "jobs": [], "reveal": reveal, "on_finish": on_finish})
+            return False
+        try:
+            msg = await context.bot.send_message(chat_id=chat_id, text=stages[0])
+        except Exception:
+            msg = None
+        anim = {"mid": msg.message_id if msg else None, "jobs": [], "reveal": reveal,
+                "keep": keep_result, "on_finish": on_finish}
+        self._active[chat_id] = anim
+        per_step = max(2, total // max(1, len(stages)))
+        for i, txt in enumerate(stages[1:], 1):
+            anim["jobs"].append(jq.run_once(self._stage_job, when=per_step * i, data=(chat_id, anim, txt),
+                                            name=f"anim:{chat_id}:{i}"))
+        anim["jobs"].append(jq.run_once(self._reveal_job, when=max(total, per_step * len(stages)),
+                                        data=(chat_id, anim), name=f"anim:{chat_id}:reveal"))
+        return True
+
+    async def cancel(self, context, chat_id: int):
+        anim = self._active.get(chat_id)
+        if anim is not None:
+            await self._finish(context.bot, chat_id, anim, reveal=anim["keep"])
+
+    async def _stage_job(self, context: ContextTypes.DEFAULT_TYPE):
+        chat_id, anim, txt = context.job.data
+        if self._active.get(chat_id) is not anim:
+            return
+        try:
+            if anim["mid"]:
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=anim["mid"], text=txt)
+                return
+        except Exception:
+            pass
+        # если не удалось отредактировать — пробуем отправить новое
+        try:
+            anim["mid"] = (await context.bot.send_message(chat_id=chat_id, text=txt)).message_id
+        except Exception:
+            pass
+
+    async def _reveal_job(self, context: ContextTypes.DEFAULT_TYPE):
+        chat_id, anim = context.job.data
+        if self._active.get(chat_id) is anim:
+            await self._finish(context.bot, chat_id, anim)
+
+    async def _finish(self, bot, chat_id: int, anim: dict, reveal: bool = True):
+        if self._active.get(chat_id) is anim:
+            del self._active[chat_id]
+        for job in anim["jobs"]:
+            try:
+                job.schedule_removal()
+            except Exception:
+                pass  # уже отработала
+        # сообщение прогресса удаляется вместе с тем, что reveal наберёт в CLEANUP, после показа
+        CLEANUP.add(chat_id, anim["mid"])
+        try:
+            if reveal:
+                await anim["reveal"]()
+        except Exception as e:
+            logging.warning("progress reveal failed for chat %s: %s", chat_id, e)
+        finally:
+            await CLEANUP.flush(bot, chat_id)
+            if anim["on_finish"]:
+                anim["on_finish"]()
+
+ANIMATIONS = ProgressAnimator()
+
 # --- Category card (header with date + 3 meters) ---
 _CAT_EMO = {name: emo for name, emo in CATEGORY_LIST}
 
 def _daily_score_rng(zodiac: str, category: str) -> random.Random:
-    seed = f"{today_str()}|{zodiac}|{category}|v1"
-    return random.Random(abs(hash(seed)) % (2**31))
+    return random.Random(stable_hash(today_str(), zodiac, category, "v1") % (2**31))
 
 def _build_meter(value: int, total: int = 5) -> str:
     value = max(0, min(total, int(value)))
@@ -1324,823 +3175,1450 @@ def build_category_card(zodiac: str, category: str) -> str:
     ]
     return "\n".join(lines)
 
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await safe_answer(query)
-    data = query.data
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
+# --- Daily precompute (252 тела категорий + 12 утренних дайджестов) ---
+# Результат зависит только от (дата, знак, категория, глубина), поэтому всё считается
+# один раз в 00:00 МСК (и после перезагрузки индекса), а хендлеры отдают готовые строки.
+PRECOMPUTE_PERSIST = os.getenv("PRECOMPUTE_PERSIST", "1") == "1"  # копия в SQLite для быстрых рестартов
 
-    # --- НАСТРОЙКИ (Settings) ---
-    if data == "settings:open":
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
-            else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
-        await safe_edit(query, settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
-        return
+def render_category_body(zodiac: str, category: str, depth: str) -> str:
+    return build_category_card(zodiac, category) + "\n" + pick_prediction(zodiac, category, depth)
 
-    if data == "settings:zodiac":
-        await safe_edit(query, "Выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb_settings())
-        return
+def render_morning_text(zodiac: str) -> str:
+    zemo = ZODIAC_SYMBOL.get(zodiac, "✨")
+    pred = load_daily_prediction(zodiac)
+    return (
+        f"🌅 <b>Доброе утро</b> · {zemo} <b>{zodiac}</b>\n"
+        f"<i>{today_str()}</i>\n"
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
+        f"{pred}"
+    )
 
-    if data.startswith("settings:setz:"):
-        new_z = data.split(":", 2)[-1]
-        async with db_connect() as db:
-            await db.execute("UPDATE users SET zodiac=? WHERE user_id=?", (new_z, user_id))
-            await db.commit()
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
+class DailyRenders:
+    """Готовые тексты на текущие сутки; на промах (другая дата/ключ) — обычный рендер."""
+
+    def __init__(self):
+        self._date: Optional[str] = None
+        self._category: dict[tuple, str] = {}
+        self._morning: dict[str, str] = {}
+
+    def category_body(self, zodiac: str, category: str, depth: str) -> str:
+        if self._date == today_str():
+            body = self._category.get((zodiac, category, depth))
+            if body is not None:
+                return body
+        return render_category_body(zodiac, category, depth)
+
+    def morning_body(self, zodiac: str) -> str:
+        if self._date == today_str():
+            body = self._morning.get(zodiac)
+            if body is not None:
+                return body
+        return render_morning_text(zodiac)
+
+    @staticmethod
+    def _render_all() -> tuple[str, dict, dict]:
+        day = today_str()
+        category = {
+            (z, cat, depth): render_category_body(z, cat, depth)
+            for z in ZODIACS for cat, _emo in CATEGORY_LIST for depth in PRED_DEPTHS
+        }
+        morning = {z: render_morning_text(z) for z in ZODIACS}
+        return day, category, morning
+
+    async def refresh(self, use_stored: bool = False):
+        day = today_str()
+        if use_stored and PRECOMPUTE_PERSIST and await self._load(day):
+            return
+        day, category, morning = await asyncio.to_thread(self._render_all)
+        self._date, self._category, self._morning = day, category, morning
+        logging.info("Daily renders ready for %s: %d bodies", day, len(category) + len(morning))
+        if PRECOMPUTE_PERSIST and IS_PRIMARY:
+            try:
+                await self._store(day, category, morning)
+            except Exception as e:
+                logging.warning("Daily renders store failed: %s", e)
+
+    @staticmethod
+    def _content_version() -> str:
+        # версия файлов предсказаний: сохранённая копия годится, только если файлы не менялись
+        return str(stable_hash(*(PRED_INDEX._sig or ())))
+
+    async def _load(self, day: str) -> bool:
+        rows = await DB.fetchall("SELECT kind, key, body FROM daily_renders WHERE date=?", (day,))
+        category, morning, version = {}, {}, None
+        for kind, key, body in rows:
+            if kind == "category":
+                category[tuple(key.split("|"))] = body
+            elif kind == "morning":
+                morning[key] = body
             else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
-        await safe_edit(query, f"✅ Знак обновлён: <b>{ZODIAC_SYMBOL.get(new_z,'✨')} {new_z}</b>\n\n" + settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
-        return
+                version = body
+        if version != self._content_version():
+            return False
+        if len(category) != len(ZODIACS) * len(CATEGORY_LIST) * len(PRED_DEPTHS) or len(morning) != len(ZODIACS):
+            return False
+        self._date, self._category, self._morning = day, category, morning
+        logging.info("Daily renders for %s loaded from DB", day)
+        return True
 
-    if data == "settings:age":
-        context.user_data["await_set_age"] = True
-        await safe_edit(
-            query,
-            "🎂 <b>Укажите возраст</b>\n\nВведите возраст числом (например, 25):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="settings:open")]]),
-            parse_mode=ParseMode.HTML
-        )
-        return
+    async def _store(self, day: str, category: dict, morning: dict):
+        rows = [(day, "category", "|".join(k), v) for k, v in category.items()]
+        rows += [(day, "morning", z, v) for z, v in morning.items()]
+        rows.append((day, "meta", "version", self._content_version()))
+        async def _tx(db):
+            await db.execute("DELETE FROM daily_renders WHERE date<>?", (day,))
+            await db.executemany("INSERT OR REPLACE INTO daily_renders(date, kind, key, body) VALUES(?,?,?,?)", rows)
+        await DB.write(_tx)
 
-    if data == "settings:gender":
-        await safe_edit(query, "Выберите пол:", reply_markup=gender_pick_kb())
-        return
+DAILY = DailyRenders()
 
-    if data.startswith("settings:gender:set:"):
-        val = data.split(":", 3)[-1]
-        async with db_connect() as db:
-            await db.execute("UPDATE users SET gender=? WHERE user_id=?", (val, user_id))
-            await db.commit()
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
-            else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
-        await safe_edit(query, f"✅ Пол обновлён: <b>{val}</b>\n\n" + settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
-        return
+async def daily_precompute_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await DAILY.refresh()
+    except Exception as e:
+        logging.warning("Daily precompute failed: %s", e)
+
+# --- НАСТРОЙКИ (Settings) ---
+@CALLBACKS.route("settings:open")
+async def cb_settings_open(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, settings_main_text(cb.prof.zodiac, cb.prof.age, cb.prof.gender, cb.prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("settings:zodiac")
+async def cb_settings_zodiac(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, "Выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb_settings())
+
+@CALLBACKS.route("settings:setz:<zodiac>")
+async def cb_settings_setz(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, zodiac: str):
+    await set_user_fields(cb.user_id, cb.prof, zodiac=zodiac)
+    await safe_edit(cb.query, f"✅ Знак обновлён: <b>{ZODIAC_SYMBOL.get(zodiac,'✨')} {zodiac}</b>\n\n" + settings_main_text(cb.prof.zodiac, cb.prof.age, cb.prof.gender, cb.prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("settings:age")
+async def cb_settings_age(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    context.user_data["await_set_age"] = True
+    await safe_edit(
+        cb.query,
+        "🎂 <b>Укажите возраст</b>\n\nВведите возраст числом (например, 25):",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="settings:open")]]),
+        parse_mode=ParseMode.HTML
+    )
 
-    if data == "settings:notify":
-        await safe_edit(query, "Выберите время для ежедневной рассылки (МСК, доступно 07:00–12:00):", reply_markup=notify_time_kb())
-        return
+@CALLBACKS.route("settings:gender")
+async def cb_settings_gender(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, "Выберите пол:", reply_markup=gender_pick_kb())
 
-    if data.startswith("settings:notify:set:"):
-        val = data.split(":", 3)[-1]
-        # Проверяем формат и допустимый диапазон 07:00–12:00 МСК
-        if not re.match(r"^\d{2}:\d{2}$", val):
-            await safe_answer(query, "Неверный формат времени.", show_alert=True)
-            return
-        hh, mm = val.split(":")
-        try:
-            h = int(hh); m = int(mm)
-        except Exception:
-            await safe_answer(query, "Неверный формат времени.", show_alert=True)
-            return
-        # Только целые часы, минутная точность 00, диапазон 07:00–12:00
-        if m != 0 or h < 7 or h > 12:
-            await safe_answer(query, "Можно выбрать время с 07:00 до 12:00 (МСК).", show_alert=True)
-            return
-        async with db_connect() as db:
-            await db.execute("UPDATE users SET notify_time=? WHERE user_id=?", (val, user_id))
-            await db.commit()
-            cur = await db.execute("SELECT zodiac, age, gender, COALESCE(notify_time,'') FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            if row:
-                zodiac, age, gender, notify_time = row
-            else:
-                zodiac, age, gender, notify_time = (None, None, None, DEFAULT_NOTIFY_TIME)
-        await safe_edit(query, f"✅ Время обновлено: <b>{val}</b> (МСК)\n\n" + settings_main_text(zodiac, age, gender, notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
-        return
+@CALLBACKS.route("settings:gender:set:<val>")
+async def cb_settings_gender_set(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, val: str):
+    await set_user_fields(cb.user_id, cb.prof, gender=val)
+    await safe_edit(cb.query, f"✅ Пол обновлён: <b>{val}</b>\n\n" + settings_main_text(cb.prof.zodiac, cb.prof.age, cb.prof.gender, cb.prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
 
-    # --- АДМИНКА ---
-    if data == "admin:test_morning":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        try:
-            await send_morning_digest(context, user_id, chat_id, force=True)
-            await safe_edit(query, "✅ Тестовое утреннее сообщение отправлено.", reply_markup=admin_main_kb()); return
-        except Exception as e:
-            logging.exception("admin:test_morning failed: %s", e)
-            await safe_answer(query, f"Ошибка: {e}", show_alert=True); return
-    if data == "admin:give5":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        await tarot_add_cards(user_id, 5)
-        bal, _, _, _ = await tarot_get_user(user_id)
-        await safe_edit(query, f"✅ Начислено +5 карт. Баланс: <b>{bal}</b>", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:cards_stats":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        async with db_connect() as db:
-            cur = await db.execute("SELECT COUNT(1), COALESCE(SUM(cards_balance),0) FROM tarot_users")
-            row = await cur.fetchone()
-            users_with_tarot = int(row[0] or 0)
-            total_balance = int(row[1] or 0)
-            cur = await db.execute("SELECT COUNT(1) FROM tarot_draws")
-            total_draws = int((await cur.fetchone())[0] or 0)
-            cur = await db.execute("SELECT COUNT(1) FROM tarot_draws WHERE is_free=1")
-            free_draws = int((await cur.fetchone())[0] or 0)
-        paid_draws = max(0, total_draws - free_draws)
-        txt = ("<b>📊 Статистика карт</b>\n"
-               f"Пользователей с профилем Таро: <b>{users_with_tarot}</b>\n"
-               f"Суммарный баланс карт у всех: <b>{total_balance}</b>\n"
-               f"Всего раскладов: <b>{total_draws}</b> (бесплатных: {free_draws}, платных: {paid_draws})")
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:grant_cards":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        context.user_data["await_grant_cards"] = True
-        await safe_edit(query, "Введите: <code>user_id количество</code> (пример: <code>123456789 5</code>)", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:stats_zodiac":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac, COUNT(1) FROM users GROUP BY zodiac ORDER BY COUNT(1) DESC")
-            rows = await cur.fetchall()
-        lines = [f"{ZODIAC_SYMBOL.get(z or '', '✨')} {z or '—'}: <b>{n}</b>" for z, n in rows]
-        txt = "<b>👥 Пользователи по знакам</b>\n" + ("\n".join(lines) if lines else "— нет данных")
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:stats_gender":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        async with db_connect() as db:
-            cur = await db.execute("SELECT COALESCE(gender,'Не указан'), COUNT(1) FROM users GROUP BY COALESCE(gender,'Не указан')")
-            rows = await cur.fetchall()
-        lines = [f"{g}: <b>{n}</b>" for g, n in rows]
-        txt = "<b>🚻 Пользователи по полу</b>\n" + ("\n".join(lines) if lines else "— нет данных")
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:stats_age":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        buckets = [(0,17,'<18'),(18,24,'18–24'),(25,34,'25–34'),(35,44,'35–44'),(45,54,'45–54'),(55,200,'55+')]
-        counts = {label:0 for _,_,label in buckets}; unknown = 0
-        async with db_connect() as db:
-            cur = await db.execute("SELECT age FROM users")
-            async for (age,) in cur:
-                try: a = int(age)
-                except Exception: a = None
-                if not a or a <= 0: unknown += 1; continue
-                for lo,hi,label in buckets:
-                    if lo <= a <= hi: counts[label] += 1; break
-        lines = [f"{k}: <b>{v}</b>" for k,v in counts.items()] + [f"Не указан: <b>{unknown}</b>"]
-        txt = "<b>🎂 Пользователи по возрастам</b>\n" + "\n".join(lines)
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:stats_subs":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        async with db_connect() as db:
-            cur = await db.execute("SELECT COALESCE(consent,0), COUNT(1) FROM users GROUP BY COALESCE(consent,0)")
-            rows = await cur.fetchall()
-        on = sum(n for c,n in rows if int(c)==1)
-        off = sum(n for c,n in rows if int(c)!=1)
-        txt = f"<b>🔔 Подписки</b>\nВключена: <b>{on}</b>\nВыключена: <b>{off}</b>"
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:pred_overview":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-        zodiac = (row[0] if row else None) or "Овен"
-        lines = []
-        for name, _emo in CATEGORY_LIST:
-            s = []
-            for depth in ("short","medium","long"):
-                files = find_prediction_files(zodiac, name, depth)
-                s.append(f"{depth}:{len([p for p in files if p.exists()])}")
-            lines.append(f"{name}: " + ", ".join(s))
-        txt = "<b>📂 Проверка предсказаний</b>\n" + "\n".join(lines)
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:pred_edit":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        await safe_edit(query, "Редактирование из админки в разработке. Изменяйте файлы в <code>predictions_db</code>.", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:test_spread":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        await safe_edit(query, "<b>Выберите расклад (тест)</b>", reply_markup=tarot_spread_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:broadcast":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        context.user_data["await_broadcast"] = True
-        await safe_edit(query, "Отправь одним сообщением текст рассылки. (Тест: отправится только тебе.)", reply_markup=admin_main_kb()); return
-
-    if data == "admin:admins":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        lst = sorted(ADMINS)
-        txt = "<b>👑 Администраторы</b>\n" + "\n".join([f"• <code>{aid}</code>{' (главный)' if aid==MAIN_ADMIN_ID else ''}" for aid in lst])
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    if data == "admin:cleanup":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        await tarot_cleanup_all_photos(context)
-        prev_ids = context.user_data.pop("tarot_album_ids", None)
-        if prev_ids:
-            for mid in prev_ids:
-                try: await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                except Exception: pass
-        await safe_edit(query, "✅ Временные сообщения/фото очищены.", reply_markup=admin_main_kb()); return
-
-    if data == "admin:restart":
-        if not is_admin(user_id):
-            await safe_answer(query, "Только для админов", show_alert=True); return
-        txt = ("<b>🔄 Перезапуск</b>\n"
-               "Локально: <code>Ctrl+C</code> и снова <code>python3 bot.py</code>.\n"
-               "Если сервис: перезапусти unit в supervisor/systemd.")
-        await safe_edit(query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML); return
-
-    # Главное меню
-    if data == "ui:menu":
-        # выходим из режимов ожидания админки
-        context.user_data.pop("await_grant_cards", None)
-        context.user_data.pop("await_broadcast", None)
-        await try_delete_last_prediction(context, user_id)
-        await tarot_cleanup_about_photo(context)
-        await ui_show(context, chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
-        return
+@CALLBACKS.route("settings:notify")
+async def cb_settings_notify(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, "Выберите время для ежедневной рассылки (МСК, доступно 07:00–12:00):", reply_markup=notify_time_kb())
 
-    # Категории
-    if data == "catpred:open":
-        context.user_data.pop("await_grant_cards", None)
-        context.user_data.pop("await_broadcast", None)
-        await try_delete_last_prediction(context, user_id)
-        await safe_edit(query, "Выберите категорию:", reply_markup=categories_inline_kb())
+@CALLBACKS.route("settings:notify:set:<val>")
+async def cb_settings_notify_set(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, val: str):
+    # Проверяем формат и допустимый диапазон 07:00–12:00 МСК
+    if not re.match(r"^\d{2}:\d{2}$", val):
+        await safe_answer(cb.query, "Неверный формат времени.", show_alert=True)
         return
-
-    if data.startswith("catpred:"):
-        _, cat = data.split(":", 1)
-        await safe_edit(query, f"Категория: <b>{cat}</b>\nВыберите формат:", reply_markup=depth_inline_kb(cat), parse_mode=ParseMode.HTML)
+    hh, mm = val.split(":")
+    try:
+        h = int(hh); m = int(mm)
+    except Exception:
+        await safe_answer(cb.query, "Неверный формат времени.", show_alert=True)
         return
-
-    if data.startswith("catdepth:"):
-        _, cat, depth = data.split(":", 2)
-        # Проверим знак зодиака
-        async with db_connect() as db:
-            cur = await db.execute("SELECT zodiac FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            zodiac = row[0] if row else None
-        if not zodiac:
-            await safe_edit(query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
-            return
-        # Подготовим анимацию 5–7 сек с картинкой знака
-        await try_delete_last_prediction(context, user_id)
-        # Подготовим путь к картинке знака (покажем её после «анимации»)
-        zimg = _zodiac_img_path(zodiac)
-        # Анимация прогресса
-        stages, total = build_pred_progress()
-        per_step = max(2, total // max(1, len(stages)))
-        try:
-            prog_msg = await context.bot.send_message(chat_id=chat_id, text=stages[0])
-        except Exception:
-            prog_msg = None
-        remaining = total
-        await asyncio.sleep(per_step); remaining -= per_step
-        for s in stages[1:]:
-            try:
-                if prog_msg:
-                    await context.bot.edit_message_text(chat_id=chat_id, message_id=prog_msg.message_id, text=s)
-                else:
-                    prog_msg = await context.bot.send_message(chat_id=chat_id, text=s)
-            except Exception:
-                pass
-            await asyncio.sleep(per_step); remaining -= per_step
-        if remaining > 0:
-            await asyncio.sleep(remaining)
-        # Удалим прогресс
-        if prog_msg:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=prog_msg.message_id)
-            except Exception:
-                pass
-        # Отправим картинку знака сверху (если есть)
-        if zimg and zimg.exists():
-            try:
-                with zimg.open("rb") as f:
-                    ph2 = await context.bot.send_photo(chat_id=chat_id, photo=f)
-                context.user_data["last_pred_photo"] = {"chat_id": chat_id, "message_id": ph2.message_id}
-            except Exception:
-                pass
-        # Теперь текст предсказания с нижней кнопкой "Меню"
-        text = pick_prediction(zodiac, cat, depth)
-        card = build_category_card(zodiac, cat)
-        pred_kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]])
-        sent = await context.bot.send_message(chat_id=chat_id, text=card + "\n" + text, parse_mode=ParseMode.HTML, reply_markup=pred_kb)
-        context.user_data["last_pred_msg"] = {"chat_id": chat_id, "message_id": sent.message_id}
-        # Обновим панель выбора формата ниже
-        await safe_edit(query, f"Категория: <b>{cat}</b>\nФормат: <b>{'Короткий' if depth=='short' else ('Средний' if depth=='medium' else 'Полный')}</b>", reply_markup=depth_inline_kb(cat), parse_mode=ParseMode.HTML)
+    # Только целые часы, минутная точность 00, диапазон 07:00–12:00
+    if m != 0 or h < 7 or h > 12:
+        await safe_answer(cb.query, "Можно выбрать время с 07:00 до 12:00 (МСК).", show_alert=True)
         return
+    await set_user_fields(cb.user_id, cb.prof, notify_time=val)
+    await safe_edit(cb.query, f"✅ Время обновлено: <b>{val}</b> (МСК)\n\n" + settings_main_text(cb.prof.zodiac, cb.prof.age, cb.prof.gender, cb.prof.notify_time), reply_markup=settings_main_kb(), parse_mode=ParseMode.HTML)
 
-    if data.startswith("setz:"):
-        zodiac = data.split(":",1)[1]
-        async with db_connect() as db:
-            await db.execute("UPDATE users SET zodiac=? WHERE user_id=?", (zodiac, user_id))
-            await db.commit()
-            cur = await db.execute("SELECT COALESCE(consent,0) FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            consent = int(row[0]) if row else 0
-        if consent:
-            await ui_show(context, chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
-        else:
-            await safe_edit(query, f"Ваш знак сохранён: <b>{ZODIAC_SYMBOL.get(zodiac,'✨')} {zodiac}</b>\n" + await build_consent_text(user_id), reply_markup=consent_inline_kb(), parse_mode=ParseMode.HTML)
+# --- АДМИНКА ---
+@CALLBACKS.route("admin:test_morning", admin=True)
+async def cb_admin_test_morning(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    try:
+        await send_morning_digest(context, cb.user_id, cb.chat_id, force=True)
+        await safe_edit(cb.query, "✅ Тестовое утреннее сообщение отправлено.", reply_markup=admin_main_kb()); return
+    except Exception as e:
+        logging.exception("admin:test_morning failed: %s", e)
+        await safe_answer(cb.query, f"Ошибка: {e}", show_alert=True); return
+
+@CALLBACKS.route("admin:give5", admin=True)
+async def cb_admin_give5(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_add_cards(cb.user_id, 5, "grant", cb.user_id)
+    bal, _, _, _ = await tarot_get_user(cb.user_id)
+    await safe_edit(cb.query, f"✅ Начислено +5 карт. Баланс: <b>{bal}</b>", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:cards_stats", admin=True)
+async def cb_admin_cards_stats(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    c = await stats_counters()
+    total_draws, free_draws = c.get("draws", 0), c.get("draws_free", 0)
+    paid_draws = max(0, total_draws - free_draws)
+    txt = ("<b>📊 Статистика карт</b>\n"
+           f"Пользователей с профилем Таро: <b>{c.get('tarot_users', 0)}</b>\n"
+           f"Суммарный баланс карт у всех: <b>{c.get('cards_balance', 0)}</b>\n"
+           f"Всего раскладов: <b>{total_draws}</b> (бесплатных: {free_draws}, платных: {paid_draws})")
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:reconcile", admin=True)
+async def cb_admin_reconcile(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    total, rows = await tarot_reconcile()
+    if not total:
+        txt = "🧾 <b>Сверка баланса</b>\nБалансы всех пользователей совпадают с журналом."
+    else:
+        lines = [f"<code>{uid}</code>: баланс {bal}, по журналу {led}" for uid, bal, led in rows]
+        more = f"\n… и ещё {total - len(rows)}" if total > len(rows) else ""
+        txt = f"🧾 <b>Сверка баланса</b>\nРасхождений: <b>{total}</b>\n" + "\n".join(lines) + more
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:grant_cards", admin=True)
+async def cb_admin_grant_cards(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    context.user_data["await_grant_cards"] = True
+    await safe_edit(cb.query, "Введите: <code>user_id количество</code> (пример: <code>123456789 5</code>)", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+def _stats_slice(c: dict, prefix: str) -> dict[str, int]:
+    return {k[len(prefix):]: n for k, n in c.items() if k.startswith(prefix) and n}
+
+@CALLBACKS.route("admin:stats_zodiac", admin=True)
+async def cb_admin_stats_zodiac(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    rows = sorted(_stats_slice(await stats_counters(), "zodiac:").items(), key=lambda kv: -kv[1])
+    lines = [f"{ZODIAC_SYMBOL.get(z, '✨')} {z or '—'}: <b>{n}</b>" for z, n in rows]
+    txt = "<b>👥 Пользователи по знакам</b>\n" + ("\n".join(lines) if lines else "— нет данных")
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:stats_gender", admin=True)
+async def cb_admin_stats_gender(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    rows = _stats_slice(await stats_counters(), "gender:")
+    lines = [f"{g or 'Не указан'}: <b>{n}</b>" for g, n in rows.items()]
+    txt = "<b>🚻 Пользователи по полу</b>\n" + ("\n".join(lines) if lines else "— нет данных")
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:stats_age", admin=True)
+async def cb_admin_stats_age(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    ages = _stats_slice(await stats_counters(), "age:")
+    lines = [f"{label}: <b>{ages.get(label, 0)}</b>" for _, label in STATS_AGE_BUCKETS] + [f"Не указан: <b>{ages.get('', 0)}</b>"]
+    txt = "<b>🎂 Пользователи по возрастам</b>\n" + "\n".join(lines)
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:stats_subs", admin=True)
+async def cb_admin_stats_subs(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    subs = _stats_slice(await stats_counters(), "subs:")
+    txt = f"<b>🔔 Подписки</b>\nВключена: <b>{subs.get('on', 0)}</b>\nВыключена: <b>{subs.get('off', 0)}</b>"
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:stats_rebuild", admin=True)
+async def cb_admin_stats_rebuild(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    diff = await stats_rebuild()
+    if not diff:
+        txt = "♻️ <b>Счётчики статистики</b>\nПересчитаны, расхождений с таблицами нет."
+    else:
+        lines = [f"<code>{k}</code>: было {old}, стало {new}" for k, (old, new) in sorted(diff.items())[:20]]
+        txt = f"♻️ <b>Счётчики статистики</b>\nПересчитаны, исправлено расхождений: <b>{len(diff)}</b>\n" + "\n".join(lines)
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:pred_overview", admin=True)
+async def cb_admin_pred_overview(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    zodiac = cb.prof.zodiac or "Овен"
+    lines = []
+    for name, _emo in CATEGORY_LIST:
+        s = []
+        for depth in ("short","medium","long"):
+            files = find_prediction_files(zodiac, name, depth)
+            s.append(f"{depth}:{len([p for p in files if p.exists()])}")
+        lines.append(f"{name}: " + ", ".join(s))
+    txt = "<b>📂 Проверка предсказаний</b>\n" + "\n".join(lines)
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:pred_edit", admin=True)
+async def cb_admin_pred_edit(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, "Редактирование из админки в разработке. Изменяйте файлы в <code>predictions_db</code>.", reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:test_spread", admin=True)
+async def cb_admin_test_spread(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await safe_edit(cb.query, "<b>Выберите расклад (тест)</b>", reply_markup=tarot_spread_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:broadcast", admin=True)
+async def cb_admin_broadcast(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    context.user_data["await_broadcast"] = True
+    await safe_edit(cb.query, "Отправь одним сообщением текст рассылки. Он уйдёт всем подписчикам в фоне.", reply_markup=admin_main_kb())
+
+@CALLBACKS.route("admin:bc_stop:<job_id>", admin=True)
+async def cb_admin_bc_stop(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, job_id: str):
+    try:
+        job_id = int(job_id)
+    except ValueError:
         return
-
-    if data == "consent:yes":
-        async with db_connect() as db:
-            # Set consent on and initialize notify_time to default if it's empty
-            await db.execute("UPDATE users SET consent=1 WHERE user_id=?", (user_id,))
-            cur = await db.execute("SELECT COALESCE(notify_time,''), COALESCE(zodiac,'') FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
-            current_time = (row[0] or '').strip() if row else ''
-            zodiac = str(row[1]) if row and row[1] else ''
-            if not current_time:
-                await db.execute("UPDATE users SET notify_time=? WHERE user_id=?", (DEFAULT_NOTIFY_TIME, user_id))
-            await db.commit()
-        if zodiac:
-            await ui_show(context, chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
-        else:
-            await safe_edit(query, "Отлично! Теперь выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
+    await BROADCASTS.cancel(job_id)
+    await safe_answer(cb.query, f"Рассылка #{job_id} остановлена")
+
+@CALLBACKS.route("admin:admins", admin=True)
+async def cb_admin_admins(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    lst = sorted(ADMINS)
+    txt = "<b>👑 Администраторы</b>\n" + "\n".join([f"• <code>{aid}</code>{' (главный)' if aid==MAIN_ADMIN_ID else ''}" for aid in lst])
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("admin:cleanup", admin=True)
+async def cb_admin_cleanup(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_all_photos(context)
+    CLEANUP.add(cb.chat_id, *(context.user_data.pop("tarot_album_ids", None) or ()))
+    await safe_edit(cb.query, "✅ Временные сообщения/фото очищены.", reply_markup=admin_main_kb())
+
+@CALLBACKS.route("admin:restart", admin=True)
+async def cb_admin_restart(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    txt = ("<b>🔄 Перезапуск</b>\n"
+           "Локально: <code>Ctrl+C</code> и снова <code>python3 bot.py</code>.\n"
+           "Если сервис: перезапусти unit в supervisor/systemd.")
+    await safe_edit(cb.query, txt, reply_markup=admin_main_kb(), parse_mode=ParseMode.HTML)
+
+# Главное меню
+@CALLBACKS.route("ui:menu")
+async def cb_ui_menu(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    # выходим из режимов ожидания админки
+    context.user_data.pop("await_grant_cards", None)
+    context.user_data.pop("await_broadcast", None)
+    await try_delete_last_prediction(context, cb.user_id)
+    await tarot_cleanup_about_photo(context)
+    await ui_show(context, cb.chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
+
+# Категории
+@CALLBACKS.route("catpred:open")
+async def cb_catpred_open(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    context.user_data.pop("await_grant_cards", None)
+    context.user_data.pop("await_broadcast", None)
+    await try_delete_last_prediction(context, cb.user_id)
+    await safe_edit(cb.query, "Выберите категорию:", reply_markup=categories_inline_kb())
+
+@CALLBACKS.route("catpred:<cat>")
+async def cb_catpred(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, cat: str):
+    await safe_edit(cb.query, f"Категория: <b>{cat}</b>\nВыберите формат:", reply_markup=depth_inline_kb(cat), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("catdepth:<cat>:<depth>")
+async def cb_catdepth(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, cat: str, depth: str):
+    # Проверим знак зодиака
+    zodiac = cb.prof.zodiac
+    if not zodiac:
+        await safe_edit(cb.query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
         return
+    # Подготовим анимацию 5–7 сек с картинкой знака
+    await try_delete_last_prediction(context, cb.user_id)
+    # Подготовим путь к картинке знака (покажем её после «анимации»)
+    zimg = _zodiac_img_path(zodiac)
+    body = DAILY.category_body(zodiac, cat, depth)
+
+    async def _reveal():
+        # Картинка знака с предсказанием в подписи и нижней кнопкой "Меню"
+        pred_kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="ui:menu")]])
+        photo = zimg if zimg and zimg.exists() else None
+        sent, ph2 = await send_card(context.bot, cb.chat_id, photo, body, reply_markup=pred_kb)
+        context.user_data["last_pred_msg"] = {"chat_id": cb.chat_id, "message_id": sent.message_id}
+        if ph2 is not None:   # текст не влез в подпись — фото ушло отдельным сообщением
+            context.user_data["last_pred_photo"] = {"chat_id": cb.chat_id, "message_id": ph2.message_id}
+        # Обновим панель выбора формата ниже
+        await safe_edit(cb.query, f"Категория: <b>{cat}</b>\nФормат: <b>{'Короткий' if depth=='short' else ('Средний' if depth=='medium' else 'Полный')}</b>", reply_markup=depth_inline_kb(cat), parse_mode=ParseMode.HTML)
 
-    # --- ТАРО ---
+    # Анимация прогресса — задачами JobQueue, хендлер не ждёт
+    stages, total = build_pred_progress()
+    await ANIMATIONS.run(context, cb.chat_id, stages, total, _reveal)
 
-    if data == "noop":
-        # ничего не делаем, просто закрываем спиннер
-        return
+@CALLBACKS.route("setz:<zodiac>")
+async def cb_setz(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, zodiac: str):
+    await set_user_fields(cb.user_id, cb.prof, zodiac=zodiac)
+    if cb.prof.consent:
+        await ui_show(context, cb.chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
+    else:
+        await safe_edit(cb.query, f"Ваш знак сохранён: <b>{ZODIAC_SYMBOL.get(zodiac,'✨')} {zodiac}</b>\n" + await build_consent_text(cb.user_id), reply_markup=consent_inline_kb(), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("consent:yes")
+async def cb_consent_yes(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    async def _tx(db):
+        # Set consent on and initialize notify_time to default if it's empty
+        await db.execute("UPDATE users SET consent=1 WHERE user_id=?", (cb.user_id,))
+        cur = await db.execute("SELECT COALESCE(notify_time,''), COALESCE(zodiac,'') FROM users WHERE user_id=?", (cb.user_id,))
+        row = await cur.fetchone()
+        current_time = (row[0] or '').strip() if row else ''
+        if not current_time:
+            await db.execute("UPDATE users SET notify_time=? WHERE user_id=?", (DEFAULT_NOTIFY_TIME, cb.user_id))
+            current_time = DEFAULT_NOTIFY_TIME
+        return current_time, (str(row[1]) if row and row[1] else '')
+    notify_time, zodiac = await DB.write(_tx)
+    PROFILES.update(cb.user_id, consent=1, notify_time=notify_time)
+    if zodiac:
+        await ui_show(context, cb.chat_id, "🏠 Главное меню", reply_markup=main_menu_kb())
+    else:
+        await safe_edit(cb.query, "Отлично! Теперь выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
+
+# --- ТАРО ---
+@CALLBACKS.route("noop")
+async def cb_noop(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    # ничего не делаем, просто закрываем спиннер
+    pass
+
+@CALLBACKS.route("tarot:open")
+async def cb_tarot_open(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    context.user_data.pop("await_grant_cards", None)
+    context.user_data.pop("await_broadcast", None)
+    await tarot_cleanup_about_photo(context)
+    bal, tar, _, _ = await tarot_get_user(cb.user_id)
+    kb = await tarot_main_kb(cb.user_id, bal, tar)
+    await safe_edit(cb.query, tarot_intro_text(cb.user_id, bal, tar), reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:howto")
+async def cb_tarot_howto(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_about_photo(context)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+        [InlineKeyboardButton("👤 Профиль", callback_data="tarot:profile")],
+    ])
+    await safe_edit(cb.query, tarot_howto_text(), reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:buy")
+async def cb_tarot_buy(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_about_photo(context)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("+5 карт — бесплатно (тест)", callback_data="tarot:buy:p5")],
+        [InlineKeyboardButton("+15 карт — бесплатно (тест)", callback_data="tarot:buy:p15")],
+        [InlineKeyboardButton("+50 карт — бесплатно (тест)", callback_data="tarot:buy:p50")],
+        [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+    ])
+    await safe_edit(
+        cb.query,
+        "<b>🛒 Покупка карт</b>\n\n<b>Тестовый режим:</b> пока все пакеты бесплатные. Выберите нужный — и мы мгновенно начислим карты на баланс.",
+        reply_markup=kb,
+        parse_mode=ParseMode.HTML
+    )
 
-    if data == "tarot:open":
-        context.user_data.pop("await_grant_cards", None)
-        context.user_data.pop("await_broadcast", None)
-        await tarot_cleanup_about_photo(context)
-        bal, tar, _, _ = await tarot_get_user(user_id)
-        kb = await tarot_main_kb(user_id, bal, tar)
-        await safe_edit(query, tarot_intro_text(user_id, bal, tar), reply_markup=kb, parse_mode=ParseMode.HTML)
-        return
+@CALLBACKS.route("tarot:buy:p5")
+async def cb_tarot_buy_p5(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_add_cards(cb.user_id, 5, "purchase", "p5")
+    bal, tar, last, used = await tarot_get_user(cb.user_id)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+        [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
+    ])
+    await safe_edit(cb.query, f"✅ Начислено: <b>+5</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
 
-    if data == "tarot:howto":
-        await tarot_cleanup_about_photo(context)
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-            [InlineKeyboardButton("👤 Профиль", callback_data="tarot:profile")],
-        ])
-        await safe_edit(query, tarot_howto_text(), reply_markup=kb, parse_mode=ParseMode.HTML)
-        return
+@CALLBACKS.route("tarot:buy:p15")
+async def cb_tarot_buy_p15(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_add_cards(cb.user_id, 15, "purchase", "p15")
+    bal, tar, last, used = await tarot_get_user(cb.user_id)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+        [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
+    ])
+    await safe_edit(cb.query, f"✅ Начислено: <b>+15</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
 
-    if data == "tarot:buy":
-        await tarot_cleanup_about_photo(context)
+@CALLBACKS.route("tarot:buy:p50")
+async def cb_tarot_buy_p50(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_add_cards(cb.user_id, 50, "purchase", "p50")
+    bal, tar, last, used = await tarot_get_user(cb.user_id)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+        [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
+    ])
+    await safe_edit(cb.query, f"✅ Начислено: <b>+50</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:ref")
+async def cb_tarot_ref(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_about_photo(context)
+    me = await context.bot.get_me()
+    ref_link = f"https://t.me/{me.username}?start=ref{cb.user_id}"
+    txt = (
+        "<b>👥 Рефералка</b>\n"
+        "Приглашай друзей — за каждого активного друга +1 карта на баланс.\n\n"
+        f"Твоя ссылка: {ref_link}\n\n"
+        "Как это работает: друг заходит по ссылке и запускает бота. После первого действия мы начислим 1 карту на твой баланс."
+    )
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")]])
+    await safe_edit(cb.query, txt, reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:profile")
+async def cb_tarot_profile(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_about_photo(context)
+    bal, tar, last, used = await tarot_get_user(cb.user_id)
+    txt = (
+        "<b>👤 Профиль Таро</b>\n"
+        f"Баланс: <b>{bal}</b>\n"
+        f"Таролог: <b>{_label_for_tarolog(tar)}</b>\n"
+        f"Бесплатных сегодня: {max(0, TAROT_DAILY_FREE - (used if last == today_str() else 0))}/{TAROT_DAILY_FREE}"
+    )
+    await safe_edit(cb.query, txt, reply_markup=tarot_profile_kb(bal), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:choose")
+async def cb_tarot_choose(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    await tarot_cleanup_about_photo(context)
+    bal, tar, _, _ = await tarot_get_user(cb.user_id)
+    await safe_edit(cb.query, "<b>Выбери таролога</b>", reply_markup=tarot_pick_kb(tar), parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:about:<code>")
+async def cb_tarot_about(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, code: str):
+    label = _label_for_tarolog(code)
+    bio = TAROLOG_BIO.get(code, "Описание скоро появится.")
+    desc = TAROLOG_DESC.get(code, "")
+    caption = f"<b>{label}</b>\n{bio}\n\n<i>Стиль:</i> {desc}"
+
+    # Определим кнопки «выбрать/текущий»
+    _, current, _, _ = await tarot_get_user(cb.user_id)
+    if _norm_tarolog(current) == _norm_tarolog(code):
         kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("+5 карт — бесплатно (тест)", callback_data="tarot:buy:p5")],
-            [InlineKeyboardButton("+15 карт — бесплатно (тест)", callback_data="tarot:buy:p15")],
-            [InlineKeyboardButton("+50 карт — бесплатно (тест)", callback_data="tarot:buy:p50")],
-            [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+            [InlineKeyboardButton("✅ Текущий таролог", callback_data="noop")],
+            [InlineKeyboardButton("⬅️ К выбору таролога", callback_data="tarot:choose")],
         ])
-        await safe_edit(
-            query,
-            "<b>🛒 Покупка карт</b>\n\n<b>Тестовый режим:</b> пока все пакеты бесплатные. Выберите нужный — и мы мгновенно начислим карты на баланс.",
-            reply_markup=kb,
-            parse_mode=ParseMode.HTML
-        )
-        return
-
-    if data == "tarot:buy:p5":
-        await tarot_add_cards(user_id, 5)
-        bal, tar, last, used = await tarot_get_user(user_id)
+    else:
         kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-            [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
+            [InlineKeyboardButton("✅ Выбрать этого таролога", callback_data=f"tarot:set_tarolog:{code}")],
+            [InlineKeyboardButton("⬅️ К выбору таролога", callback_data="tarot:choose")],
         ])
-        await safe_edit(query, f"✅ Начислено: <b>+5</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
-        return
 
-    if data == "tarot:buy:p15":
-        await tarot_add_cards(user_id, 15)
-        bal, tar, last, used = await tarot_get_user(user_id)
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-            [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
-        ])
-        await safe_edit(query, f"✅ Начислено: <b>+15</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
-        return
+    # Удаляем любые предыдущие фото (если были)
+    await tarot_cleanup_all_photos(context)
+
+    # Старое UI-сообщение уходит в конце апдейта: порядок новых — СНАЧАЛА фото, НИЖЕ текст
+    CLEANUP.add(cb.chat_id, cb.query.message.message_id)
+
+    # Сначала отправляем фото (если есть) — оно окажется ВЫШЕ (старше) текста
+    img = _tarot_img_path(code)
+    if img and img.exists():
+        try:
+            photo_msg = await MEDIA.send_photo(context.bot, cb.chat_id, img)
+            # Сохраняем в обоих пространствах (на случай смены экрана)
+            context.user_data["tarot_about_photo"] = {"chat_id": cb.chat_id, "message_id": photo_msg.message_id}
+            context.chat_data["tarot_photo"] = {"chat_id": cb.chat_id, "message_id": photo_msg.message_id}
+        except Exception:
+            pass
 
-    if data == "tarot:buy:p50":
-        await tarot_add_cards(user_id, 50)
-        bal, tar, last, used = await tarot_get_user(user_id)
+    # Затем отправляем текст с кнопками — он будет НИЖЕ фото
+    text_msg = await context.bot.send_message(chat_id=cb.chat_id, text=caption, reply_markup=kb, parse_mode=ParseMode.HTML)
+    # фиксируем как текущее UI-сообщение, чтобы другие экраны могли его корректно обновлять/удалять
+    context.chat_data["ui_mid"] = text_msg.message_id
+
+@CALLBACKS.route("tarot:set_tarolog:<code>")
+async def cb_tarot_set_tarolog(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, code: str):
+    await tarot_cleanup_about_photo(context)
+    await tarot_set_tarolog(cb.user_id, code)
+    bal, tar, _, _ = await tarot_get_user(cb.user_id)
+    kb = await tarot_main_kb(cb.user_id, bal, tar)
+    await safe_edit(cb.query, f"✅ Таролог выбран: <b>{_label_for_tarolog(tar)}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@CALLBACKS.route("tarot:draw_entry")
+async def cb_tarot_draw_entry(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx):
+    # Перед карточками попросим выбрать расклад, и убедимся, что у пользователя задан знак
+    zodiac = await get_user_zodiac(cb.user_id)
+    if not zodiac:
+        await safe_edit(cb.query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
+        return
+    # Проверим доступность попыток: бесплатная или платная
+    bal, tar, last, used = await tarot_get_user(cb.user_id)
+    free_left = max(0, TAROT_DAILY_FREE - (used if last == today_str() else 0))
+    if free_left <= 0 and bal <= 0:
         kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🛒 Купить карты", callback_data="tarot:buy")],
             [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-            [InlineKeyboardButton("🛒 Ещё пакеты", callback_data="tarot:buy")],
         ])
-        await safe_edit(query, f"✅ Начислено: <b>+50</b> карт.\nТекущий баланс: <b>{bal}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
+        await safe_edit(cb.query, "<b>Нет доступных попыток</b>\n\nСегодня бесплатные попытки израсходованы, а баланс равен нулю. В тестовом режиме пополнить можно бесплатно — выбери пакет в магазине.", reply_markup=kb, parse_mode=ParseMode.HTML)
         return
+    await safe_edit(cb.query, "<b>Выберите расклад</b>", reply_markup=tarot_spread_kb(), parse_mode=ParseMode.HTML)
 
-    if data == "tarot:ref":
-        await tarot_cleanup_about_photo(context)
-        me = await context.bot.get_me()
-        ref_link = f"https://t.me/{me.username}?start=ref{user_id}"
-        txt = (
-            "<b>👥 Рефералка</b>\n"
-            "Приглашай друзей — за каждого активного друга +1 карта на баланс.\n\n"
-            f"Твоя ссылка: {ref_link}\n\n"
-            "Как это работает: друг заходит по ссылке и запускает бота. После первого действия мы начислим 1 карту на твой баланс."
-        )
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")]])
-        await safe_edit(query, txt, reply_markup=kb, parse_mode=ParseMode.HTML)
-        return
-
-    if data == "tarot:profile":
-        await tarot_cleanup_about_photo(context)
-        bal, tar, last, used = await tarot_get_user(user_id)
-        txt = (
-            "<b>👤 Профиль Таро</b>\n"
-            f"Баланс: <b>{bal}</b>\n"
-            f"Таролог: <b>{_label_for_tarolog(tar)}</b>\n"
-            f"Бесплатных сегодня: {max(0, TAROT_DAILY_FREE - (used if last == today_str() else 0))}/{TAROT_DAILY_FREE}"
-        )
-        await safe_edit(query, txt, reply_markup=tarot_profile_kb(bal), parse_mode=ParseMode.HTML)
-        return
-
-    if data == "tarot:choose":
-        await tarot_cleanup_about_photo(context)
-        bal, tar, _, _ = await tarot_get_user(user_id)
-        await safe_edit(query, "<b>Выбери таролога</b>", reply_markup=tarot_pick_kb(tar), parse_mode=ParseMode.HTML)
+@CALLBACKS.route("tarot:draw:<spread_key>")
+async def cb_tarot_draw(context: ContextTypes.DEFAULT_TYPE, cb: CallbackCtx, spread_key: str):
+    # Проверим знак зодиака заранее
+    zodiac = await get_user_zodiac(cb.user_id)
+    if not zodiac:
+        await safe_edit(cb.query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
         return
 
-    if data.startswith("tarot:about:"):
-        code = data.split(":", 2)[-1]
-        label = _label_for_tarolog(code)
-        bio = TAROLOG_BIO.get(code, "Описание скоро появится.")
-        desc = TAROLOG_DESC.get(code, "")
-        caption = f"<b>{label}</b>\n{bio}\n\n<i>Стиль:</i> {desc}"
-
-        # Определим кнопки «выбрать/текущий»
-        _, current, _, _ = await tarot_get_user(user_id)
-        if _norm_tarolog(current) == _norm_tarolog(code):
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Текущий таролог", callback_data="noop")],
-                [InlineKeyboardButton("⬅️ К выбору таролога", callback_data="tarot:choose")],
-            ])
-        else:
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Выбрать этого таролога", callback_data=f"tarot:set_tarolog:{code}")],
-                [InlineKeyboardButton("⬅️ К выбору таролога", callback_data="tarot:choose")],
-            ])
-
-        # Удаляем любые предыдущие фото (если были)
-        await tarot_cleanup_all_photos(context)
-
-        # Удаляем старое UI-сообщение, чтобы порядок был: СНАЧАЛА фото, НИЖЕ текст
+    # Защита от двойного нажатия: если уже идёт расклад — игнорируем
+    if context.user_data.get("tarot_busy"):
         try:
-            await query.message.delete()
+            await safe_answer(cb.query, "Идёт расклад…")
         except Exception:
             pass
+        return
+    context.user_data["tarot_busy"] = True
 
-        # Сначала отправляем фото (если есть) — оно окажется ВЫШЕ (старше) текста
-        img = _tarot_img_path(code)
-        if img and img.exists():
-            try:
-                with img.open("rb") as f:
-                    photo_msg = await context.bot.send_photo(chat_id=chat_id, photo=f)
-                # Сохраняем в обоих пространствах (на случай смены экрана)
-                context.user_data["tarot_about_photo"] = {"chat_id": chat_id, "message_id": photo_msg.message_id}
-                context.chat_data["tarot_photo"] = {"chat_id": chat_id, "message_id": photo_msg.message_id}
-            except Exception:
-                pass
+    # Сколько карт нужно для выбранного расклада
+    positions = TAROT_SPREADS.get(spread_key, {}).get("positions", [])
+    cards_needed = len(positions) if positions else 1
 
-        # Затем отправляем текст с кнопками — он будет НИЖЕ фото
-        text_msg = await context.bot.send_message(chat_id=chat_id, text=caption, reply_markup=kb, parse_mode=ParseMode.HTML)
-        # фиксируем как текущее UI-сообщение, чтобы другие экраны могли его корректно обновлять/удалять
-        context.chat_data["ui_mid"] = text_msg.message_id
-        return
+    # Текущий баланс и доступные бесплатные на сегодня
+    bal, tar_tmp, last, used = await tarot_get_user(cb.user_id)
+    free_left = TAROT_DAILY_FREE - (used if last == today_str() else 0)
+    free_left = max(0, free_left)
 
-    if data.startswith("tarot:set_tarolog:"):
-        code = data.split(":", 2)[-1]
-        await tarot_cleanup_about_photo(context)
-        await tarot_set_tarolog(user_id, code)
-        bal, tar, _, _ = await tarot_get_user(user_id)
-        kb = await tarot_main_kb(user_id, bal, tar)
-        await safe_edit(query, f"✅ Таролог выбран: <b>{_label_for_tarolog(tar)}</b>", reply_markup=kb, parse_mode=ParseMode.HTML)
+    # Проверка достаточности ресурсов
+    total_avail = free_left + bal
+    if total_avail < cards_needed:
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🛒 Купить карты", callback_data="tarot:buy")],
+            [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
+        ])
+        await safe_edit(
+            cb.query,
+            f"<b>Недостаточно карт</b>\n\nДля этого расклада нужно: <b>{cards_needed}</b>. Доступно: <b>{total_avail}</b> (бесплатные сегодня: {free_left}, на балансе: {bal}).",
+            reply_markup=kb,
+            parse_mode=ParseMode.HTML,
+        )
+        context.user_data.pop("tarot_busy", None)
         return
 
-    if data == "tarot:draw_entry":
-        # Перед карточками попросим выбрать расклад, и убедимся, что у пользователя задан знак
-        zodiac = await get_user_zodiac(user_id)
-        if not zodiac:
-            await safe_edit(query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
-            return
-        # Проверим доступность попыток: бесплатная или платная
-        bal, tar, last, used = await tarot_get_user(user_id)
-        free_left = max(0, TAROT_DAILY_FREE - (used if last == today_str() else 0))
-        if free_left <= 0 and bal <= 0:
+    # Резервируем: сначала бесплатную (если есть), затем платные на остаток
+    use_free = 1 if (free_left > 0 and cards_needed > 0) else 0
+    paid_need = cards_needed - use_free
+
+    if paid_need > 0:
+        ok_paid = await tarot_consume_paid_cards(cb.user_id, paid_need, spread_key)
+        if not ok_paid:
+            # гонка: кто-то потратил карты; просим пополнить
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("🛒 Купить карты", callback_data="tarot:buy")],
                 [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
             ])
-            await safe_edit(query, "<b>Нет доступных попыток</b>\n\nСегодня бесплатные попытки израсходованы, а баланс равен нулю. В тестовом режиме пополнить можно бесплатно — выбери пакет в магазине.", reply_markup=kb, parse_mode=ParseMode.HTML)
+            await safe_edit(cb.query, "<b>Недостаточно карт</b>\n\nПохоже, баланс изменился. Пополни карты и попробуй снова.", reply_markup=kb, parse_mode=ParseMode.HTML)
+            context.user_data.pop("tarot_busy", None)
             return
-        await safe_edit(query, "<b>Выберите расклад</b>", reply_markup=tarot_spread_kb(), parse_mode=ParseMode.HTML)
-        return
 
-    if data.startswith("tarot:draw:"):
-        _, _, spread_key = data.split(":", 2)
+    is_free_used = False
+    if use_free:
+        # Списываем бесплатную попытку (их максимум 1 в день)
+        is_free_used = await tarot_try_use_free(cb.user_id)
+        # Если по какой-то причине не удалось — это не критично, бесплатная просто не зачлась.
 
-        # Проверим знак зодиака заранее
-        zodiac = await get_user_zodiac(user_id)
-        if not zodiac:
-            await safe_edit(query, "Сначала выберите ваш знак зодиака:", reply_markup=zodiac_pick_kb())
-            return
+    # Прогресс-этапы перед показом расклада
+    await tarot_cleanup_all_photos(context)
+    CLEANUP.add(cb.chat_id, cb.query.message.message_id)
 
-        # Сколько карт нужно для выбранного расклада
-        positions = TAROT_SPREADS.get(spread_key, {}).get("positions", [])
-        cards_needed = len(positions) if positions else 1
+    # Покажем фото текущего таролога СРАЗУ (оно будет выше всех дальнейших сообщений прогресса и результата)
+    _, tar, _, _ = await tarot_get_user(cb.user_id)
+    img = _tarot_img_path(_norm_tarolog(tar) or "")
+    if img and img.exists():
+        try:
+            photo_msg = await MEDIA.send_photo(context.bot, cb.chat_id, img)
+            context.user_data["tarot_about_photo"] = {"chat_id": cb.chat_id, "message_id": photo_msg.message_id}
+            context.chat_data["tarot_photo"] = {"chat_id": cb.chat_id, "message_id": photo_msg.message_id}
+        except Exception:
+            pass
 
-        # Текущий баланс и доступные бесплатные на сегодня
-        bal, tar_tmp, last, used = await tarot_get_user(user_id)
-        free_left = TAROT_DAILY_FREE - (used if last == today_str() else 0)
-        free_left = max(0, free_left)
+    # Готовим расклад
+    cards = await draw_unique_cards_for_spread(cb.user_id, zodiac, spread_key)
+    positions = TAROT_SPREADS[spread_key]["positions"]
+    title = TAROT_SPREADS[spread_key]["title"]
+
+    style_pre = {"scientist": "👨‍🔬 Учёный","mystic": "🌙 Мистик","popular": "🌟 Популярная","young": "✨ Молодая"}
+    # tar уже получен ранее перед прогрессом
+    persona = style_pre.get((_norm_tarolog(tar) or "mystic"), "🌙 Мистик")
+
+    # Загрузим оверлей под знак
+    overlay_map = load_zodiac_overlay(zodiac)
+    rng = deck_rng_for(cb.user_id, zodiac, spread_key)
+
+    lines = [f"<b>🔮 {title}</b> • {ZODIAC_SYMBOL.get(zodiac,'✨')} {zodiac}", ""]
+    logged_codes = []
+    for idx, (pos) in enumerate(positions):
+        card = cards[idx]
+        is_rev = decide_orientation(rng)
+        code = card["code"] + (" (R)" if is_rev else "")
+        base_text = (card["reversed"] if is_rev and card.get("reversed") else card["upright"])
+        with_overlay = apply_overlays(base_text, card.get("tags") or [], overlay_map)
+        lines.append(f"<b>{pos}:</b> {code}\n<i>{with_overlay}</i>")
+        logged_codes.append(card["code"])
+
+    # Финальный текст без подсказок от персоны
+    text_out = "\n".join(lines)
+
+    await tarot_log_draw(cb.user_id, ",".join(logged_codes), (_norm_tarolog(tar) or None), 1 if is_free_used else 0)
+
+    async def _reveal():
+        # Текст расклада с кнопкой «Назад»
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")]])
+        text_msg = await context.bot.send_message(chat_id=cb.chat_id, text=text_out, reply_markup=kb, parse_mode=ParseMode.HTML)
+        # Оплаченный расклад — отдельное сообщение, не окно ui_mid: reveal может прийти из отмены
+        # анимации (нажатие в меню), и следующий ui_show иначе отредактировал/удалил бы его.
+        # Заменяется только следующим раскладом.
+        _cleanup_info(context.user_data.get("last_tarot_msg"))
+        context.user_data["last_tarot_msg"] = {"chat_id": cb.chat_id, "message_id": text_msg.message_id}
+
+    # Выберем стиль прогресса и длительность; карты уже списаны — при уходе в меню
+    # расклад всё равно показываем (keep_result), флаг «занято» снимается в on_finish
+    style = "ritual"  # варианты на будущее: "ritual","cards","stars","tech","calm"
+    stages, (min_s, max_s) = build_progress_stages(spread_key, style)
+    await ANIMATIONS.run(context, cb.chat_id, stages, random.randint(min_s, max_s), _reveal,
+                         keep_result=True, on_finish=lambda: context.user_data.pop("tarot_busy", None))
 
-        # Проверка достаточности ресурсов
-        total_avail = free_left + bal
-        if total_avail < cards_needed:
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🛒 Купить карты", callback_data="tarot:buy")],
-                [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-            ])
-            await safe_edit(
-                query,
-                f"<b>Недостаточно карт</b>\n\nДля этого расклада нужно: <b>{cards_needed}</b>. Доступно: <b>{total_avail}</b> (бесплатные сегодня: {free_left}, на балансе: {bal}).",
-                reply_markup=kb,
-                parse_mode=ParseMode.HTML,
-            )
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await safe_answer(query)
+    cb = CallbackCtx(query, update.effective_user.id, update.effective_chat.id)
+    cb.prof = await user_profile(context, cb.user_id)
+    # Любая навигация, кроме повторного расклада, отменяет анимацию прогресса
+    if cb.data != "noop" and not cb.data.startswith("tarot:draw:"):
+        await ANIMATIONS.cancel(context, cb.chat_id)
+    await CALLBACKS.dispatch(context, cb)
+
+# ----------------- WEBHOOK -----------------
+# Минимальный HTTP/1.1-сервер на asyncio (без aiohttp/tornado): Telegram держит keep-alive
+# соединения и шлёт POST с JSON апдейта; проверяем секрет и кладём Update прямо в
+# app.update_queue — дальше его забирает обычный диспетчер PTB.
+
+WEBHOOK_MAX_BODY = 1 << 20   # апдейт Telegram заметно меньше мегабайта
+WEBHOOK_IDLE_SEC = 75
+_HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                 405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large"}
+
+def allowed_updates() -> Optional[list[str]]:
+    if _ALLOWED_UPDATES_ENV.lower() == "all":
+        return Update.ALL_TYPES
+    return [t.strip() for t in _ALLOWED_UPDATES_ENV.split(",") if t.strip()]
+
+def app_update_sink(app):
+    async def _sink(data: dict):
+        update = Update.de_json(data, app.bot)
+        if update is None:
+            raise ValueError("empty update")
+        await app.update_queue.put(update)
+    return _sink
+
+async def _close_connections(conns: dict):
+    # закрываем клиентские соединения и ждём обработчики: они увидят EOF и выйдут сами
+    tasks = [t for t in conns.values() if t is not asyncio.current_task()]
+    for w in list(conns):
+        w.close()
+    if tasks:
+        await asyncio.wait(tasks, timeout=5)
+
+class WebhookServer:
+    """sink(data) получает JSON апдейта: в обычном режиме — очередь Application, во фронте — роутер шардов."""
+
+    def __init__(self, sink, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET):
+        self.sink = sink
+        self.listen, self.port, self.path, self.secret = listen, port, path, secret
+        self._server = None
+        self._conns: dict = {}   # writer -> задача обработчика соединения
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logging.info("Webhook server listening on %s:%s%s", self.listen, self.port, self.path)
+
+    async def stop(self):
+        if self._server is None:
             return
+        self._server.close()
+        await _close_connections(self._conns)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), WEBHOOK_IDLE_SEC)
+                if not line:
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                keep = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                length = headers.get("content-length")
+                if "transfer-encoding" in headers or (method == "POST" and length is None):
+                    status, keep = 411, False
+                elif int(length or 0) > WEBHOOK_MAX_BODY:
+                    status, keep = 413, False
+                else:
+                    body = await reader.readexactly(int(length or 0))
+                    status = await self._handle(method, target, headers, body)
+                writer.write((f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\nContent-Length: 0\r\n"
+                              f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n").encode("latin-1"))
+                await writer.drain()
+                if not keep:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._conns.pop(writer, None)
+            writer.close()
+
+    async def _handle(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        if target.split("?", 1)[0] != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), self.secret):
+            return 403
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("update must be an object")
+            await self.sink(data)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning("Webhook: bad update payload: %s", e)
+            return 400
+        return 200
+
+async def _serve_app(app, server, after_start=None):
+    """Жизненный цикл Application без Updater: апдейты кладёт server (webhook или сокет шарда)."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    try:
+        await app.start()
+        await server.start()
+        if after_start:
+            await after_start()
+        await stop.wait()
+    finally:
+        await server.stop()
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+async def run_webhook(app):
+    async def _set_webhook():
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates(), max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            logging.info("Webhook set to %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+    await _serve_app(app, WebhookServer(app_update_sink(app)), _set_webhook)
+
+# ----------------- ШАРДИРОВАНИЕ -----------------
+# Фронт (polling или webhook) не строит объекты PTB: берёт сырой JSON апдейта, находит
+# from.id и пишет строку JSON в Unix-сокет воркера user_id % SHARDS. Один поток на воркера —
+# апдейты пользователя приходят в свой воркер по порядку, поэтому tarot_busy, ui_mid,
+# user_data и кэш профиля остаются локальными для процесса. Воркер 0 стартует первым
+# (миграции БД), остальные — после появления его сокета.
+# Внутри воркера апдейты одного пользователя обрабатываются строго друг за другом (цепочка
+# задач по effective_user.id), разные пользователи — параллельно.
+# Доставка — at-least-once: воркер отвечает {"ack": update_id} после обработки апдейта, фронт
+# держит неподтверждённые строки и после падения воркера шлёт их новому процессу заново.
+# Апдейт, обработанный перед самым падением (ack не успел уйти), может прийти повторно.
+
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "").strip()
+SHARD_QUEUE_SIZE = 10000          # апдейтов в очереди фронта на воркера (дальше — backpressure)
+SHARD_ACK_WINDOW = 1000           # неподтверждённых апдейтов на воркера (дальше — ждём ack)
+SHARD_POLL_TIMEOUT = 50           # long polling getUpdates во фронте, с
+_shard_control_tasks: set = set()
+
+def shard_of(user_id: int) -> int:
+    return int(user_id) % SHARD_COUNT
+
+def shard_socket_path(index: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"shard-{index}.sock")
+
+def update_user_id(data: dict) -> int:
+    """from.id из любого типа апдейта (message, callback_query, …); 0 — если отправителя нет."""
+    for key, val in data.items():
+        if key != "update_id" and isinstance(val, dict):
+            sender = val.get("from") or val.get("user") or val.get("chat") or {}
+            return int(sender.get("id") or 0)
+    return 0
+
+def send_shard_control(index: int, message: dict):
+    """Служебное сообщение воркеру (без ожидания): например, инвалидация кэша профиля."""
+    async def _send():
+        try:
+            _, writer = await asyncio.open_unix_connection(shard_socket_path(index))
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+            writer.close()
+        except Exception as e:
+            logging.warning("shard %s control %s failed: %s", index, message.get("control"), e)
+    task = asyncio.get_running_loop().create_task(_send())
+    _shard_control_tasks.add(task)
+    task.add_done_callback(_shard_control_tasks.discard)
+
+class ShardSocketServer:
+    """Сторона воркера: строки JSON из сокета → обработка в Application и ack (или служебные команды)."""
+
+    def __init__(self, app, path: str):
+        self.app, self.path = app, path
+        self._server = None
+        self._conns: dict = {}
+        self._chains: dict[int, asyncio.Task] = {}   # user_id -> задача его последнего апдейта
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path, limit=WEBHOOK_MAX_BODY)
+        logging.info("Shard %s/%s listening on %s", SHARD_INDEX, SHARD_COUNT, self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await _close_connections(self._conns)
+            await self._server.wait_closed()
+            self._server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
 
-        # Резервируем: сначала бесплатную (если есть), затем платные на остаток
-        use_free = 1 if (free_left > 0 and cards_needed > 0) else 0
-        paid_need = cards_needed - use_free
-
-        if paid_need > 0:
-            ok_paid = await tarot_consume_paid_cards(user_id, paid_need)
-            if not ok_paid:
-                # гонка: кто-то потратил карты; просим пополнить
-                kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛒 Купить карты", callback_data="tarot:buy")],
-                    [InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")],
-                ])
-                await safe_edit(query, "<b>Недостаточно карт</b>\n\nПохоже, баланс изменился. Пополни карты и попробуй снова.", reply_markup=kb, parse_mode=ParseMode.HTML)
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns[writer] = asyncio.current_task()
+        try:
+            while line := await reader.readline():
+                try:
+                    data = json.loads(line)
+                    if "control" in data:
+                        if data["control"] == "invalidate":
+                            PROFILES.invalidate(int(data["user_id"]))
+                    else:
+                        update = Update.de_json(data, self.app.bot)
+                        if update is None:
+                            raise ValueError("empty update")
+                        uid = update.effective_user.id if update.effective_user else 0
+                        prev = self._chains.get(uid) if uid else None
+                        task = self.app.create_task(self._process(update, writer, prev), update=update)
+                        if uid:
+                            self._chains[uid] = task
+                            task.add_done_callback(functools.partial(self._chain_done, uid))
+                except Exception as e:
+                    logging.warning("shard %s: bad message: %s", SHARD_INDEX, e)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._conns.pop(writer, None)
+            writer.close()
+
+    def _chain_done(self, uid: int, task: asyncio.Task):
+        if self._chains.get(uid) is task:
+            del self._chains[uid]
+
+    async def _process(self, update: Update, writer: asyncio.StreamWriter, prev: Optional[asyncio.Task] = None):
+        # мимо update_queue: так известен момент конца обработки, после него и уходит ack.
+        # Прерванная остановкой обработка ack не шлёт — фронт повторит апдейт новому воркеру.
+        if prev is not None:
+            # предыдущий апдейт того же пользователя — сначала он (и его ack)
+            await asyncio.wait((prev,))
+        try:
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception:
+            logging.exception("shard %s: update %s failed", SHARD_INDEX, update.update_id)
+        if not writer.is_closing():
+            writer.write(json.dumps({"ack": update.update_id}).encode() + b"\n")
+
+async def run_worker(app):
+    await _serve_app(app, ShardSocketServer(app, shard_socket_path(SHARD_INDEX)))
+
+class ShardLink:
+    """Сторона фронта: процесс воркера, очередь апдейтов и одно соединение к его сокету."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.proc = None
+        self.queue: asyncio.Queue = asyncio.Queue(SHARD_QUEUE_SIZE)   # (update_id, строка JSON)
+        self._unacked: dict[int, bytes] = {}   # отправлено, но воркер ещё не подтвердил (по порядку)
+        self._acked = asyncio.Event()
+        self._tasks: list = []
+        self._stopping = False
+
+    async def spawn(self):
+        env = dict(os.environ, SHARD_INDEX=str(self.index), SHARDS=str(SHARD_COUNT), SHARD_SOCKET_DIR=SHARD_SOCKET_DIR)
+        self.proc = await asyncio.create_subprocess_exec(sys.executable, str(Path(__file__).resolve()), env=env)
+        logging.info("Shard %s started (pid %s)", self.index, self.proc.pid)
+
+    async def wait_ready(self, timeout: float = 120):
+        path = shard_socket_path(self.index)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not os.path.exists(path):
+            if self.proc.returncode is not None:
+                raise RuntimeError(f"shard {self.index} exited with code {self.proc.returncode}")
+            if loop.time() > deadline:
+                raise RuntimeError(f"shard {self.index} did not start in {timeout:.0f}s")
+            await asyncio.sleep(0.2)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._pump()), asyncio.create_task(self._watch())]
+
+    async def _watch(self):
+        # упавший воркер перезапускаем; недоставленные апдейты ждут в очереди
+        while not self._stopping:
+            code = await self.proc.wait()
+            if self._stopping:
                 return
+            logging.error("Shard %s exited with code %s, restarting", self.index, code)
+            await asyncio.sleep(1.0)
+            await self.spawn()
 
-        is_free_used = False
-        if use_free:
-            # Списываем бесплатную попытку (их максимум 1 в день)
-            is_free_used = await tarot_try_use_free(user_id)
-            # Если по какой-то причине не удалось — это не критично, бесплатная просто не зачлась.
+    async def _read_acks(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                try:
+                    self._unacked.pop(json.loads(line)["ack"], None)
+                except (ValueError, KeyError, TypeError):
+                    pass
+                self._acked.set()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._acked.set()   # обрыв соединения тоже будит _pump
 
-        # Защита от двойного нажатия: если уже идёт расклад — игнорируем
-        if context.user_data.get("tarot_busy"):
+    async def _pump(self):
+        while True:
+            writer = acks = None
             try:
-                await safe_answer(query, "Идёт расклад…")
-            except Exception:
+                reader, writer = await asyncio.open_unix_connection(shard_socket_path(self.index))
+                acks = asyncio.create_task(self._read_acks(reader))
+                # всё, что не подтвердил прошлый процесс воркера, — заново и по порядку
+                for line in list(self._unacked.values()):
+                    writer.write(line)
+                await writer.drain()
+                while not acks.done():
+                    if len(self._unacked) >= SHARD_ACK_WINDOW:
+                        self._acked.clear()
+                        await self._acked.wait()
+                        continue
+                    get = asyncio.ensure_future(self.queue.get())
+                    await asyncio.wait((get, acks), return_when=asyncio.FIRST_COMPLETED)
+                    if not get.done():
+                        get.cancel()   # соединение оборвалось, пока очередь была пуста
+                        break
+                    update_id, line = get.result()
+                    self._unacked[update_id] = line   # до записи: при обрыве строка уйдёт повторно
+                    writer.write(line)
+                    await writer.drain()
+            except (OSError, ConnectionError):
                 pass
-            return
-        context.user_data["tarot_busy"] = True
-
-        # Прогресс-этапы перед показом расклада
-        await tarot_cleanup_all_photos(context)
+            finally:
+                if acks is not None:
+                    acks.cancel()
+                if writer is not None:
+                    writer.close()
+            # воркер перезапускается — ждём его сокет
+            await asyncio.sleep(0.5)
+
+    async def stop(self):
+        self._stopping = True
+        # даём дописать очередь и дождаться ack, затем останавливаем воркер штатно (SIGTERM → post_shutdown)
+        for _ in range(50):
+            if self.queue.empty() and not self._unacked:
+                break
+            await asyncio.sleep(0.1)
+        for t in self._tasks:
+            t.cancel()
+        if self.proc and self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 30)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+
+async def _bot_api(client, method: str, **params):
+    base = TELEGRAM_BASE_URL or "https://api.telegram.org/bot"
+    r = await client.post(f"{base}{BOT_TOKEN}/{method}", json=params)
+    payload = r.json()
+    if not payload.get("ok"):
+        raise RuntimeError(f"{method}: {payload.get('description')}")
+    return payload.get("result")
+
+async def _front_poll(client, route, stop: asyncio.Event):
+    await _bot_api(client, "deleteWebhook")
+    offset = None
+    while not stop.is_set():
         try:
-            await query.message.delete()
-        except Exception:
+            params = {"timeout": SHARD_POLL_TIMEOUT, "allowed_updates": allowed_updates()}
+            if offset is not None:
+                params["offset"] = offset
+            updates = await _bot_api(client, "getUpdates", **params)
+        except Exception as e:
+            logging.warning("front getUpdates failed: %s", e)
+            await asyncio.sleep(2.0)
+            continue
+        for data in updates:
+            await route(data)
+            offset = data["update_id"] + 1
+
+async def run_front():
+    global SHARD_SOCKET_DIR
+    import httpx
+    own_dir = not SHARD_SOCKET_DIR
+    if own_dir:
+        SHARD_SOCKET_DIR = tempfile.mkdtemp(prefix="astro-shards-")
+    os.makedirs(SHARD_SOCKET_DIR, exist_ok=True)
+    links = [ShardLink(i) for i in range(SHARD_COUNT)]
+
+    async def route(data: dict):
+        line = json.dumps(data, ensure_ascii=False).encode() + b"\n"
+        await links[shard_of(update_user_id(data))].queue.put((data["update_id"], line))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
             pass
-
-        # Покажем фото текущего таролога СРАЗУ (оно будет выше всех дальнейших сообщений прогресса и результата)
-        _, tar, _, _ = await tarot_get_user(user_id)
-        img = _tarot_img_path(_norm_tarolog(tar) or "")
-        if img and img.exists():
+    server = None
+    try:
+        # воркер 0 применяет миграции — остальные стартуют после него
+        await links[0].spawn()
+        await links[0].wait_ready()
+        for link in links[1:]:
+            await link.spawn()
+        for link in links[1:]:
+            await link.wait_ready()
+        for link in links:
+            link.start()
+        timeout = SHARD_POLL_TIMEOUT + 10
+        async with httpx.AsyncClient(timeout=timeout, proxy=HTTP_PROXY or None) as client:
+            if UPDATES_MODE == "webhook":
+                server = WebhookServer(route)
+                await server.start()
+                if WEBHOOK_URL:
+                    await _bot_api(client, "setWebhook", url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                   allowed_updates=allowed_updates(), max_connections=WEBHOOK_MAX_CONNECTIONS)
+                await stop.wait()
+            else:
+                poller = asyncio.create_task(_front_poll(client, route, stop))
+                await stop.wait()
+                poller.cancel()
+    finally:
+        if server is not None:
+            await server.stop()
+        await asyncio.gather(*(link.stop() for link in links), return_exceptions=True)
+        if own_dir:
             try:
-                with img.open("rb") as f:
-                    photo_msg = await context.bot.send_photo(chat_id=chat_id, photo=f)
-                context.user_data["tarot_about_photo"] = {"chat_id": chat_id, "message_id": photo_msg.message_id}
-                context.chat_data["tarot_photo"] = {"chat_id": chat_id, "message_id": photo_msg.message_id}
-            except Exception:
+                os.rmdir(SHARD_SOCKET_DIR)
+            except OSError:
                 pass
 
-        # Выберем стиль прогресса и длительность
-        style = "ritual"  # варианты на будущее: "ritual","cards","stars","tech","calm"
-        stages, (min_s, max_s) = build_progress_stages(spread_key, style)
-        total_delay = random.randint(min_s, max_s)
-        # Отправляем первое сообщение прогресса и постепенно обновляем
+# ----------------- СОСТОЯНИЕ UI (persistence) -----------------
+# user_data/chat_data PTB переживают рестарт: id UI-сообщений, ожидаемый ввод админа,
+# последние фото — всё, что нужно, чтобы после перезапуска чистить чат, а не плодить дубли.
+# Запись чата читается из ui_state лениво, при первом апдейте от него (refresh_*), а не вся
+# таблица на старте. PTB раз в UI_STATE_FLUSH_SEC отдаёт данные тронутых чатов; пишем только
+# те, чей JSON изменился с последней записи, — строки уходят через WRITE_BEHIND одной транзакцией.
+
+UI_STATE_FLUSH_SEC = float(os.getenv("UI_STATE_FLUSH_SEC", "5") or 5)
+UI_STATE_TRANSIENT = frozenset({"tarot_busy"})   # живут только в памяти процесса
+
+_UI_STATE_SQL = ("INSERT INTO ui_state(scope, id, data, ts) VALUES(?,?,?,?) "
+                 "ON CONFLICT(scope, id) DO UPDATE SET data=excluded.data, ts=excluded.ts")
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, db: Database, update_interval: float = UI_STATE_FLUSH_SEC):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.db = db
+        self._stored: dict[tuple[str, int], str] = {}   # (scope, id) -> JSON, который сейчас в БД
+        self._loading: dict[tuple[str, int], asyncio.Future] = {}
+
+    async def _load(self, scope: str, id_: int, data: dict):
+        key = (scope, id_)
+        if key in self._stored:
+            return
+        fut = self._loading.get(key)
+        if fut is not None:
+            # параллельный апдейт того же чата: PTB отдаёт тот же dict, ждём, пока его заполнят
+            await asyncio.shield(fut)
+            return
+        fut = self._loading[key] = asyncio.get_running_loop().create_future()
         try:
-            prog_msg = await context.bot.send_message(chat_id=chat_id, text=stages[0])
-        except Exception:
-            prog_msg = None
-
-        # Распределим время равномерно по этапам (не менее 2 секунд на шаг)
-        per_step = max(2, total_delay // max(1, len(stages)))
-        # Небольшая коррекция, чтобы суммарно не меньше total_delay
-        remaining = total_delay
-        for i, txt in enumerate(stages):
-            if i == 0:
-                # уже показали первый шаг
-                await asyncio.sleep(per_step)
-                remaining -= per_step
-                continue
-            try:
-                if prog_msg:
-                    await context.bot.edit_message_text(chat_id=chat_id, message_id=prog_msg.message_id, text=txt)
-            except Exception:
-                # если не удалось отредактировать — пробуем отправить новое
-                try:
-                    prog_msg = await context.bot.send_message(chat_id=chat_id, text=txt)
-                except Exception:
-                    pass
-            await asyncio.sleep(per_step)
-            remaining -= per_step
-        # Если осталось время из-за округления — досыпаем
-        if remaining > 0:
-            await asyncio.sleep(remaining)
-
-        # Готовим расклад
-        cards = await draw_unique_cards_for_spread(user_id, zodiac, spread_key)
-        positions = TAROT_SPREADS[spread_key]["positions"]
-        title = TAROT_SPREADS[spread_key]["title"]
-
-        style_pre = {"scientist": "👨‍🔬 Учёный","mystic": "🌙 Мистик","popular": "🌟 Популярная","young": "✨ Молодая"}
-        # tar уже получен ранее перед прогрессом
-        persona = style_pre.get((_norm_tarolog(tar) or "mystic"), "🌙 Мистик")
-
-        # Загрузим оверлей под знак
-        overlay_map = load_zodiac_overlay(zodiac)
-        rng = deck_rng_for(user_id, zodiac, spread_key)
-
-        lines = [f"<b>🔮 {title}</b> • {ZODIAC_SYMBOL.get(zodiac,'✨')} {zodiac}", ""]
-        logged_codes = []
-        for idx, (pos) in enumerate(positions):
-            card = cards[idx]
-            is_rev = decide_orientation(rng)
-            code = card["code"] + (" (R)" if is_rev else "")
-            base_text = (card["reversed"] if is_rev and card.get("reversed") else card["upright"])
-            with_overlay = apply_overlays(base_text, card.get("tags") or [], overlay_map)
-            lines.append(f"<b>{pos}:</b> {code}\n<i>{with_overlay}</i>")
-            logged_codes.append(card["code"])
-
-        # Финальный текст без подсказок от персоны
-        text_out = "\n".join(lines)
-
-        await tarot_log_draw(user_id, ",".join(logged_codes), (_norm_tarolog(tar) or None), 1 if is_free_used else 0)
-
-        # Удаляем прогресс
-        if prog_msg:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=prog_msg.message_id)
-            except Exception:
-                pass
+            row = await self.db.fetchone("SELECT data FROM ui_state WHERE scope=? AND id=?", key)
+            raw = row[0] if row else ""
+            for k, v in (json.loads(raw) if raw else {}).items():
+                data.setdefault(k, v)
+            self._stored[key] = raw
+        except Exception as e:
+            # не помечаем загруженным: следующий апдейт попробует снова
+            logging.warning("ui_state load %s:%s failed: %s", scope, id_, e)
+        finally:
+            del self._loading[key]
+            fut.set_result(None)
+
+    def _save(self, scope: str, id_: int, data: dict):
+        key = (scope, id_)
+        payload = {k: v for k, v in data.items() if k not in UI_STATE_TRANSIENT}
+        try:
+            raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), sort_keys=True) if payload else ""
+        except (TypeError, ValueError) as e:
+            logging.warning("ui_state %s:%s is not JSON-serializable, skipped: %s", scope, id_, e)
+            return
+        if self._stored.get(key) == raw:
+            return   # не изменилось — не пишем
+        self._stored[key] = raw
+        # удаление — тоже upsert пустой строки: один SQL сохраняет порядок записей в батче write-behind
+        WRITE_BEHIND.add(_UI_STATE_SQL, (scope, id_, raw, int(time.time())))
 
-        # Затем отправляем текст расклада с кнопкой «Назад»
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Таро", callback_data="tarot:open")]])
-        text_msg = await context.bot.send_message(chat_id=chat_id, text=text_out, reply_markup=kb, parse_mode=ParseMode.HTML)
-        context.chat_data["ui_mid"] = text_msg.message_id
-        # Снимаем флаг «занято»
-        context.user_data.pop("tarot_busy", None)
-        return
+    # --- загрузка ---
+    async def get_user_data(self) -> dict:
+        return {}   # записи читаются лениво в refresh_user_data
 
-# ----------------- APP INIT -----------------
+    async def get_chat_data(self) -> dict:
+        return {}
 
-def build_application():
-    builder = ApplicationBuilder().token(BOT_TOKEN)
-    if TELEGRAM_BASE_URL:
-        try:
-            builder = builder.base_url(TELEGRAM_BASE_URL)
-        except Exception:
-            logging.warning("base_url() not supported; ignoring TELEGRAM_BASE_URL")
-    try:
-        from telegram.request import HTTPXRequest as _HTTPXRequest
-        sig = inspect.signature(_HTTPXRequest)
-        kwargs = {}
-        if 'connect_timeout' in sig.parameters: kwargs['connect_timeout'] = 20.0
-        if 'read_timeout'    in sig.parameters: kwargs['read_timeout']    = 40.0
-        if 'write_timeout'   in sig.parameters: kwargs['write_timeout']   = 20.0
-        if 'pool_timeout'    in sig.parameters: kwargs['pool_timeout']    = 10.0
-        if 'proxies' in sig.parameters and HTTP_PROXY:
-            kwargs['proxies'] = HTTP_PROXY
-        request = _HTTPXRequest(**kwargs)
-        builder = builder.request(request)
-    except Exception as e:
-        logging.warning("Using default Telegram request (no custom timeouts): %s", e)
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        await self._load("u", user_id, user_data)
 
-    builder = builder.concurrent_updates(True)
-    app = builder.build()
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        await self._load("c", chat_id, chat_data)
 
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("tgtest", tgtest_cmd))
-    app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CallbackQueryHandler(on_button))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_router))
-    return app
+    # --- запись ---
+    async def update_user_data(self, user_id: int, data: dict):
+        self._save("u", user_id, data)
 
-def main():
-    # Backward-compatible sync entrypoint for environments expecting a sync function.
-    # We delegate to the async main to ensure an event loop exists on Python 3.13+.
-    asyncio.run(main_async())
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._save("c", chat_id, data)
 
-async def main_async():
-    await init_db()
-    app = build_application()
-    logging.info("Starting bot…")
-    # Explicit async lifecycle to avoid "no current event loop" on Python 3.13
-    await app.initialize()
-    await app.start()
-    await app.updater.start_polling()
-    # Block forever until the process receives SIGINT/SIGTERM (Ctrl+C)
-    try:
-        await asyncio.Future()
-    except asyncio.CancelledError:
+    async def drop_user_data(self, user_id: int):
+        self._save("u", user_id, {})
+
+    async def drop_chat_data(self, chat_id: int):
+        self._save("c", chat_id, {})
+
+    async def flush(self):
+        # PTB зовёт flush в app.shutdown(), до post_shutdown — БД ещё открыта
+        await WRITE_BEHIND.flush()
+
+    # --- не храним ---
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data):
         pass
-    finally:
-        # Best-effort graceful shutdown
-        try:
-            await app.updater.stop()
-        except Exception:
-            pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+# ----------------- ЛИМИТЫ ОТПРАВКИ (rate limiter) -----------------
+# Все исходящие запросы ExtBot проходят через OutboundRateLimiter (BaseRateLimiter PTB, слой
+# над InstrumentedRequest). Новые сообщения (send*/copy*/forward*) берут жетон из глобального
+# ведра (~30/с на бота, делится между воркерами шардов) и из ведра чата: личка ~1/с, группы
+# ~20/мин, с небольшим запасом на всплеск. Правки (edit*) жетонов не тратят: лимиты Telegram
+# (1 сообщение/с в чат, ~30/с на бота) — про новые сообщения, а навигация по меню почти вся
+# из правок. Правка ждёт только замороженное после 429 ведро своего чата. Массовые отправки (рассылка, утренний дайджест) передают rate_limit_args=BULK и
+# не трогают последние RATE_BULK_RESERVE жетонов глобального ведра — интерактивные ответы
+# проходят первыми. На 429 ведро (чата или глобальное) замораживается на retry_after,
+# и запрос повторяется до RATE_MAX_RETRIES раз; дальше RetryAfter уходит вызывающему.
+
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "30") or 30)
+RATE_PRIVATE_PER_SEC = float(os.getenv("RATE_PRIVATE_PER_SEC", "1") or 1)
+RATE_PRIVATE_BURST = float(os.getenv("RATE_PRIVATE_BURST", "3") or 3)
+RATE_GROUP_PER_MIN = float(os.getenv("RATE_GROUP_PER_MIN", "20") or 20)
+RATE_GROUP_BURST = float(os.getenv("RATE_GROUP_BURST", "3") or 3)
+RATE_BULK_RESERVE = float(os.getenv("RATE_BULK_RESERVE", "5") or 5)
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3") or 3)
+RATE_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+RATE_SPEND_PREFIXES = ("send", "copy", "forward")   # тратят жетоны; edit* — только ждут заморозку чата
+BULK = {"bulk": True}   # rate_limit_args для массовых отправок
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, max(1.0, capacity)
+        self.tokens, self.ts = self.capacity, time.monotonic()
+
+    def wait(self, now: float, reserve: float = 0.0) -> float:
+        """Сколько ждать, пока в ведре будет жетон сверх reserve (0 — можно брать сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        return max(0.0, (1.0 + reserve - self.tokens) / self.rate)
+
+    def freeze(self, seconds: float):
+        # следующий жетон появится ровно через seconds
+        self.tokens, self.ts = min(self.tokens, 1.0 - seconds * self.rate), time.monotonic()
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate: float = RATE_GLOBAL_PER_SEC / SHARD_COUNT):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[int, TokenBucket] = {}
+        self.waiting = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> Optional[TokenBucket]:
         try:
-            await app.stop()
-        except Exception:
-            pass
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            return None   # @username канала — только глобальный лимит
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10000:
+                # простаивающие вёдра полные — их можно забыть без потери состояния
+                now = time.monotonic()
+                self._chats = {k: v for k, v in self._chats.items() if now - v.ts < 60}
+            if chat_id > 0:
+                b = TokenBucket(RATE_PRIVATE_PER_SEC, RATE_PRIVATE_BURST)
+            else:
+                b = TokenBucket(RATE_GROUP_PER_MIN / 60, RATE_GROUP_BURST)
+            self._chats[chat_id] = b
+        return b
+
+    async def _acquire(self, chat: Optional[TokenBucket], priority: str, spend: bool = True):
+        reserve = RATE_BULK_RESERVE if priority == "bulk" else 0.0
+        t0 = None
+        while True:
+            now = time.monotonic()
+            delay = self._global.wait(now, reserve) if spend else 0.0
+            if chat is not None:
+                # без траты жетона ждём, только пока ведро ушло в минус (заморозка после 429)
+                delay = max(delay, chat.wait(now, 0.0 if spend else -1.0))
+            if delay <= 0:
+                if spend:
+                    self._global.tokens -= 1
+                    if chat is not None:
+                        chat.tokens -= 1
+                break
+            if t0 is None:
+                t0 = now
+                self.waiting += 1
+                RATE_DELAYED.inc(priority)
+            await asyncio.sleep(delay)
+        if t0 is not None:
+            self.waiting -= 1
+            RATE_WAIT_SECONDS.observe(time.monotonic() - t0, priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: dict, rate_limit_args):
+        if not endpoint.startswith(RATE_LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)   # answerCallbackQuery, delete*, getMe, ...
+        priority = "bulk" if rate_limit_args and rate_limit_args.get("bulk") else "interactive"
+        chat = self._chat_bucket(data.get("chat_id")) if data.get("chat_id") is not None else None
+        # правка без chat_id (inline_message_id) не видна ни одному ведру чата — считаем её в общем
+        spend = priority == "bulk" or chat is None or endpoint.startswith(RATE_SPEND_PREFIXES)
+        for attempt in range(RATE_MAX_RETRIES + 1):
+            await self._acquire(chat, priority, spend)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= RATE_MAX_RETRIES:
+                    raise
+                ra = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+                RATE_RETRY_AFTER.inc(endpoint)
+                logging.info("RetryAfter %.0fs on %s (chat %s), retrying", ra, endpoint, data.get("chat_id"))
+                # 429 посреди рассылки — общий флуд-контроль бота; в интерактиве — скорее лимит чата
+                (self._global if priority == "bulk" or chat is None else chat).freeze(ra + 0.1)
+
+RATE_LIMITER = OutboundRateLimiter()
+
+# ----------------- APP INIT -----------------
+
+async def _on_startup(app):
+    # соединения с БД открываются один раз, в цикле событий приложения
+    await DB.open()
+    await init_db()
+    await check_query_plans()
+    WRITE_BEHIND.start()
+    try:
+        await ASSETS.build()
+    except Exception as e:
+        logging.warning("Asset build failed, sending original images: %s", e)
+    # индекс предсказаний: первая сборка сразу, дальше — опрос mtime
+    await asyncio.to_thread(PRED_INDEX.reload)
+    app.job_queue.run_repeating(pred_index_reload_job, interval=PREDICTIONS_RELOAD_SEC, first=PREDICTIONS_RELOAD_SEC, name="pred_index_reload")
+    # незавершённые рассылки продолжаются с места остановки (при шардировании — только в воркере 0)
+    if IS_PRIMARY:
+        await BROADCASTS.resume_all(app.bot)
+    await DAILY.refresh(use_stored=True)
+    app.job_queue.run_daily(daily_precompute_job, time=datetime.time(0, 0, tzinfo=TZ), name="daily_precompute")
+    if IS_PRIMARY:
+        start_morning_scheduler(app.job_queue)
+    global METRICS_SERVER
+    UPDATE_QUEUE_DEPTH.set_function(app.update_queue.qsize)
+    if METRICS_PORT and METRICS_SERVER is None:
+        METRICS_SERVER = MetricsServer(port=METRICS_PORT + (SHARD_INDEX or 0))
+        await METRICS_SERVER.start()
+
+async def _on_shutdown(app):
+    global METRICS_SERVER
+    if METRICS_SERVER is not None:
+        await METRICS_SERVER.stop()
+        METRICS_SERVER = None
+    await BROADCASTS.stop()
+    await WRITE_BEHIND.stop()
+    await DB.close()
+
+def _build_request():
+    sig = inspect.signature(HTTPXRequest)
+    kwargs = {}
+    if 'connect_timeout' in sig.parameters: kwargs['connect_timeout'] = 20.0
+    if 'read_timeout'    in sig.parameters: kwargs['read_timeout']    = 40.0
+    if 'write_timeout'   in sig.parameters: kwargs['write_timeout']   = 20.0
+    if 'pool_timeout'    in sig.parameters: kwargs['pool_timeout']    = 10.0
+    # по умолчанию у HTTPXRequest одно соединение: интерактивные ответы ждали бы в пуле
+    # за массовыми отправками, и приоритет лимитера ничего бы не дал
+    if 'connection_pool_size' in sig.parameters: kwargs['connection_pool_size'] = 16
+    if 'proxies' in sig.parameters and HTTP_PROXY:
+        kwargs['proxies'] = HTTP_PROXY
+    return InstrumentedRequest(**kwargs)
 
 def build_application():
-    app = (
+    builder = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
-        .build()
+        .concurrent_updates(True)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .persistence(SQLitePersistence(DB))
+        .rate_limiter(RATE_LIMITER)
     )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    try:
+        builder = builder.request(_build_request())
+    except Exception as e:
+        logging.warning("Using default Telegram request (no custom timeouts): %s", e)
+    if UPDATES_MODE == "webhook" or SHARD_INDEX is not None:
+        builder = builder.updater(None)   # апдейты кладёт WebhookServer / сокет шарда
+    app = builder.build()
 
     # handlers
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("tgtest", tgtest_cmd))
-    app.add_handler(CommandHandler("admin", admin_cmd))
-    app.add_handler(CallbackQueryHandler(on_button))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, menu_router))
+    app.add_handler(TypeHandler(Update, profile_prehandler), group=-1)
+    app.add_handler(CommandHandler("start", timed_handler(start_cmd, "command", "start")))
+    app.add_handler(CommandHandler("tgtest", timed_handler(tgtest_cmd, "command", "tgtest")))
+    app.add_handler(CommandHandler("admin", timed_handler(admin_cmd, "command", "admin")))
+    app.add_handler(CallbackQueryHandler(on_button))   # время маршрутов — в CALLBACKS.dispatch
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(menu_router, "menu", menu_branch)))
+    app.add_handler(TypeHandler(Update, cleanup_flush), group=CLEANUP_GROUP)   # после основных хендлеров
     return app
 
 def main():
-    # Инициализация БД до старта приложения
-    asyncio.run(init_db())
-
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        asyncio.run(run_front())
+        return
+    # БД открывается и инициализируется в post_init (_on_startup)
     app = build_application()
+    if SHARD_INDEX is not None:
+        asyncio.run(run_worker(app))
+        return
+    if UPDATES_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+        return
     # run_polling — синхронный метод PTB; он сам запустит async-хендлеры корректно
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    app.run_polling(allowed_updates=allowed_updates())
 
 if __name__ == "__main__":
     main()
-
-
-async def _schedule_mornings(app):
-    """Каждую минуту проверяет время (МСК) и шлёт дайджест 1 раз в день."""
-    await init_db()
-    while True:
-        try:
-            now = datetime.datetime.now(tz=TZ)
-            hhmm = now.strftime("%H:%M")
-            today = today_str()
-            async with db_connect() as db:
-                cur = await db.execute(
-                    "SELECT user_id, chat_id, COALESCE(notify_time,'') FROM users WHERE COALESCE(consent,0)=1"
-                )
-                rows = await cur.fetchall()
-            for uid, cid, nt in rows:
-                try:
-                    target = nt.strip() if re.match(r"^\d{2}:\d{2}$", nt or "") else DEFAULT_NOTIFY_TIME
-                    if target != hhmm:
-                        continue
-                    # skip if already sent today
-                    async with db_connect() as db:
-                        cur = await db.execute("SELECT COALESCE(last_morning_date,'') FROM users WHERE user_id=?", (uid,))
-                        row = await cur.fetchone()
-                        last = (row[0] or '').strip() if row else ''
-                    if last == today:
-                        continue
-                    await send_morning_digest(app, uid, cid)
-                    async with db_connect() as db:
-                        await db.execute("UPDATE users SET last_morning_date=? WHERE user_id=?", (today, uid))
-                        await db.commit()
-                except Exception as e:
-                    logging.warning("morning send failed for %s: %s", uid, e)
-        except Exception as e:
-            logging.warning("scheduler loop error: %s", e)
-        await asyncio.sleep(60)
@@ -0,0 +1,32 @@
+"""Сборка оптимизированных картинок (то же, что бот делает на старте).
+
+    python tools/build_assets.py           # пересобрать изменившиеся
+    python tools/build_assets.py --force   # пересобрать всё
+
+Результат — ASSET_CACHE_DIR (по умолчанию .asset_cache/ рядом с bot.py) и manifest.json в нём.
+Удобно запускать при деплое, чтобы первый старт бота не тратил время на пережатие.
+"""
+import argparse, asyncio, os, sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("BOT_TOKEN", "0:assets")  # bot.py требует токен при импорте
+
+import bot  # noqa: E402
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--force", action="store_true", help="игнорировать манифест")
+    args = ap.parse_args()
+    if args.force:
+        bot.ASSETS.manifest_path.unlink(missing_ok=True)
+    if bot.Image is None:
+        print("Pillow не установлен (pip install -r requirements.txt): файлы только переименовываются и копируются в кеш")
+    n = asyncio.run(bot.ASSETS.build())
+    print(f"пересобрано: {n}, кеш: {bot.ASSETS.cache_dir}")
+    for key, e in sorted(bot.ASSETS._entries.items()):
+        print(f"  {key:<18} {e['src']:<40} {e['size'] / 1024:7.1f} КБ -> {e['bytes'] / 1024:7.1f} КБ")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Локальная замена Telegram Bot API для нагрузочных прогонов.
+
+Понимает getMe, getUpdates (long polling), sendMessage, editMessageText, editMessageReplyMarkup,
+deleteMessage(s), sendPhoto и answerCallbackQuery; остальные методы отвечают ok/True.
+Сообщения хранятся по чатам, поэтому правка удалённого сообщения или повтор того же текста
+дают те же ошибки 400, что и настоящий API. Задержка и доля ответов 429 настраиваются.
+
+Отдельно (апдейты подкладывает внешний код, см. tools/loadtest.py):
+
+    python tools/fake_bot_api.py --port 8081 --latency 30 --jitter 20 --rate-429 0.01
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=1:fake python bot.py
+"""
+import argparse, asyncio, itertools, json, random, time
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+NO_FAULTS = {"getMe", "getUpdates", "deleteWebhook", "setWebhook", "getWebhookInfo"}  # без 429 и задержки
+MAX_BODY = 20 << 20
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int | None = None):
+        super().__init__(description)
+        self.code, self.description, self.retry_after = code, description, retry_after
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    """Параметры запроса PTB: x-www-form-urlencoded, multipart (файлы) или JSON."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+        out = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name and part.get_filename() is None:
+                out[name] = part.get_payload(decode=True).decode("utf-8")
+            elif name:
+                out[name] = {"filename": part.get_filename()}
+        return out
+    return dict(parse_qsl(body.decode()))
+
+def public(msg: dict) -> dict:
+    """Message в том виде, как его отдаёт Telegram: reply_markup только у inline-клавиатур."""
+    if "keyboard" in (msg.get("reply_markup") or {}):
+        msg = {k: v for k, v in msg.items() if k != "reply_markup"}
+    return msg
+
+def _json_param(params: dict, key: str):
+    v = params.get(key)
+    if isinstance(v, str) and v[:1] in "{[":
+        return json.loads(v)
+    return v
+
+class FakeBotAPI:
+    """Состояние фейкового API. on_call(method, chat_id, params, result) — хук для симулятора."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, rate_429: float = 0.0,
+                 retry_after: int = 1, on_call=None):
+        self.latency, self.jitter = latency_ms / 1000, jitter_ms / 1000
+        self.rate_429, self.retry_after = rate_429, retry_after
+        self.on_call = on_call
+        self.updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Condition()
+        self._msg_ids: dict[int, itertools.count] = defaultdict(lambda: itertools.count(1))
+        self.messages: dict[int, dict[int, dict]] = defaultdict(dict)   # chat_id -> message_id -> Message
+        self.calls = Counter()
+        self.errors = Counter()   # (method, code)
+        self._server = None
+        self._conns: set[asyncio.Task] = set()
+
+    # --- апдейты ---
+    async def push_update(self, payload: dict) -> int:
+        """payload — {"message": ...} или {"callback_query": ...}; update_id проставляется здесь."""
+        update = {"update_id": next(self._update_ids), **payload}
+        async with self._new_updates:
+            self.updates.append(update)
+            self._new_updates.notify_all()
+        return update["update_id"]
+
+    def user_message(self, user: dict, text: str) -> dict:
+        chat_id = user["id"]
+        msg = {"message_id": next(self._msg_ids[chat_id]), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private", "first_name": user.get("first_name", "")},
+               "from": user, "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.messages[chat_id][msg["message_id"]] = msg
+        return {"message": msg}
+
+    def callback(self, user: dict, message: dict, data: str) -> dict:
+        return {"callback_query": {"id": f"{user['id']}:{time.monotonic_ns()}", "from": user,
+                                   "chat_instance": str(user["id"]), "message": public(message), "data": data}}
+
+    async def _get_updates(self, p: dict):
+        offset = int(p.get("offset") or 0)
+        limit = int(p.get("limit") or 100)
+        timeout = float(p.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            async with self._new_updates:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait_for(lambda: self.updates), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        return self.updates[:limit]
+
+    # --- сообщения ---
+    def _new_message(self, chat_id: int, **fields) -> dict:
+        msg = {"message_id": next(self._msg_ids[chat_id]), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+        msg.update({k: v for k, v in fields.items() if v is not None})
+        self.messages[chat_id][msg["message_id"]] = msg
+        return msg
+
+    def _existing(self, p: dict, what: str, own: bool = True) -> dict:
+        msg = self.messages[int(p["chat_id"])].get(int(p["message_id"]))
+        if msg is None or (own and msg["from"] is not BOT_USER):
+            raise ApiError(400, f"Bad Request: message to {what} not found")
+        return msg
+
+    async def call(self, method: str, p: dict):
+        self.calls[method] += 1
+        if method not in NO_FAULTS:
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + random.random() * self.jitter)
+            if self.rate_429 and random.random() < self.rate_429:
+                raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        chat_id = int(p["chat_id"]) if str(p.get("chat_id", "")).lstrip("-").isdigit() else None
+        result = await self._dispatch(method, p, chat_id)
+        if isinstance(result, dict) and "message_id" in result:
+            result = public(result)
+        if self.on_call is not None:
+            self.on_call(method, chat_id, p, result)
+        return result
+
+    async def _dispatch(self, method: str, p: dict, chat_id):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(p)
+        if method == "sendMessage":
+            return self._new_message(chat_id, text=p.get("text", ""), reply_markup=_json_param(p, "reply_markup"))
+        if method == "sendPhoto":
+            photo = [{"file_id": f"photo{chat_id}", "file_unique_id": f"u{chat_id}", "width": 512, "height": 512}]
+            return self._new_message(chat_id, photo=photo, caption=p.get("caption"), reply_markup=_json_param(p, "reply_markup"))
+        if method in ("editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            msg = self._existing(p, "edit")
+            new = {"reply_markup": _json_param(p, "reply_markup")}
+            if method == "editMessageText":
+                new["text"] = p.get("text", "")
+            elif method == "editMessageCaption":
+                new["caption"] = p.get("caption", "")
+            if all(msg.get(k) == v for k, v in new.items()):
+                raise ApiError(400, "Bad Request: message is not modified: specified new message content "
+                                    "and reply markup are exactly the same as a current content and reply markup of the message")
+            msg.update(new)
+            if msg["reply_markup"] is None:
+                del msg["reply_markup"]
+            return msg
+        if method == "deleteMessage":
+            self._existing(p, "delete", own=False)   # в личке бот удаляет и входящие
+            del self.messages[chat_id][int(p["message_id"])]
+            return True
+        if method == "deleteMessages":
+            for mid in _json_param(p, "message_ids") or []:
+                self.messages[chat_id].pop(int(mid), None)
+            return True
+        return True   # answerCallbackQuery, deleteWebhook, sendChatAction, ...
+
+    # --- HTTP ---
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for task in list(self._conns):
+            task.cancel()
+        await asyncio.gather(*self._conns, return_exceptions=True)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                _, target, _ = line.decode("latin-1").split()
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    break
+                body = await reader.readexactly(length)
+                status, payload = await self._handle(target, headers.get("content-type", ""), body)
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                writer.write((f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                              f"Content-Length: {len(data)}\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass   # CancelledError — stop(): висящий long poll не дождётся апдейтов
+        finally:
+            self._conns.discard(asyncio.current_task())
+            writer.close()
+
+    async def _handle(self, target: str, content_type: str, body: bytes):
+        method = target.split("?", 1)[0].rsplit("/", 1)[-1]
+        try:
+            result = await self.call(method, parse_params(content_type, body))
+        except ApiError as e:
+            self.errors[(method, e.code)] += 1
+            payload = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.retry_after is not None:
+                payload["parameters"] = {"retry_after": e.retry_after}
+            return e.code, payload
+        except (KeyError, TypeError, ValueError) as e:
+            self.errors[(method, 400)] += 1
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        return 200, {"ok": True, "result": result}
+
+async def _serve_forever(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_429, args.retry_after)
+    port = await api.start(args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{port}/bot<token>/<method>")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            if api.calls:
+                print(dict(api.calls.most_common()), dict(api.errors) or "")
+    finally:
+        await api.stop()
+
+def add_fault_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, мс")
+    ap.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    ap.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    add_fault_args(ap)
+    args = ap.parse_args()
+    try:
+        asyncio.run(_serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
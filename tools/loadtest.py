@@ -0,0 +1,240 @@
+"""Нагрузочный прогон: виртуальные пользователи проходят реальные сценарии бота через фейковый Bot API.
+
+Сценарий пользователя: /start → consent:yes → setz:<знак> → «Предсказания» → catpred:<категория>
+→ catdepth:<категория>:<формат> → «Таро» → tarot:draw_entry → tarot:draw:<расклад>; шаги после
+онбординга повторяются --rounds раз. Кнопки берутся из клавиатур, которые прислал бот.
+Задержка шага — от постановки апдейта в очередь getUpdates до первого видимого ответа
+(sendMessage/sendPhoto/edit*) в чате пользователя.
+
+По умолчанию бот запускается дочерним процессом с отдельной БД во временном каталоге:
+
+    python tools/loadtest.py --users 2000 --concurrency 500 --latency 30 --rate-429 0.005
+
+С --no-spawn бот нужно запустить самому с TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot.
+"""
+import argparse, asyncio, os, random, signal, sys, tempfile, time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from fake_bot_api import FakeBotAPI, add_fault_args  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+VISIBLE = {"sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+USER_ID_BASE = 7_000_000_000
+
+class StepTimeout(Exception):
+    pass
+
+class Chat:
+    """Что бот показал пользователю: какие сообщения тронуты с начала текущего шага."""
+
+    def __init__(self):
+        self.seq = 0
+        self.touched: dict[int, int] = {}   # message_id -> seq последнего изменения
+        self.changed = asyncio.Event()
+        self.first_at: float | None = None
+
+class Simulator:
+    def __init__(self, api: FakeBotAPI, timeout: float, think: float):
+        self.api, self.timeout, self.think = api, timeout, think
+        self.chats: dict[int, Chat] = defaultdict(Chat)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.timeouts: dict[str, int] = defaultdict(int)
+        self.updates = 0
+        api.on_call = self._on_call
+
+    def _on_call(self, method: str, chat_id, params: dict, result):
+        if method not in VISIBLE or chat_id not in self.chats or not isinstance(result, dict):
+            return
+        chat = self.chats[chat_id]
+        chat.seq += 1
+        chat.touched[result["message_id"]] = chat.seq
+        if chat.first_at is None:
+            chat.first_at = time.perf_counter()
+        chat.changed.set()
+
+    # --- что на экране ---
+    def _recent(self, chat_id: int, since: int):
+        """Сообщения, изменённые после since, от свежих к старым."""
+        chat, msgs = self.chats[chat_id], self.api.messages[chat_id]
+        for mid, seq in sorted(chat.touched.items(), key=lambda kv: -kv[1]):
+            if seq > since and mid in msgs:
+                yield msgs[mid]
+
+    @staticmethod
+    def _inline(msg: dict) -> list[str]:
+        kb = (msg.get("reply_markup") or {}).get("inline_keyboard") or []
+        return [b["callback_data"] for row in kb for b in row if "callback_data" in b]
+
+    @staticmethod
+    def _reply(msg: dict) -> list[str]:
+        kb = (msg.get("reply_markup") or {}).get("keyboard") or []
+        return [b["text"] if isinstance(b, dict) else b for row in kb for b in row]
+
+    def find_button(self, chat_id: int, prefix: str, since: int = 0, skip: tuple = ()):
+        """(message, callback_data) — случайная кнопка с префиксом в самом свежем сообщении, где она есть."""
+        for msg in self._recent(chat_id, since):
+            opts = [d for d in self._inline(msg) if d.startswith(prefix) and d not in skip]
+            if opts:
+                return msg, random.choice(opts)
+        return None
+
+    def find_reply_button(self, chat_id: int, substr: str, since: int = 0):
+        for msg in self._recent(chat_id, since):
+            opts = [t for t in self._reply(msg) if substr in t]
+            if opts:
+                return opts[0]
+        return None
+
+    # --- шаг сценария ---
+    async def step(self, name: str, user: dict, payload: dict, ready):
+        """Отправляет апдейт и ждёт, пока ready(since) не вернёт не-None; задержка — до первого ответа."""
+        chat = self.chats[user["id"]]
+        since, chat.first_at = chat.seq, None
+        t0 = time.perf_counter()
+        await self.api.push_update(payload)
+        self.updates += 1
+        deadline = t0 + self.timeout
+        while True:
+            found = ready(since) if chat.seq > since else None
+            if found is not None:
+                break
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                self.timeouts[name] += 1
+                raise StepTimeout(name)
+            chat.changed.clear()
+            try:
+                await asyncio.wait_for(chat.changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+        self.latencies[name].append(chat.first_at - t0)
+        if self.think:
+            await asyncio.sleep(random.random() * self.think)
+        return found
+
+    async def click(self, name: str, user: dict, button, expect):
+        msg, data = button
+        return await self.step(name, user, self.api.callback(user, msg, data), expect)
+
+    async def send_text(self, name: str, user: dict, text: str, expect):
+        return await self.step(name, user, self.api.user_message(user, text), expect)
+
+    # --- сценарий ---
+    async def run_user(self, n: int, rounds: int, wait_reveal: bool):
+        uid = USER_ID_BASE + n
+        user = {"id": uid, "is_bot": False, "first_name": f"load{n}", "language_code": "ru"}
+        btn = lambda prefix, *skip: (lambda since: self.find_button(uid, prefix, since, skip))
+        reply = lambda substr: (lambda since: self.find_reply_button(uid, substr, since))
+        anything = lambda since: True
+        try:
+            b = await self.send_text("start", user, "/start", btn("consent:"))
+            b = await self.click("consent", user, b, btn("setz:"))
+            await self.click("setz", user, b, reply("Предсказания"))
+            # подписи запоминаем сразу: пока идёт анимация, бот может удалить сообщение с клавиатурой
+            menu = {k: self.find_reply_button(uid, k) for k in ("Предсказания", "Таро")}
+            for _ in range(rounds):
+                b = await self.send_text("menu_catpred", user, menu["Предсказания"], btn("catpred:", "catpred:open"))
+                b = await self.click("catpred", user, b, btn("catdepth:"))
+                b = await self.click("catdepth", user, b, btn("ui:menu") if wait_reveal else anything)
+                b = await self.send_text("menu_tarot", user, menu["Таро"], btn("tarot:draw_entry"))
+                b = await self.click("tarot_entry", user, b, lambda since: self.find_button(uid, "tarot:draw:", since)
+                                     or self.find_button(uid, "tarot:buy", since))
+                if b[1].startswith("tarot:draw:"):
+                    await self.click("tarot_draw", user, b, anything)
+        except StepTimeout:
+            pass
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+def report(sim: Simulator, api: FakeBotAPI, wall: float):
+    print(f"\n{'шаг':<14}{'n':>8}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'таймауты':>10}")
+    total = []
+    for name, vals in sim.latencies.items():
+        total.extend(vals)
+        print(f"{name:<14}{len(vals):>8}{percentile(vals, .5) * 1000:>10.1f}{percentile(vals, .99) * 1000:>10.1f}"
+              f"{max(vals) * 1000:>10.1f}{sim.timeouts.get(name, 0):>10}")
+    for name, n in sim.timeouts.items():
+        if name not in sim.latencies:
+            print(f"{name:<14}{0:>8}{'':>30}{n:>10}")
+    print(f"{'всего':<14}{len(total):>8}{percentile(total, .5) * 1000:>10.1f}{percentile(total, .99) * 1000:>10.1f}")
+    print(f"\nапдейтов: {sim.updates} за {wall:.1f} с — {sim.updates / wall:.1f} апд/с")
+    print("вызовы API:", ", ".join(f"{m}={n}" for m, n in api.calls.most_common()))
+    if api.errors:
+        print("ошибки API:", ", ".join(f"{m} {code}={n}" for (m, code), n in api.errors.most_common()))
+
+async def spawn_bot(port: int, workdir: str, log_path: Path):
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "1:loadtest",
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{port}/bot",
+        "DB_PATH": str(Path(workdir) / "loadtest.db"),
+        "UPDATES_MODE": "polling",
+    })
+    env.setdefault("PREDICTIONS_DB_DIR", str(ROOT))
+    env.pop("WEBHOOK_URL", None)
+    log = open(log_path, "wb")
+    proc = await asyncio.create_subprocess_exec(sys.executable, str(ROOT / "bot.py"), cwd=str(ROOT),
+                                                env=env, stdout=log, stderr=asyncio.subprocess.STDOUT)
+    log.close()
+    return proc
+
+async def main_async(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.rate_429, args.retry_after)
+    port = await api.start("127.0.0.1", args.port)
+    sim = Simulator(api, args.timeout, args.think / 1000)
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    proc = None
+    try:
+        if args.spawn:
+            log_path = Path(workdir) / "bot.log"
+            proc = await spawn_bot(port, workdir, log_path)
+            print(f"бот запущен (pid {proc.pid}), лог: {log_path}")
+        print(f"fake Bot API: http://127.0.0.1:{port}/bot — ждём первый getUpdates…")
+        while api.calls["getUpdates"] == 0:
+            if proc is not None and proc.returncode is not None:
+                sys.exit(f"бот завершился с кодом {proc.returncode}")
+            await asyncio.sleep(0.2)
+
+        sem = asyncio.Semaphore(args.concurrency)
+        async def _user(n):
+            async with sem:
+                await sim.run_user(n, args.rounds, args.wait_reveal)
+        t0 = time.perf_counter()
+        tasks = []
+        for n in range(args.users):
+            tasks.append(asyncio.create_task(_user(n)))
+            if args.ramp:
+                await asyncio.sleep(args.ramp / args.users)
+        await asyncio.gather(*tasks)
+        report(sim, api, time.perf_counter() - t0)
+    finally:
+        if proc is not None and proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 30)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await api.stop()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=500, help="виртуальных пользователей")
+    ap.add_argument("--concurrency", type=int, default=200, help="одновременно активных пользователей")
+    ap.add_argument("--rounds", type=int, default=1, help="повторов сценария после онбординга")
+    ap.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд запустить всех, с")
+    ap.add_argument("--think", type=float, default=0.0, help="пауза пользователя между шагами до N мс")
+    ap.add_argument("--timeout", type=float, default=30.0, help="сколько ждать ответа на шаг, с")
+    ap.add_argument("--wait-reveal", action="store_true", help="на catdepth ждать показа предсказания после анимации")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--no-spawn", dest="spawn", action="store_false", help="бот уже запущен отдельно")
+    add_fault_args(ap)
+    asyncio.run(main_async(ap.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Отправляет записанные апдейты в локальный webhook бота.
+
+Файл — JSON-массив апдейтов или JSONL (по апдейту на строку), как их присылает Telegram.
+Бот запускается с UPDATES_MODE=webhook (WEBHOOK_URL можно не задавать) и тем же WEBHOOK_SECRET
+(без WEBHOOK_URL он обязателен — бот не стартует со случайным секретом):
+
+    python tools/replay_updates.py updates.jsonl --url http://127.0.0.1:8443/tg-webhook --secret change-me
+"""
+import argparse, json, os, sys, time
+
+import httpx
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("file")
+    ap.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}/{os.getenv('WEBHOOK_PATH', 'tg-webhook').strip('/')}")
+    ap.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    ap.add_argument("--delay", type=float, default=0.0, help="пауза между апдейтами, с")
+    args = ap.parse_args()
+
+    updates = load_updates(args.file)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret}
+    failed = 0
+    with httpx.Client(headers=headers, timeout=10) as client:
+        for upd in updates:
+            r = client.post(args.url, json=upd)
+            if r.status_code != 200:
+                failed += 1
+                print(f"update {upd.get('update_id')}: HTTP {r.status_code}", file=sys.stderr)
+            if args.delay:
+                time.sleep(args.delay)
+    print(f"sent {len(updates)}, failed {failed}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()